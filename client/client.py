@@ -1,60 +1,259 @@
 #!/usr/bin/python
 
 import ConfigParser
+import httplib
+import urlparse
 import urllib2
 import urllib
 import json
 import sys
 import json
 import re
+import socket
 import syslog
+import threading
 import time
 import random
 import subprocess
 import os
 import hashlib
+import base64
+import calendar
+from multiprocessing.pool import ThreadPool
 
 
 def log(msg):
-    print(time.strftime('%Y/%m/%d %H:%M ') + msg)
+    # single write keeps lines of parallel workers from interleaving
+    sys.stdout.write(time.strftime('%Y/%m/%d %H:%M ') + msg + "\n")
+
+
+class GeneratorClient:
+    """
+    Call generator API reusing one keep-alive connection per generator and thread
+    """
+    def __init__(self, timeout=20):
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connections(self):
+        if not hasattr(self._local, 'connections'):
+            self._local.connections = {}
+
+        return self._local.connections
+
+    def _connection(self, generator):
+        connections = self._connections()
+        if generator not in connections:
+            url = urlparse.urlparse(generator)
+            if url.scheme == 'https':
+                connection = httplib.HTTPSConnection(url.netloc, timeout=self.timeout)
+            else:
+                connection = httplib.HTTPConnection(url.netloc, timeout=self.timeout)
+            connections[generator] = (connection, url.path.rstrip('/') + '/call')
+
+        return connections[generator]
+
+    def _drop(self, generator):
+        connection, path = self._connections().pop(generator)
+        connection.close()
+
+    def call(self, generator, req):
+        """
+        Send API request to generator
+
+        :param generator: generator base URL
+        :param req: request dict
+        :return: response body
+        """
+        body = json.dumps(req)
+        for attempt in range(2):
+            connection, path = self._connection(generator)
+            try:
+                connection.request('POST', path, body, {'Content-Type': 'application/json'})
+                response = connection.getresponse()
+                answer = response.read()
+            except (httplib.HTTPException, socket.error):
+                self._drop(generator)
+                # kept alive connection could be closed by server, retry once on new one
+                if attempt:
+                    raise
+                continue
+
+            if response.version < 11 or response.getheader('connection', '').lower() == 'close':
+                self._drop(generator)
+
+            return answer
+
+
+class TriggerQueue:
+    """
+    Collect trigger commands of changed services and run each unique command once
+    """
+    def __init__(self, delay=2):
+        self.delay = delay
+        self._commands = []
+        self._changed = 0
+        self._lock = threading.Lock()
+
+    def add(self, command):
+        with self._lock:
+            if command not in self._commands:
+                self._commands.append(command)
+            self._changed = time.time()
+
+    def flush(self):
+        """
+        Wait until no new triggers were added for delay seconds, then run collected commands
+
+        :return:
+        """
+        while True:
+            with self._lock:
+                if not self._commands:
+                    return
+
+                quiet = self._changed + self.delay - time.time()
+                if quiet <= 0:
+                    commands = self._commands
+                    self._commands = []
+                    break
+
+            time.sleep(quiet)
+
+        for command in commands:
+            log("Running trigger command: %s" % command)
+            tr = subprocess.Popen(command, shell=True)
+
+            res = tr.wait()
+            if res != 0:
+                log("failed to executed trigger command, got : %d" % res)
 
 
 class CertLoader:
-    def load_certs(self, services):
-        res = True
-        for service in services:
-            if not self.load_service_certs(service, services[service]):
+    def __init__(self, workers=16, state_path=None):
+        self.workers = workers
+        self.client = GeneratorClient()
+        self.watch_client = GeneratorClient(timeout=WATCH_TIMEOUT + 30)
+        self.triggers = TriggerQueue(TRIGGER_DELAY)
+        # service => fingerprint, not_after, last_sync and generator of last loaded certificate
+        self.state_path = state_path
+        self._stateLock = threading.Lock()
+        self.state = self.load_state()
+
+    def _load(self, item):
+        service, service_info, force = item
+        try:
+            return self.load_service_certs(service, service_info, force)
+        except Exception as e:
+            log("Failed to load cert for %s, error: %s" % (service, str(e)))
+            return False
+
+    def load_parallel(self, services, force=False):
+        """
+        Load certificates for all services using bounded pool of workers
+
+        :param services:
+        :param force: contact generator even if certificate was synced recently
+        :return: list of services failed to load
+        """
+        items = [(service, services[service], force) for service in services]
+        if not items:
+            return []
+
+        pool = ThreadPool(min(self.workers, len(items)))
+        try:
+            results = pool.map(self._load, items)
+        finally:
+            pool.close()
+            pool.join()
+
+        failed = []
+        for (service, service_info, force), result in zip(items, results):
+            if not result:
                 log("Failed to load cert for %s" % service)
-                res = False
+                failed.append(service)
 
-        return res
+        self.save_state()
+        self.triggers.flush()
+        return failed
+
+    def load_certs(self, services):
+        return len(self.load_parallel(services)) == 0
 
     def blocking_load(self, services, timeout):
         start = time.time()
-        loaded = []
+        pending = dict(services)
 
         while start > time.time() - timeout:
-            all_loaded = True
-            for service in services:
-                if service in loaded:
-                    continue
-
-                if not self.load_service_certs(service, services[service]):
-                    all_loaded = False
-                    log("Failed to load cert for %s" % service)
-                    continue
-
-                loaded.append(service)
-
-            if all_loaded:
+            failed = self.load_parallel(pending)
+            if not failed:
                 return True
 
-            log("Failed to load all certs. Sleep for some time")
+            pending = dict([(service, services[service]) for service in failed])
+            log("Failed to load %d certs. Sleep for some time" % len(pending))
             time.sleep(15)
 
         log("Failed to load all certs")
         return False
 
+    def watch(self, services):
+        """
+        Start long-poll watchers, one per generator
+
+        :param services:
+        :return: list of started threads
+        """
+        generators = {}
+        for service in services:
+            generator = self.prepare_variable(services[service]['generator'])
+            generators.setdefault(generator, {})[service] = services[service]
+
+        threads = []
+        for generator in generators:
+            thread = threading.Thread(target=self.watch_generator, args=(generator, generators[generator]))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        return threads
+
+    def watch_generator(self, generator, services):
+        """
+        Wait for certificates changes on generator and reload changed services
+
+        :param generator:
+        :param services:
+        :return:
+        """
+        log("Watching %d services on %s" % (len(services), generator))
+        while True:
+            hostnames = {}
+            for service in services:
+                hostnames[services[service]['hostname']] = self.state.get(service, {}).get('fingerprint', '')
+
+            try:
+                answer = json.loads(self.watch_client.call(generator, {
+                    "type": "watch",
+                    "hostnames": hostnames,
+                    "timeout": WATCH_TIMEOUT
+                }))
+            except (IOError, ValueError, httplib.HTTPException) as e:
+                log("Failed to watch %s: %s" % (generator, str(e)))
+                time.sleep(60)
+                continue
+
+            if answer.get('status') != 'changed':
+                if answer.get('status') != 'timeout':
+                    log("Unexpected watch reply from %s: %s" % (generator, str(answer)))
+                    time.sleep(60)
+                continue
+
+            changed = dict([(service, services[service]) for service in services
+                            if services[service]['hostname'] in answer['hostnames']])
+            log("Certificates changed for %s" % ", ".join(changed.keys()))
+            if self.load_parallel(changed, force=True):
+                time.sleep(60)
+
     def prepare_variable(self, variable):
         """
         Replace variables in item with environment variables
@@ -78,22 +277,218 @@ class CertLoader:
 
         return result
 
-    def fail_with_fallback(self, key, cert, fallback):
+    def split_pem(self, pem):
+        """
+        Split PEM bundle to list of certificates
+
+        :param pem:
+        :return:
+        """
+        return [block + '-----END CERTIFICATE-----\n' for block in
+                re.findall('-----BEGIN CERTIFICATE-----[^-]+', pem)]
+
+    def pem_to_der(self, pem):
+        """
+        Convert one PEM encoded certificate to DER
+
+        :param pem:
+        :return:
+        """
+        lines = pem.strip().split('\n')
+        return base64.b64decode(''.join([line.strip() for line in lines[1:-1]]))
+
+    def pkcs12(self, key, certs, password):
+        """
+        Pack key and certificates chain to PKCS#12 bundle
+
+        :param key:
+        :param certs:
+        :param password:
+        :return: bundle or None on failure
+        """
+        cmd = ["openssl", "pkcs12", "-export", "-passout", "env:SCMT_PKCS12_PASSWORD"]
+        env = dict(os.environ, SCMT_PKCS12_PASSWORD=password)
+        convert = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+        data, err = convert.communicate(key + ''.join(certs))
+        if convert.returncode != 0:
+            log("Failed to create PKCS#12 bundle, exitcode: %d, %s" % (convert.returncode, err))
+            return None
+
+        return data
+
+    def file_digest(self, path):
+        """
+        Calculate SHA256 of file reading it by chunks
+
+        :param path:
+        :return:
+        """
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                h.update(chunk)
+
+        return h.hexdigest()
+
+    def write_atomic(self, path, data):
+        """
+        Replace file content using temporary file and rename, so readers never see partially written file
+
+        :param path:
+        :param data:
+        :return: True when file content changed
+        """
+        if os.path.exists(path) and self.file_digest(path) == hashlib.sha256(data).hexdigest():
+            return False
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            log("Create directory %s" % directory)
+            os.makedirs(directory)
+
+        tmp_path = "%s.tmp-%d-%s" % (path, os.getpid(), str(random.random())[2:])
+        try:
+            with open(tmp_path, 'w') as out:
+                out.write(data)
+                out.flush()
+                os.fsync(out.fileno())
+
+            if os.path.exists(path):
+                os.chmod(tmp_path, os.stat(path).st_mode & 0o7777)
+            os.rename(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+        return True
+
+    def fail_with_fallback(self, service, key, cert, fallback):
         """
         Check if we already have key and cert and in fallback mode
 
+        :param service:
         :param key:
         :param cert:
         :param fallback:
         :return:
         """
-        if os.path.exists(key) and os.path.exists(cert) and fallback:
-            log("Fallback mode, old keys and certs: %s %s" % (key, cert))
-            return True
-        else:
+        if not fallback or not os.path.exists(key) or not os.path.exists(cert):
+            return False
+
+        state = self.state.get(service)
+        if state and state.get('not_after') and state['not_after'] < time.time():
+            log("Fallback is not possible, certificate %s expired" % cert)
+            return False
+
+        log("Fallback mode, old keys and certs: %s %s" % (key, cert))
+        return True
+
+    def not_after(self, der):
+        """
+        Read expiration time from DER encoded certificate
+
+        :param der:
+        :return: unix timestamp or 0 when certificate can't be parsed
+        """
+        def item(offset):
+            tag = ord(der[offset])
+            length = ord(der[offset + 1])
+            offset += 2
+            if length & 0x80:
+                size = length & 0x7f
+                length = int(der[offset:offset + size].encode('hex'), 16)
+                offset += size
+            return tag, offset, length
+
+        try:
+            # Certificate => TBSCertificate
+            tag, offset, length = item(0)
+            tag, offset, length = item(offset)
+
+            tag, offset, length = item(offset)
+            # skip explicit version, serial, signature algorithm and issuer
+            skip = 3 if tag == 0xa0 else 2
+            for i in range(skip):
+                tag, offset, length = item(offset + length)
+
+            # validity => notBefore, notAfter
+            tag, offset, length = item(offset + length)
+            tag, offset, length = item(offset)
+            tag, offset, length = item(offset + length)
+            value = der[offset:offset + length]
+            if tag == 0x17:
+                value = ('19' if int(value[:2]) >= 50 else '20') + value
+
+            # time.strptime is not thread safe in python 2, parse fields manually
+            return calendar.timegm([int(value[i:i + 2 if i else 4]) for i in (0, 4, 6, 8, 10, 12)] + [0, 0, 0])
+        except (IndexError, ValueError):
+            return 0
+
+    def load_state(self):
+        if not self.state_path or not os.path.exists(self.state_path):
+            return {}
+
+        try:
+            with open(self.state_path, 'r') as state_file:
+                return json.load(state_file)
+        except (IOError, ValueError) as e:
+            log("Failed to load state from %s: %s" % (self.state_path, str(e)))
+            return {}
+
+    def save_state(self):
+        if not self.state_path:
+            return
+
+        with self._stateLock:
+            data = json.dumps(self.state, indent=1, sort_keys=True)
+
+        try:
+            self.write_atomic(self.state_path, data)
+        except (IOError, OSError) as e:
+            log("Failed to save state to %s: %s" % (self.state_path, str(e)))
+
+    def is_fresh(self, service, generator, outputs):
+        """
+        Check if certificate was synced recently and not going to expire soon
+
+        :param service:
+        :param generator:
+        :param outputs: files which should exist
+        :return:
+        """
+        state = self.state.get(service)
+        if not state or state.get('generator') != generator:
+            return False
+
+        if state.get('last_sync', 0) < time.time() - REFRESH_INTERVAL:
             return False
 
-    def load_service_certs(self, service, service_info):
+        if state.get('not_after', 0) < time.time() + RENEW_MARGIN:
+            return False
+
+        return all([os.path.exists(path) for path in outputs])
+
+    def update_state(self, service, **values):
+        with self._stateLock:
+            self.state.setdefault(service, {}).update(values)
+
+    def request_cert(self, generator, hostname, fingerprint=None):
+        req = {
+            "type": "cert",
+            "hostname": hostname
+        }
+        if fingerprint:
+            req['fingerprint'] = fingerprint
+
+        backend_answer = self.client.call(generator, req).rstrip()
+
+        try:
+            return json.loads(backend_answer)
+        except ValueError:
+            log("failed to parse cert request")
+            return None
+
+    def load_service_certs(self, service, service_info, force=False):
         hostname = service_info['hostname']
         key = service_info['key']
         cert = service_info['cert']
@@ -119,8 +514,26 @@ class CertLoader:
             trigger = None
 
         generator = self.prepare_variable(service_info['generator'])
+
+        outputs = [key, cert]
+        if 'chain' in service_info:
+            outputs.append(service_info['chain'])
+
+        if not force and self.is_fresh(service, generator, outputs):
+            log("Certificate for %s synced recently, skipping" % service)
+            return True
+
         log("Working on %s/%s from %s" % (service, hostname, generator))
 
+        state = self.state.get(service, {})
+        cert_info = None
+        if state.get('fingerprint') and state.get('generator') == generator and all([os.path.exists(path) for path in outputs]):
+            cert_info = self.request_cert(generator, hostname, state['fingerprint'])
+            if cert_info and cert_info.get('status') == 'not_modified':
+                log("Certificate for %s is not changed" % service)
+                self.update_state(service, last_sync=time.time())
+                return True
+
         req = {
             "type": "key",
             "bits": 2048,
@@ -128,94 +541,75 @@ class CertLoader:
             "algo": algo,
         }
 
-        link = urllib2.urlopen(generator + '/call', json.dumps(req), timeout=20)
-        backend_answer = link.read().rstrip()
+        backend_answer = self.client.call(generator, req).rstrip()
 
         log("Received backend answer")
         try:
             info = json.loads(backend_answer)
         except ValueError:
-            return self.fail_with_fallback(key, cert, fallback)
+            return self.fail_with_fallback(service, key, cert, fallback)
 
         if 'key' not in info:
             log("no key found, reply: %s" % backend_answer)
-            return self.fail_with_fallback(cert, key, fallback)
-
-        if not os.path.exists(os.path.dirname(key)):
-            log("Create directory to store key file")
-            os.makedirs(os.path.dirname(key))
-
-        with open(key, 'w') as key_out:
-            key_out.write(info['key'])
+            return self.fail_with_fallback(service, key, cert, fallback)
 
-        req = {
-            "type": "cert",
-            "hostname": hostname
-        }
+        if self.write_atomic(key, info['key']) and trigger:
+            log("key updated in %s" % key)
+            self.triggers.add(trigger)
 
-        link = urllib2.urlopen(generator + '/call', json.dumps(req), timeout=20)
-        backend_answer = link.read().rstrip()
+        if not cert_info or cert_info.get('status') != 'available':
+            cert_info = self.request_cert(generator, hostname)
 
-        try:
-            cert_info = json.loads(backend_answer)
-        except ValueError:
-            log("failed to parse cert request")
-            return self.fail_with_fallback(key, cert, fallback)
+        if not cert_info:
+            return self.fail_with_fallback(service, key, cert, fallback)
 
         if 'status' not in cert_info:
             log("No status info found")
-            return self.fail_with_fallback(key, cert, fallback)
+            return self.fail_with_fallback(service, key, cert, fallback)
 
         if 'fullchain' not in cert_info:
             log("No fullchain found in reply")
-            return self.fail_with_fallback(key, cert, fallback)
+            return self.fail_with_fallback(service, key, cert, fallback)
 
         if cert_info['status'] == 'available':
-            updated = False
-            old_hash = ''
-            if not os.path.exists(cert):
-                updated = True
+            if 'fingerprint' in cert_info:
+                fingerprint = cert_info['fingerprint']
             else:
-                with open(cert, 'r') as old_cert:
-                    h = hashlib.md5()
-                    h.update(old_cert.read())
-                    old_hash = h.hexdigest()
+                fingerprint = hashlib.sha256(cert_info['fullchain']).hexdigest()
 
+            certs = self.split_pem(cert_info['fullchain'])
+            if not certs:
+                log("No certificates found in fullchain")
+                return self.fail_with_fallback(service, key, cert, fallback)
+
+            leaf = self.pem_to_der(certs[0])
+            # PKCS#12 output is randomized, so bundle is compared by its inputs
+            pkcs12_inputs = None
             if outform == 'der':
-                tmpFile = "/tmp/crt-%s" % (str(random.random()))
-                with open(tmpFile, 'w') as cert_out:
-                    cert_out.write(cert_info['fullchain'])
-                    log("cert saved to temporary path for converting. path: %s" % tmpFile)
-
-                cmd = ["openssl", "x509", "-in", tmpFile, "-out", cert, "-inform", "pem", "-outform", "der"]
-                log("Running: " + " ".join(cmd))
-                convert = subprocess.Popen(cmd)
-
-                res = convert.wait()
-                if res != 0:
-                    log("Failed to convert cert to DER format, exitcode: %d" % res)
+                data = leaf
+            elif outform == 'pkcs12':
+                pkcs12_inputs = hashlib.sha256(info['key'] + ''.join(certs) + service_info.get('password', '')).hexdigest()
+                if state.get('pkcs12_inputs') == pkcs12_inputs and os.path.exists(cert):
+                    data = None
+                else:
+                    data = self.pkcs12(info['key'], certs, service_info.get('password', ''))
+                    if data is None:
+                        return self.fail_with_fallback(service, key, cert, fallback)
             else:
-                with open(cert, 'w') as cert_out:
-                    cert_out.write(cert_info['fullchain'])
-                    log("cert info updated in %s" % cert)
-            if not os.path.exists(os.path.dirname(cert)):
-                os.makedirs(os.path.dirname(cert))
-
-            with open(cert, 'r') as new_cert:
-                h = hashlib.md5()
-                h.update(new_cert.read())
-                new_hash = h.hexdigest()
-
-                if new_hash != old_hash and trigger:
-                    log("Hash changed %s => %s" % (old_hash, new_hash))
+                data = cert_info['fullchain']
 
-                    log("Running trigger command: %s" % trigger)
-                    tr = subprocess.Popen(trigger, shell=True)
+            files = [(cert, data)] if data is not None else []
+            if 'chain' in service_info:
+                files.append((service_info['chain'], ''.join(certs[1:])))
 
-                    res = tr.wait()
-                    if res != 0:
-                        log("failed to executed trigger command, got : %d" % res)
+            for path, content in files:
+                if self.write_atomic(path, content):
+                    log("cert info updated in %s" % path)
+                    if trigger:
+                        self.triggers.add(trigger)
 
+            self.update_state(service, fingerprint=fingerprint, not_after=self.not_after(leaf),
+                              last_sync=time.time(), generator=generator, pkcs12_inputs=pkcs12_inputs)
             return True
         else:
             log("cert status is %s" % cert_info['status'])
@@ -223,6 +617,13 @@ class CertLoader:
 
 
 LOAD_TIMEOUT = 500
+LOAD_WORKERS = 16
+WATCH_TIMEOUT = 300
+TRIGGER_DELAY = 2
+# certificates synced within this interval are not requested again on start
+REFRESH_INTERVAL = 43200
+# refresh certificate earlier when it expires within this time
+RENEW_MARGIN = 86400 * 7
 
 if os.getenv('SCMT_CONFIG') != '':
     app_config = os.getenv('SCMT_CONFIG')
@@ -244,7 +645,12 @@ for service_name in sections:
     for opt in options:
         services[service_name][opt] = parser.get(service_name, opt)
 
-loader = CertLoader()
+if os.getenv('SCMT_STATE'):
+    state_path = os.getenv('SCMT_STATE')
+else:
+    state_path = '/var/lib/scmt-client/state.json'
+
+loader = CertLoader(LOAD_WORKERS, state_path)
 
 if '-once' in sys.argv:
     log("Downloading certificates first time")
@@ -252,6 +658,13 @@ if '-once' in sys.argv:
     sys.exit(0)
 
 log("Starting scmt daemon process")
+if '-watch' in sys.argv:
+    log("Downloading certificates first time")
+    loader.blocking_load(services, LOAD_TIMEOUT)
+    loader.watch(services)
+    # watchers deliver changes, full reload is kept as safety net
+    time.sleep(43200)
+
 while True:
     log("Starting download process")
     try:
@@ -0,0 +1,255 @@
+"""
+End-to-end benchmark of scmt with local stand-ins for Consul, ACME and Cloudflare.
+
+Usage (from server directory):
+    python -m bench.run --hosts 200 --scan-hosts 1000,10000 --json bench.json
+"""
+import argparse
+import httplib
+import json
+import random
+import resource
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import scmt.loggable
+from scmt.api.handler import Handler
+from scmt.api.server import Server
+from scmt.ca.baseca import BaseCA
+from scmt.ca.letsencrypt import LetsEncrypt
+from scmt.hooks.cloudflare import Cloudflare
+from scmt.hooks.propagation import PropagationChecker
+from scmt.manager import Manager
+from scmt.reconciler import Reconciler
+from scmt.storages.consul import Consul
+
+from stub_acme import AcmeServer
+from stub_cloudflare import CloudflareServer
+from stub_consul import ConsulServer
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def memory_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def bench_issuance(args, work_dir, consul, acme, cloudflare):
+    Cloudflare.api_url = cloudflare.url
+    PropagationChecker.interval = 0.05
+    LetsEncrypt.account_key_size = 2048
+
+    domains = {
+        'example.com': {
+            'ca': 'letsencrypt',
+            'url': acme.url,
+            'storage': 'kv',
+            'issuers': acme.ca_cert,
+            'tmp': work_dir + '/tmp',
+            'hook': 'cloudflare',
+            'hook.email': 'bench@example.com',
+            'hook.key': 'bench',
+            'hook.nameservers': '%s:%d' % cloudflare.dns_address,
+            'hook.propagation_window': '0.05'
+        }
+    }
+    manager = Manager(work_dir + '/data', domains, {'kv': Consul(consul.address)},
+                      issue_workers=args.workers, cleanup_workers=args.cleanup_workers)
+    manager.daemon = True
+    manager.start()
+    if not manager.wait_ready(args.timeout):
+        raise RuntimeError("Domains failed to initialize: %s" % manager.get_readiness())
+
+    hostnames = ['host%d.bench.example.com' % i for i in range(args.hosts)]
+    pool = ThreadPool(args.workers)
+    pool.map(lambda hostname: manager.get_key({'hostname': hostname, 'algo': 'EC-SECP384R1', 'bits': 384}), hostnames)
+    pool.close()
+
+    started = time.time()
+    with manager.issued:
+        issued_before = manager.issued_count
+
+    for hostname in hostnames:
+        manager.add_to_queue(hostname)
+
+    deadline = started + args.timeout
+    with manager.issued:
+        while manager.issued_count - issued_before < len(hostnames) and time.time() < deadline:
+            manager.issued.wait(1)
+        issued = manager.issued_count - issued_before
+
+    elapsed = time.time() - started
+    return manager, hostnames, {
+        'hosts': len(hostnames),
+        'issued': issued,
+        'seconds': elapsed,
+        'certs_per_sec': issued / elapsed if elapsed else 0,
+        'memory_mb': memory_mb()
+    }
+
+
+def bench_api(args, manager, hostnames):
+    server = Server(('127.0.0.1', 0), Handler, manager=manager)
+    serve_thread = threading.Thread(target=server.serve_forever, name='bench-api')
+    serve_thread.daemon = True
+    serve_thread.start()
+
+    latencies = []
+    errors = []
+    per_client = args.api_requests // args.api_clients
+
+    def client(number):
+        connection = httplib.HTTPConnection('127.0.0.1', server.server_address[1], timeout=30)
+        local = []
+        for i in range(per_client):
+            body = json.dumps({'type': 'cert', 'hostname': random.choice(hostnames)})
+            started = time.time()
+            try:
+                connection.request('POST', '/', body, {'Content-Type': 'application/json'})
+                response = connection.getresponse()
+                response.read()
+            except (httplib.HTTPException, IOError):
+                errors.append(1)
+                connection.close()
+                connection = httplib.HTTPConnection('127.0.0.1', server.server_address[1], timeout=30)
+                continue
+            local.append(time.time() - started)
+
+        latencies.extend(local)
+
+    started = time.time()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(args.api_clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+    server.shutdown()
+
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'requests_per_sec': len(latencies) / elapsed if elapsed else 0,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'memory_mb': memory_mb()
+    }
+
+
+def bench_scan(args, work_dir, consul, acme, hosts):
+    domain = 'scan%d.example.com' % hosts
+    cert = acme.signer.sign(leaf_csr(work_dir), days=90)[0]
+    now = str(time.time())
+    for i in range(hosts):
+        prefix = '%s/h%d.%s/' % (domain, i, domain)
+        consul.store.put(prefix + 'cert.pem', cert)
+        consul.store.put(prefix + 'fullchain.pem', cert)
+        consul.store.put(prefix + 'requests/127_0_0_1', now)
+
+    storage = Consul(consul.address)
+    ca = BaseCA(domain, {'tmp': work_dir + '/tmp'}, storage)
+    reconciler = Reconciler(domain, ca, storage)
+    reconciler.slice_size = hosts
+
+    pool = ThreadPool(args.cleanup_workers)
+    started = time.time()
+    checked = reconciler.tick(pool)
+    full = time.time() - started
+
+    started = time.time()
+    rechecked = reconciler.tick(pool)
+    incremental = time.time() - started
+    pool.close()
+
+    consul.store.delete(domain + '/', recurse=True)
+    return {
+        'hosts': hosts,
+        'checked': checked,
+        'full_scan_seconds': full,
+        'hosts_per_sec': checked / full if full else 0,
+        'incremental_checked': rechecked,
+        'incremental_seconds': incremental,
+        'memory_mb': memory_mb()
+    }
+
+
+def leaf_csr(work_dir):
+    subprocess.check_call(['openssl', 'req', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1', '-nodes',
+                           '-keyout', work_dir + '/leaf.key', '-out', work_dir + '/leaf.csr', '-subj', '/CN=scan'],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    with open(work_dir + '/leaf.csr') as csr:
+        return csr.read()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='scmt end-to-end benchmark')
+    parser.add_argument('--hosts', type=int, default=100, help='number of certificates to issue')
+    parser.add_argument('--workers', type=int, default=8, help='issue workers')
+    parser.add_argument('--cleanup-workers', type=int, default=8, help='clean-up workers')
+    parser.add_argument('--api-clients', type=int, default=16, help='parallel API clients')
+    parser.add_argument('--api-requests', type=int, default=5000, help='total number of cert API requests')
+    parser.add_argument('--scan-hosts', default='1000', help='comma separated fleet sizes for clean-up scan')
+    parser.add_argument('--latency-ms', type=float, default=0, help='latency added by every stub')
+    parser.add_argument('--timeout', type=float, default=600, help='issuance timeout')
+    parser.add_argument('--json', help='write results to file')
+    parser.add_argument('--verbose', action='store_true', help='show scmt log')
+    args = parser.parse_args()
+
+    if not args.verbose:
+        scmt.loggable.set_level('error')
+
+    latency = args.latency_ms / 1000.0
+    work_dir = tempfile.mkdtemp(prefix='scmt-bench-')
+    results = {}
+    try:
+        consul = ConsulServer(latency).start()
+        acme = AcmeServer(work_dir, latency).start()
+        cloudflare = CloudflareServer(latency).start()
+
+        manager, hostnames, results['issuance'] = bench_issuance(args, work_dir, consul, acme, cloudflare)
+        results['api'] = bench_api(args, manager, hostnames)
+        results['scan'] = [bench_scan(args, work_dir, consul, acme, int(hosts)) for hosts in args.scan_hosts.split(',')]
+        manager.is_active = False
+        with manager.queueLock:
+            manager.queueCondition.notify_all()
+        manager.join(10)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+
+def report(results):
+    issuance = results['issuance']
+    print("Issuance: %d/%d certificates in %.1f s, %.2f certs/s" % (
+        issuance['issued'], issuance['hosts'], issuance['seconds'], issuance['certs_per_sec']))
+
+    api = results['api']
+    print("API cert: %d requests, %d errors, %.0f req/s, p50 %.2f ms, p99 %.2f ms" % (
+        api['requests'], api['errors'], api['requests_per_sec'], api['p50_ms'], api['p99_ms']))
+
+    for scan in results['scan']:
+        print("Clean-up %d hosts: full %.1f s (%.0f hosts/s), incremental %d hosts in %.3f s" % (
+            scan['hosts'], scan['full_scan_seconds'], scan['hosts_per_sec'],
+            scan['incremental_checked'], scan['incremental_seconds']))
+
+    print("Peak memory: %.1f MB" % max([issuance['memory_mb'], api['memory_mb']] +
+                                       [scan['memory_mb'] for scan in results['scan']]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+"""
+Renewal scheduling simulation. Real Manager issue workers, Reconciler and
+BaseCA clean-up run against simulated clock, in-memory storage and CA which
+takes --issue-seconds of virtual time per issue and enforces rate limit, so
+months of renewals take seconds.
+
+Usage (from server directory):
+    python -m bench.simulate --hosts 10000 --days 90 --spread 0 --json sim.json
+
+Every host is checked at least once per --max-interval and workers wake
+every --cleanup-interval, so run time grows with hosts * days / max-interval
+and days / cleanup-interval.
+"""
+import argparse
+import collections
+import datetime
+import json
+import random
+import shutil
+import tempfile
+import time
+
+import scmt.loggable
+from scmt.ca.baseca import BaseCA
+from scmt.clock import SimulatedClock
+from scmt.manager import Manager
+from scmt.reconciler import Reconciler
+from scmt.storages.memory import MemoryStorage
+
+
+class SimulatedCA(BaseCA):
+    """
+    Certificate is its expiration timestamp, issue fails when more than
+    rate_limit certificates were issued during rate_window
+    """
+    def __init__(self, domain, options, storage, stats, lifetime, issue_seconds, rate_limit, rate_window):
+        BaseCA.__init__(self, domain, options, storage)
+        self.stats = stats
+        self.issue_seconds = issue_seconds
+        self.lifetime = lifetime
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self._recent = collections.deque()
+
+    def get_cert_info(self, crt):
+        return {'NotAfter': datetime.datetime.utcfromtimestamp(float(crt))}
+
+    def issue_certificate(self, hostname, force=False):
+        # worker is busy during issue, virtual time moves while it sleeps
+        self.clock.sleep(self.issue_seconds)
+        now = self.clock.time()
+        while self._recent and self._recent[0] <= now - self.rate_window:
+            self._recent.popleft()
+
+        if len(self._recent) >= self.rate_limit:
+            self.stats['rate_limited'] += 1
+            raise RuntimeError("Rate limit reached")
+
+        self._recent.append(now)
+        cert = self.get_cert(hostname)
+        if cert:
+            expires = float(cert)
+            self.stats['lags'].append(max(0, now - (expires - self._certificate_expiration)))
+            if now > expires:
+                self.stats['expired'] += 1
+                self.stats['expired_seconds'] += now - expires
+
+        self.stats['issued'].append(now)
+        self._storage.write(self.get_crt_url(hostname), str(now + self.lifetime))
+        self.certificate_issued(hostname)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def simulate(args, work_dir):
+    clock = SimulatedClock(time.time())
+    started = clock.time()
+    end = started + args.days * 86400
+    lifetime = args.lifetime * 86400
+
+    storage = MemoryStorage()
+    stats = {'issued': [], 'lags': [], 'rate_limited': 0, 'expired': 0, 'expired_seconds': 0}
+    domain = 'example.com'
+
+    random.seed(args.seed)
+    for i in range(args.hosts):
+        hostname = 'host%d.%s' % (i, domain)
+        issued = started - random.uniform(0, args.spread * 86400)
+        storage.write('%s/%s/cert.pem' % (domain, hostname), str(issued + lifetime))
+        storage.write('%s/%s/requests/127_0_0_1' % (domain, hostname), str(started))
+
+    Manager.cleanup_interval = args.cleanup_interval
+    # idle workers wake once per clean-up interval to start clean-up
+    Manager.queue_timeout = args.cleanup_interval
+    Reconciler.slice_size = args.slice_size
+    Reconciler.max_interval = args.max_interval
+    # restarts are not simulated, state is saved only on first clean-up
+    Reconciler.save_interval = end - started
+    manager = Manager(work_dir + '/data', {}, {}, issue_workers=args.workers, cleanup_workers=1, clock=clock)
+    manager.daemon = True
+    ca = SimulatedCA(domain, {
+        'tmp': work_dir + '/tmp',
+        'certificate_expiration': str(args.renew_before * 86400),
+        # clients are not simulated, keep all hosts alive
+        'request_cleanup': str(int(args.days * 86400 * 2))
+    }, storage, stats, lifetime, args.issue_seconds, args.rate_limit, args.rate_window)
+    manager.add_domain(domain, ca, storage)
+
+    # clean-up thread doesn't use the clock, time stands still while it runs
+    clock.add_activity(manager.cleanup_running)
+    manager.start()
+    clock.wait_blocked(args.workers)
+
+    peak_queue = 0
+    ticks = 0
+    while clock.time() < end:
+        clock.advance(args.cleanup_interval)
+        ticks += 1
+        peak_queue = max(peak_queue, len(manager.queue))
+
+    manager.is_active = False
+    return stats, ticks, peak_queue
+
+
+def summarize(args, stats, ticks, peak_queue, elapsed):
+    hours = collections.Counter([int(issued // 3600) for issued in stats['issued']])
+    days = collections.Counter([int(issued // 86400) for issued in stats['issued']])
+    lags = sorted(stats['lags'])
+
+    return {
+        'hosts': args.hosts,
+        'days': args.days,
+        'issued': len(stats['issued']),
+        'peak_per_hour': max(hours.values()) if hours else 0,
+        'peak_per_day': max(days.values()) if days else 0,
+        'rate_limited': stats['rate_limited'],
+        'expired': stats['expired'],
+        'expired_hours': stats['expired_seconds'] / 3600.0,
+        'lag_p50_hours': percentile(lags, 0.5) / 3600.0,
+        'lag_p90_hours': percentile(lags, 0.9) / 3600.0,
+        'lag_p99_hours': percentile(lags, 0.99) / 3600.0,
+        'lag_max_hours': lags[-1] / 3600.0 if lags else 0,
+        'peak_queue': peak_queue,
+        'ticks': ticks,
+        'seconds': elapsed
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='scmt renewal scheduling simulation')
+    parser.add_argument('--hosts', type=int, default=10000, help='number of hosts')
+    parser.add_argument('--days', type=float, default=90, help='simulated period')
+    parser.add_argument('--lifetime', type=float, default=90, help='certificate lifetime, days')
+    parser.add_argument('--renew-before', type=float, default=14, help='renew certificates this many days before expiration')
+    parser.add_argument('--spread', type=float, default=90, help='existing certificates were issued during this many days, 0 for all at once')
+    parser.add_argument('--workers', type=int, default=1, help='issue workers')
+    parser.add_argument('--issue-seconds', type=float, default=20, help='duration of one issue')
+    parser.add_argument('--rate-limit', type=int, default=300, help='certificates allowed per rate window')
+    parser.add_argument('--rate-window', type=float, default=10800, help='rate limit window, seconds')
+    parser.add_argument('--cleanup-interval', type=int, default=Manager.cleanup_interval, help='clean-up tick, seconds')
+    parser.add_argument('--slice-size', type=int, default=Reconciler.slice_size, help='hosts checked per tick')
+    parser.add_argument('--max-interval', type=int, default=Reconciler.max_interval, help='maximum time between host checks, seconds')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='write results to file')
+    parser.add_argument('--verbose', action='store_true', help='show scmt log')
+    args = parser.parse_args()
+
+    if not args.verbose:
+        scmt.loggable.set_level('error')
+
+    work_dir = tempfile.mkdtemp(prefix='scmt-sim-')
+    started = time.time()
+    try:
+        stats, ticks, peak_queue = simulate(args, work_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = summarize(args, stats, ticks, peak_queue, time.time() - started)
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+
+def report(results):
+    print("Simulated %d hosts for %d days in %.1f s (%d ticks)" % (
+        results['hosts'], results['days'], results['seconds'], results['ticks']))
+    print("Issued: %d, peak %d/hour, %d/day, peak queue %d" % (
+        results['issued'], results['peak_per_hour'], results['peak_per_day'], results['peak_queue']))
+    print("Rate limit hits: %d" % results['rate_limited'])
+    print("Renewal lag: p50 %.1f h, p90 %.1f h, p99 %.1f h, max %.1f h" % (
+        results['lag_p50_hours'], results['lag_p90_hours'], results['lag_p99_hours'], results['lag_max_hours']))
+    print("Expired before renewal: %d certificates, %.1f host-hours" % (results['expired'], results['expired_hours']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Stub ACME v1 CA, accepts any account and any challenge, certificates are signed
+with in-process signer using throw-away CA
+"""
+import BaseHTTPServer
+import SocketServer
+import base64
+import itertools
+import json
+import os
+import subprocess
+import threading
+import time
+
+from scmt.ca import asn1
+from scmt.ca.signer import Signer
+
+
+def b64decode(data):
+    return base64.urlsafe_b64decode(str(data) + '=' * (-len(data) % 4))
+
+
+class AcmeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, code, body, content_type='application/json'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Replay-Nonce', os.urandom(8).encode('hex'))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        if self.path == '/directory':
+            return self.reply(200, json.dumps({'new-authz': self.server.url + '/acme/new-authz'}))
+
+        if self.path.startswith('/acme/challenge/'):
+            return self.reply(200, json.dumps({'status': 'valid'}))
+
+        return self.reply(404, '{}')
+
+    def do_POST(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        payload = json.loads(b64decode(request['payload']))
+        resource = payload.get('resource')
+
+        if resource == 'new-reg':
+            return self.reply(201, json.dumps({'status': 'valid'}))
+
+        if resource == 'new-authz':
+            number = next(self.server.counter)
+            return self.reply(201, json.dumps({
+                'identifier': payload['identifier'],
+                'challenges': [{
+                    'type': challenge_type,
+                    'token': base64.urlsafe_b64encode(os.urandom(16)).rstrip('='),
+                    'uri': '%s/acme/challenge/%d/%s' % (self.server.url, number, challenge_type)
+                } for challenge_type in ('http-01', 'dns-01')]
+            }))
+
+        if resource == 'challenge':
+            return self.reply(202, json.dumps({'status': 'pending'}))
+
+        if resource == 'new-cert':
+            csr = asn1.pem_encode(b64decode(payload['csr']), 'CERTIFICATE REQUEST')
+            cert = self.server.signer.sign(csr, days=90)[0]
+            return self.reply(201, asn1.pem_decode(cert)[1], 'application/pkix-cert')
+
+        return self.reply(400, json.dumps({'type': 'urn:acme:error:malformed'}))
+
+
+class AcmeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, work_dir, latency=0, host='127.0.0.1', port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), AcmeHandler)
+        self.latency = latency
+        self.counter = itertools.count()
+        self.url = 'http://%s:%d' % self.server_address
+
+        self.ca_key = work_dir + '/stub-ca.key'
+        self.ca_cert = work_dir + '/stub-ca.pem'
+        subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-keyout', self.ca_key,
+                               '-out', self.ca_cert, '-subj', '/CN=Stub ACME CA', '-days', '365'],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        with open(self.ca_key) as key, open(self.ca_cert) as cert:
+            self.signer = Signer(key.read(), cert.read())
+
+    def start(self):
+        serve_thread = threading.Thread(target=self.serve_forever, name='stub-acme')
+        serve_thread.daemon = True
+        serve_thread.start()
+
+        return self
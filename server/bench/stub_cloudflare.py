@@ -0,0 +1,139 @@
+"""
+Stub Cloudflare v4 DNS API with authoritative DNS server answering TXT queries
+for created records
+"""
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import json
+import socket
+import threading
+import time
+import urlparse
+
+import dns.message
+import dns.rcode
+import dns.rrset
+
+
+class CloudflareHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, result, code=200, **extra):
+        body = json.dumps(dict({'success': code < 400, 'errors': [], 'result': result}, **extra))
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def route(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        url = urlparse.urlparse(self.path)
+        parts = url.path.split('/')[3:]
+        return parts, urlparse.parse_qs(url.query)
+
+    def do_GET(self):
+        parts, query = self.route()
+        if parts == ['zones']:
+            name = query['name'][0]
+            return self.reply([{'id': hashlib.md5(name).hexdigest(), 'name': name}])
+
+        if len(parts) == 3 and parts[2] == 'dns_records':
+            records = self.server.find(query.get('name', [None])[0], query.get('content', [None])[0])
+            per_page = int(query.get('per_page', [20])[0])
+            page = int(query.get('page', [1])[0])
+            pages = max(1, (len(records) + per_page - 1) // per_page)
+            return self.reply(records[(page - 1) * per_page:page * per_page],
+                              result_info={'page': page, 'per_page': per_page, 'total_pages': pages})
+
+        return self.reply(None, 404)
+
+    def do_POST(self):
+        parts, query = self.route()
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+
+        if len(parts) == 3 and parts[2] == 'dns_records':
+            return self.reply(self.server.create(payload))
+
+        if len(parts) == 4 and parts[3] == 'batch':
+            for record in payload.get('deletes') or []:
+                self.server.delete(record['id'])
+            return self.reply({'posts': [self.server.create(record) for record in payload.get('posts') or []]})
+
+        return self.reply(None, 404)
+
+    def do_DELETE(self):
+        parts, query = self.route()
+        self.server.delete(parts[-1])
+
+        return self.reply({'id': parts[-1]})
+
+
+class CloudflareServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, latency=0, host='127.0.0.1', port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), CloudflareHandler)
+        self.latency = latency
+        self.url = 'http://%s:%d/client/v4/' % self.server_address
+        # record ID => record
+        self.records = {}
+        self._lock = threading.Lock()
+        self._next_id = 0
+
+        self.dns = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.dns.bind((host, 0))
+        self.dns_address = self.dns.getsockname()
+
+    def create(self, payload):
+        with self._lock:
+            self._next_id += 1
+            record = {'id': '%032x' % self._next_id, 'type': payload['type'],
+                      'name': payload['name'], 'content': payload['content']}
+            self.records[record['id']] = record
+
+        return record
+
+    def delete(self, record_id):
+        with self._lock:
+            self.records.pop(record_id, None)
+
+    def find(self, name=None, content=None):
+        with self._lock:
+            return [record for record in self.records.values()
+                    if (name is None or record['name'] == name) and (content is None or record['content'] == content)]
+
+    def serve_dns(self):
+        while True:
+            wire, address = self.dns.recvfrom(65535)
+            try:
+                query = dns.message.from_wire(wire)
+            except Exception:
+                continue
+
+            response = dns.message.make_response(query)
+            question = query.question[0]
+            name = question.name.to_text().rstrip('.')
+            values = [record['content'] for record in self.find(name)]
+            if values:
+                response.answer.append(dns.rrset.from_text_list(question.name, 1, 'IN', 'TXT',
+                                                                ['"%s"' % value for value in values]))
+            else:
+                response.set_rcode(dns.rcode.NXDOMAIN)
+
+            self.dns.sendto(response.to_wire(), address)
+
+    def start(self):
+        for target, name in ((self.serve_forever, 'stub-cloudflare'), (self.serve_dns, 'stub-dns')):
+            serve_thread = threading.Thread(target=target, name=name)
+            serve_thread.daemon = True
+            serve_thread.start()
+
+        return self
@@ -0,0 +1,250 @@
+"""
+In-process HTTP server speaking the subset of Consul /v1/kv and /v1/session API used by scmt
+"""
+import BaseHTTPServer
+import SocketServer
+import base64
+import bisect
+import json
+import threading
+import time
+import urlparse
+import uuid
+
+
+class KVStore:
+    def __init__(self):
+        # sorted list of keys for prefix queries
+        self.keys = []
+        # key => (value, modify index)
+        self.values = {}
+        # deleted key => index of deletion
+        self.tombstones = {}
+        self.index = 1
+        self.changed = threading.Condition()
+        # session id => [expiration time, ttl, held keys]
+        self.sessions = {}
+
+    def prefixed(self, prefix):
+        start = bisect.bisect_left(self.keys, prefix)
+        end = bisect.bisect_left(self.keys, prefix + '\xff')
+        return self.keys[start:end]
+
+    def prefix_index(self, prefix):
+        """
+        Index of latest change under prefix, deletions included
+
+        :param prefix:
+        :return:
+        """
+        index = 0
+        for key in self.prefixed(prefix):
+            index = max(index, self.values[key][1])
+
+        for key in self.tombstones:
+            if key.startswith(prefix):
+                index = max(index, self.tombstones[key])
+
+        return index or 1
+
+    def put(self, key, value):
+        with self.changed:
+            self.index += 1
+            if key not in self.values:
+                bisect.insort(self.keys, key)
+            self.values[key] = (value, self.index)
+            self.tombstones.pop(key, None)
+            self.changed.notify_all()
+
+    def delete(self, prefix, recurse=False):
+        with self.changed:
+            keys = self.prefixed(prefix) if recurse else [key for key in [prefix] if key in self.values]
+            if not keys:
+                return
+
+            self.index += 1
+            for key in keys:
+                del self.values[key]
+                self.tombstones[key] = self.index
+                self.keys.pop(bisect.bisect_left(self.keys, key))
+            self.changed.notify_all()
+
+    def create_session(self, ttl):
+        session = str(uuid.uuid4())
+        with self.changed:
+            self.sessions[session] = [time.time() + ttl, ttl, set()]
+
+        return session
+
+    def renew_session(self, session):
+        self.expire_sessions()
+        with self.changed:
+            if session not in self.sessions:
+                return False
+            self.sessions[session][0] = time.time() + self.sessions[session][1]
+
+        return True
+
+    def destroy_session(self, session):
+        with self.changed:
+            held = self.sessions.pop(session, [0, 0, set()])[2]
+
+        for key in held:
+            self.delete(key)
+
+    def expire_sessions(self):
+        with self.changed:
+            expired = [session for session in self.sessions if self.sessions[session][0] < time.time()]
+
+        for session in expired:
+            self.destroy_session(session)
+
+    def acquire(self, key, value, session):
+        with self.changed:
+            if session not in self.sessions:
+                return False
+
+            for other in self.sessions:
+                if other != session and key in self.sessions[other][2]:
+                    return False
+
+            self.sessions[session][2].add(key)
+            self.put(key, value)
+
+        return True
+
+    def wait(self, prefix, index, timeout):
+        deadline = time.time() + timeout
+        with self.changed:
+            while self.prefix_index(prefix) <= index and time.time() < deadline:
+                self.changed.wait(deadline - time.time())
+
+
+class KVHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, code, body, index=None):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if index is not None:
+            self.send_header('X-Consul-Index', str(index))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def parse(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        url = urlparse.urlparse(self.path)
+        key = url.path[len('/v1/kv/'):]
+        query = urlparse.parse_qs(url.query, keep_blank_values=True)
+
+        return key, query
+
+    def do_GET(self):
+        key, query = self.parse()
+        store = self.server.store
+        store.expire_sessions()
+
+        if 'index' in query and int(query['index'][0]):
+            store.wait(key, int(query['index'][0]), float(query.get('wait', ['300s'])[0].rstrip('s')))
+
+        with store.changed:
+            index = store.prefix_index(key)
+            if 'keys' in query:
+                keys = store.prefixed(key)
+                separator = query.get('separator', [''])[0]
+                if separator:
+                    collapsed = []
+                    for item in keys:
+                        position = item.find(separator, len(key))
+                        item = item if position < 0 else item[:position + 1]
+                        if not collapsed or collapsed[-1] != item:
+                            collapsed.append(item)
+                    keys = collapsed
+                items = None
+            elif 'recurse' in query:
+                keys = store.prefixed(key)
+                items = [(item, store.values[item]) for item in keys]
+            else:
+                keys = [key] if key in store.values else []
+                items = [(item, store.values[item]) for item in keys]
+
+        if not keys:
+            return self.reply(404, '', index)
+
+        if items is None:
+            return self.reply(200, json.dumps(keys), index)
+
+        return self.reply(200, json.dumps([{
+            'Key': item,
+            'Value': base64.b64encode(value) if value else None,
+            'ModifyIndex': modify_index,
+            'CreateIndex': modify_index,
+            'LockIndex': 0,
+            'Flags': 0
+        } for item, (value, modify_index) in items]), index)
+
+    def do_PUT(self):
+        if self.path.startswith('/v1/session/'):
+            return self.session()
+
+        key, query = self.parse()
+        value = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if 'acquire' in query:
+            acquired = self.server.store.acquire(key, value, query['acquire'][0])
+            return self.reply(200, 'true' if acquired else 'false', self.server.store.index)
+
+        self.server.store.put(key, value)
+
+        return self.reply(200, 'true', self.server.store.index)
+
+    def session(self):
+        store = self.server.store
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        parts = self.path.split('?')[0].split('/')[3:]
+        if parts == ['create']:
+            options = json.loads(body) if body else {}
+            return self.reply(200, json.dumps({'ID': store.create_session(float(options.get('TTL', '10s').rstrip('s')))}))
+
+        if len(parts) == 2 and parts[0] == 'renew':
+            if not store.renew_session(parts[1]):
+                return self.reply(404, 'Session id not found')
+            return self.reply(200, json.dumps([{'ID': parts[1]}]))
+
+        if len(parts) == 2 and parts[0] == 'destroy':
+            store.destroy_session(parts[1])
+            return self.reply(200, 'true')
+
+        return self.reply(404, '')
+
+    def do_DELETE(self):
+        key, query = self.parse()
+        self.server.store.delete(key, 'recurse' in query)
+
+        return self.reply(200, 'true', self.server.store.index)
+
+
+class ConsulServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, latency=0, host='127.0.0.1', port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), KVHandler)
+        self.store = KVStore()
+        self.latency = latency
+
+    def start(self):
+        serve_thread = threading.Thread(target=self.serve_forever, name='stub-consul')
+        serve_thread.daemon = True
+        serve_thread.start()
+
+        return self
+
+    @property
+    def address(self):
+        return '%s:%d' % self.server_address
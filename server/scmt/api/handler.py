@@ -1,31 +1,87 @@
 import SimpleHTTPServer
 import json
 import re
+import scmt.metrics
+import urlparse
+
+API_REQUESTS = scmt.metrics.histogram('scmt_api_request_seconds', 'API request latency', ('method',))
 
 
 class Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
     # client IP detected by headers or directly
     client_ip = '127.0.0.1'
     answer = False
-    methods = ['sign', 'key', 'cert']
+    methods = ['sign', 'key', 'cert', 'watch']
+    # keep connections alive, clients reuse them for next calls
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, with Nagle algorithm response waits for delayed ACK
+    disable_nagle_algorithm = True
+    # close idle kept alive connections
+    timeout = 60
 
     def json(self, data, code=200):
+        return self.raw(json.dumps(data), code)
+
+    def raw(self, body, code=200):
+        """
+        Send already serialized JSON response
+
+        :param body:
+        :param code:
+        :return:
+        """
         self.send_response(code)
         self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
 
-        self.wfile.write(json.dumps(data))
+        self.wfile.write(body)
 
     def log(self, msg):
         pass
 
     def error(self, code, error):
         self.log("[%s] Error: %s (%s)" % (self.client_address[0], str(code), error))
+        # request body could be left unread, connection can't be reused
+        self.close_connection = 1
         return self.json({'code': code, 'error': error}, code)
 
     def do_GET(self):
+        if self.path == '/metrics':
+            return self.metrics()
+
+        if self.path.split('?')[0] == '/traces':
+            return self.traces()
+
+        if self.path == '/ready':
+            readiness = self.server.manager.get_readiness()
+            return self.json(readiness, 200 if readiness['ready'] else 503)
+
         return self.json({'ok': 1})
 
+    def traces(self):
+        """
+        Dump slowest recent issues and issues running now
+
+        :return:
+        """
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        try:
+            limit = int(query.get('limit', [10])[0])
+        except ValueError:
+            return self.error(500, 'incorrect_limit')
+
+        return self.json(self.server.manager.get_traces(limit))
+
+    def metrics(self):
+        body = self.server.manager.render_metrics()
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        self.wfile.write(body)
+
     def get_client_ip(self):
         if 'X-Real-IP' in self.headers:
             ip = re.sub('/[^a-f0-9\.]/', '', self.headers['X-Real-IP'])
@@ -53,7 +109,8 @@ class Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
 
         req['ip'] = self.get_client_ip()
 
-        return getattr(self, req['type'] + '_call')(req)
+        with API_REQUESTS.time((req['type'],)):
+            return getattr(self, req['type'] + '_call')(req)
 
     def key_call(self, req):
         """
@@ -82,7 +139,34 @@ class Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
         if 'hostname' not in req:
             return self.json({'code': 500, 'error': 'no_hostname_specified'})
 
-        return self.json(self.server.manager.cert(req), 200)
+        return self.raw(self.server.manager.cert_response(req), 200)
+
+    def watch_call(self, req):
+        """
+        Long-poll request, blocks until certificate of any listed hostname is changed
+
+        :param req:
+        :return:
+        """
+        if 'hostnames' not in req or not isinstance(req['hostnames'], dict) or not req['hostnames']:
+            return self.json({'code': 500, 'error': 'no_hostnames_specified'})
+
+        if 'timeout' in req:
+            try:
+                req['timeout'] = float(req['timeout'])
+            except (TypeError, ValueError):
+                return self.error(400, 'incorrect_timeout')
+            # NaN is not comparable, so it is rejected too
+            if not req['timeout'] >= 0:
+                return self.error(400, 'incorrect_timeout')
+
+        if not self.server.watch_slots.acquire(False):
+            return self.error(503, 'too_many_watches')
+
+        try:
+            return self.json(self.server.manager.watch(req), 200)
+        finally:
+            self.server.watch_slots.release()
 
     def log_message(self, format, *args):
         pass
\ No newline at end of file
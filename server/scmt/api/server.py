@@ -1,12 +1,17 @@
 import BaseHTTPServer
 import socket
 import sys
+import threading
 from SocketServer import ThreadingMixIn
 
 
 class Server(ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # every watch holds request thread for up to Manager.watch_timeout, watches above this number are refused
+    max_watches = 1000
+
     def __init__(self, server_address, request_handler_class, bind_and_activate=True, manager=False):
         self.manager = manager
+        self.watch_slots = threading.Semaphore(self.max_watches)
         BaseHTTPServer.HTTPServer.__init__(self, server_address, request_handler_class, bind_and_activate)
 
     def finish(self, *args, **kw):
@@ -8,6 +8,7 @@ from server import Server as ApiServer
 import time
 import ssl
 import scmt.loggable
+from scmt.ca.scratch import Scratch
 
 class Service(threading.Thread, scmt.loggable.Loggable):
     def __init__(self, manager, port, ssl=None):
@@ -36,8 +37,14 @@ class Service(threading.Thread, scmt.loggable.Loggable):
             return False
 
         if self.ssl:
-            self.manager.get_key({'hostname': self.ssl, 'algo': 'RSA', 'bits': 2048})
-            key_path = self.manager.get_key_path(self.ssl)
+            while True:
+                try:
+                    self.manager.get_key({'hostname': self.ssl, 'algo': 'RSA', 'bits': 2048})
+                    break
+                except RuntimeError as e:
+                    # domain of API certificate could be still initializing
+                    self.log("Waiting for key of %s: %s" % (self.ssl, e.message))
+                    time.sleep(1)
 
             while True:
                 res = self.manager.cert({'hostname': self.ssl, 'ip': '127.0.0.1'})
@@ -48,9 +55,12 @@ class Service(threading.Thread, scmt.loggable.Loggable):
                 self.log("Certificate successfully received for %s" % self.ssl)
                 break
 
-            cert_path = self.manager.get_fullchain_path(self.ssl)
-            self.log("Key: %s, Cert: %s" % (key_path, cert_path))
-            http_service.socket = ssl.wrap_socket(http_service.socket, keyfile=key_path, certfile=cert_path, server_side=True)
+            # key and certificate are loaded by wrap_socket, files are removed right after
+            with Scratch() as scratch:
+                key_path = self.manager.get_key_path(self.ssl, scratch)
+                cert_path = self.manager.get_fullchain_path(self.ssl, scratch)
+                self.log("Key: %s, Cert: %s" % (key_path, cert_path))
+                http_service.socket = ssl.wrap_socket(http_service.socket, keyfile=key_path, certfile=cert_path, server_side=True)
 
         self.log("HTTP API server started")
         while self.is_running():
@@ -0,0 +1,61 @@
+import httplib
+import json
+import threading
+import unittest
+
+from handler import Handler
+from server import Server
+
+
+class BlockingManager:
+    def __init__(self):
+        self.release = threading.Event()
+        self.watching = threading.Event()
+
+    def watch(self, req):
+        self.watching.set()
+        self.release.wait(5)
+        return {'status': 'timeout', 'timeout': req.get('timeout')}
+
+
+class HandlerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.manager = BlockingManager()
+        Server.max_watches = 1
+        self.server = Server(('127.0.0.1', 0), Handler, manager=self.manager)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.manager.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+        Server.max_watches = 1000
+
+    def watch(self, timeout):
+        connection = httplib.HTTPConnection('127.0.0.1', self.server.server_address[1], timeout=5)
+        connection.request('POST', '/', json.dumps({'type': 'watch', 'hostnames': {'a.example.com': ''},
+                                                   'timeout': timeout}))
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+
+    def test_watch_timeout_and_limit(self):
+        self.assertEqual(self.watch('soon')[0], 400)
+        self.assertEqual(self.watch(-1)[0], 400)
+
+        results = []
+        first = threading.Thread(target=lambda: results.append(self.watch('30')))
+        first.start()
+        self.manager.watching.wait(5)
+        # only one watch could hold request thread
+        self.assertEqual(self.watch(30), (503, {'code': 503, 'error': 'too_many_watches'}))
+
+        self.manager.release.set()
+        first.join(5)
+        self.assertEqual(results, [(200, {'status': 'timeout', 'timeout': 30.0})])
+        self.assertEqual(self.watch(30)[0], 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
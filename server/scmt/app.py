@@ -1,8 +1,11 @@
 from config import ConfigReader
+from cluster import Membership
 from manager import Manager
+from shards import ShardRouter
 import api
 import storages.builder
 import loggable
+import tracing
 
 
 class App(loggable.Loggable):
@@ -13,8 +16,12 @@ class App(loggable.Loggable):
 
     def set_config(self, config):
         self.config = ConfigReader(config)
+        loggable.set_level(self.config.log_level)
 
     def start(self):
+        if self.config.processes > 1:
+            return self.start_sharded()
+
         self.log("Starting app. Initializing storage")
 
         storage_configs = self.config.get_storages()
@@ -23,14 +30,48 @@ class App(loggable.Loggable):
             storage = storage_configs[storage_name]
             storage_list[storage_name] = storages.builder.build(storage)
 
-        manager = Manager(self.config.dir, self.config.get_domains(), storage_list)
+        manager = Manager(self.config.dir, self.config.get_domains(), storage_list,
+                          issue_workers=self.config.issue_workers, cleanup_workers=self.config.cleanup_workers,
+                          membership=self.build_membership(storage_list, self.config.node),
+                          init_workers=self.config.init_workers)
+        if self.config.profile_interval:
+            tracing.Profiler(self.config.profile_interval).start()
+
         self.log("Starting manager service")
         manager.start()
         self.log("Starting API service")
         api_service = api.service.Service(manager, self.config.port, self.config.ssl)
         api_service.start()
 
+    def build_membership(self, storage_list, node):
+        """
+        Create membership of replica when hostnames are shared with other replicas
+
+        :param storage_list:
+        :param node: name of replica
+        :return: Membership or None
+        """
+        if not self.config.cluster_storage:
+            return None
+
+        if self.config.cluster_storage not in storage_list:
+            raise IndexError("Unknown cluster storage %s" % self.config.cluster_storage)
+
+        return Membership(storage_list[self.config.cluster_storage], node)
 
+    def start_sharded(self):
+        """
+        Run managers of domains in worker processes, API process only routes requests to them
+
+        :return:
+        """
+        self.log("Starting app with %d worker processes" % self.config.processes)
+        router = ShardRouter(self.config, self.config.processes)
+        router.start()
+
+        self.log("Starting API service")
+        api_service = api.service.Service(router, self.config.port, self.config.ssl)
+        api_service.start()
 
     @staticmethod
     def i():
@@ -0,0 +1,207 @@
+"""
+Minimal DER encoder and decoder, enough to read keys, certificates and CSRs and
+to build X.509 certificates
+"""
+import base64
+import binascii
+import calendar
+import re
+import textwrap
+import time
+
+INTEGER = 0x02
+BIT_STRING = 0x03
+OCTET_STRING = 0x04
+NULL = 0x05
+OID = 0x06
+UTC_TIME = 0x17
+GENERALIZED_TIME = 0x18
+SEQUENCE = 0x30
+SET = 0x31
+BOOLEAN = 0x01
+
+
+def tlv(tag, content):
+    length = len(content)
+    if length < 0x80:
+        return chr(tag) + chr(length) + content
+
+    encoded = ''
+    while length:
+        encoded = chr(length & 0xff) + encoded
+        length >>= 8
+
+    return chr(tag) + chr(0x80 | len(encoded)) + encoded + content
+
+
+def integer(value):
+    encoded = int_to_bytes(value)
+    if ord(encoded[0]) & 0x80:
+        encoded = '\x00' + encoded
+
+    return tlv(INTEGER, encoded)
+
+
+def int_to_bytes(value, size=None):
+    hex_value = '%x' % value
+    if len(hex_value) % 2:
+        hex_value = '0' + hex_value
+
+    encoded = binascii.unhexlify(hex_value)
+    if size:
+        encoded = '\x00' * (size - len(encoded)) + encoded
+
+    return encoded
+
+
+def bytes_to_int(data):
+    if not data:
+        return 0
+
+    return int(binascii.hexlify(data), 16)
+
+
+def sequence(*items):
+    return tlv(SEQUENCE, ''.join(items))
+
+
+def set_of(*items):
+    return tlv(SET, ''.join(sorted(items)))
+
+
+def oid(dotted):
+    parts = [int(part) for part in dotted.split('.')]
+    encoded = chr(parts[0] * 40 + parts[1])
+    for part in parts[2:]:
+        chunk = chr(part & 0x7f)
+        part >>= 7
+        while part:
+            chunk = chr(0x80 | (part & 0x7f)) + chunk
+            part >>= 7
+        encoded += chunk
+
+    return tlv(OID, encoded)
+
+
+def null():
+    return tlv(NULL, '')
+
+
+def boolean(value):
+    return tlv(BOOLEAN, '\xff' if value else '\x00')
+
+
+def bit_string(data, unused=0):
+    return tlv(BIT_STRING, chr(unused) + data)
+
+
+def octet_string(data):
+    return tlv(OCTET_STRING, data)
+
+
+def timestamp(value):
+    """
+    Encode time as UTCTime before 2050 and GeneralizedTime after, as required by RFC 5280
+
+    :param value: unix timestamp
+    :return:
+    """
+    value = time.gmtime(value)
+    if value.tm_year < 2050:
+        return tlv(UTC_TIME, time.strftime('%y%m%d%H%M%SZ', value))
+
+    return tlv(GENERALIZED_TIME, time.strftime('%Y%m%d%H%M%SZ', value))
+
+
+def read_timestamp(tag, content):
+    if tag == UTC_TIME:
+        year = int(content[0:2])
+        year += 1900 if year >= 50 else 2000
+        content = content[2:]
+    else:
+        year = int(content[0:4])
+        content = content[4:]
+
+    return calendar.timegm((year, int(content[0:2]), int(content[2:4]), int(content[4:6]),
+                            int(content[6:8]), int(content[8:10]), 0, 0, 0))
+
+
+def explicit(number, content):
+    return tlv(0xa0 | number, content)
+
+
+def implicit(number, content):
+    return tlv(0x80 | number, content)
+
+
+def decode(data):
+    """
+    Read one TLV from data
+
+    :param data:
+    :return: tuple of tag, content, raw TLV and rest of data
+    """
+    if len(data) < 2:
+        raise ValueError("Truncated DER data")
+
+    tag = ord(data[0])
+    length = ord(data[1])
+    offset = 2
+    if length & 0x80:
+        size = length & 0x7f
+        length = bytes_to_int(data[2:2 + size])
+        offset += size
+
+    if offset + length > len(data):
+        raise ValueError("Truncated DER data")
+
+    return tag, data[offset:offset + length], data[:offset + length], data[offset + length:]
+
+
+def decode_all(data):
+    """
+    Read all TLVs from content of constructed value
+
+    :param data:
+    :return: list of tuples tag, content, raw TLV
+    """
+    items = []
+    while data:
+        tag, content, raw, data = decode(data)
+        items.append((tag, content, raw))
+
+    return items
+
+
+def read_oid(content):
+    parts = [ord(content[0]) // 40, ord(content[0]) % 40]
+    value = 0
+    for char in content[1:]:
+        value = (value << 7) | (ord(char) & 0x7f)
+        if not ord(char) & 0x80:
+            parts.append(value)
+            value = 0
+
+    return '.'.join([str(part) for part in parts])
+
+
+def pem_decode(pem):
+    """
+    Get DER data and label from PEM
+
+    :param pem:
+    :return: tuple of label and DER data
+    """
+    match = re.search(r'-----BEGIN ([A-Z0-9 ]+)-----(.*?)-----END \1-----', pem, re.DOTALL)
+    if not match:
+        raise ValueError("No PEM data found")
+
+    if 'Proc-Type' in match.group(2):
+        raise ValueError("Encrypted PEM is not supported")
+
+    return match.group(1), base64.b64decode(''.join(match.group(2).split()))
+
+
+def pem_encode(der, label='CERTIFICATE'):
+    encoded = "\n".join(textwrap.wrap(base64.b64encode(der), 64))
+    return "-----BEGIN %s-----\n%s\n-----END %s-----\n" % (label, encoded, label)
@@ -1,24 +1,26 @@
 import os
 import subprocess
-import base64
-import textwrap
-import datetime
-import time
-import threading
-import shutil
 import re
-import random
+import hashlib
+import calendar
 
-try:
-    from urllib.request import urlopen # Python 3
-except ImportError:
-    from urllib2 import urlopen # Python 2
+import certinfo
+import scmt.clock
+import scmt.loggable
+import scmt.metrics
+import scmt.tracing
+from chaincache import ChainCache
+from scratch import Scratch, cleanup_stale, default_base
 
 
-class BaseCA:
+class BaseCA(scmt.loggable.Loggable):
+    # issuer certificates shared by all CAs
+    issuers = ChainCache()
+    # scratch directories already checked for leftovers
+    _checked_scratch = set()
+
     def __init__(self, domain, options, storage):
         self._domain = domain
-        self._fs_lock = threading.Lock()
 
         if 'dir' in options:
             self._dir = options['dir']
@@ -27,43 +29,75 @@ class BaseCA:
         else:
             self._certificate_expiration = 86400 * 14
 
+        # base directory of scratch spaces, tmpfs by default
         if 'tmp' in options:
             self.tmp_dir = options['tmp']
         else:
-            self.tmp_dir = '/tmp/scmt'
+            self.tmp_dir = default_base()
 
         if not os.path.isdir(self.tmp_dir):
             self.log("Creating tmp dir %s" % self.tmp_dir)
-            os.mkdir(self.tmp_dir)
+            os.makedirs(self.tmp_dir, 0700)
+        elif self.tmp_dir not in self._checked_scratch:
+            removed = cleanup_stale(self.tmp_dir)
+            if removed:
+                self.log("Removed %d stale scratch directories from %s" % (removed, self.tmp_dir))
+        self._checked_scratch.add(self.tmp_dir)
 
         if 'request_cleanup' in options:
             self._request_cleanup = int(options['request_cleanup'])
         else:
             self._request_cleanup = 2592000
 
+        if 'request_interval' in options:
+            self._request_interval = int(options['request_interval'])
+        else:
+            self._request_interval = 3600
+        # hostname/ip => time of last written request, entries older than request_interval are pruned
+        self._registered = {}
+        self._registered_pruned = 0
+
+        # how soon should host be checked again when certificate is missing or being renewed
+        if 'recheck_interval' in options:
+            self._recheck_interval = int(options['recheck_interval'])
+        else:
+            self._recheck_interval = 3600
+
+        if 'issuers' in options:
+            self.issuers.load_bundle(options['issuers'])
+
         self._storage = storage
+        self._listeners = []
+        # CA type used in metrics labels
+        self._ca_name = self.__class__.__name__.lower()
+        self._renewer = None
+        self.clock = scmt.clock.DEFAULT
 
-    def get_temp_path(self):
-        chunk = str(int(time.time() / 30))
-        path = str(random.random()) + str(time.time())
-        chunk_dir = self.tmp_dir + '/' + chunk
+    def scratch(self):
+        """
+        Allocate private scratch directory for one operation, release it when done
 
-        with self._fs_lock:
-            if not os.path.isdir(chunk_dir):
-                os.mkdir(chunk_dir)
-                self._cleanup_temp_path()
+        :return:
+        """
+        return Scratch(self.tmp_dir)
+
+    def openssl(self, command, data=None):
+        """
+        Run openssl passing data through stdin
 
-        return chunk_dir + '/' + path
+        :param command: openssl arguments
+        :param data: stdin of openssl
+        :return: stdout of openssl
+        """
+        with scmt.metrics.OPENSSL.time((command[0],)):
+            cmd = subprocess.Popen(['openssl'] + command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+            output, error = cmd.communicate(data)
 
-    def _cleanup_temp_path(self):
-        allowed_chunks = [str(int(time.time() / 30)), str(int(time.time() / 30) - 1)]
-        for chunk in os.listdir(self.tmp_dir + '/'):
-            if chunk not in allowed_chunks:
-                shutil.rmtree(self.tmp_dir + '/' + chunk)
+        if cmd.returncode != 0:
+            raise RuntimeError("openssl %s exited with %d: %s" % (command[0], cmd.returncode, error.strip()))
 
-    def log(self, msg, level='info'):
-        thread_name = threading.currentThread().name
-        print(time.strftime('%Y/%m/%d %R ', time.localtime()) + '[' + thread_name + '] [' + level + '] ' + msg.strip())
+        return output
 
     def generate_key(self, hostname, algo, bits):
         """
@@ -76,60 +110,45 @@ class BaseCA:
         """
 
         path = self._domain + '/' + hostname + '/key.pem'
-        key_tmp_path = self.get_temp_path()
-
         if self._storage.exists(path):
             return self._storage.read(path)
 
-        self.log("Generating new key in %s, algo: %s, temp-file: %s" % (path, algo, key_tmp_path))
+        self.log("Generating new key in %s, algo: %s" % (path, algo))
         if algo == 'RSA':
-            generate_cmd = ['openssl', 'genrsa', '-out', key_tmp_path, str(bits)]
+            generate_cmd = ['genrsa', str(bits)]
         elif algo == 'EC-SECP384R1':
-            generate_cmd = ['openssl', 'ecparam', '-name', 'secp384r1', '-genkey', '-out', key_tmp_path, '-noout']
-
-        cmd = subprocess.Popen(generate_cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        res = cmd.wait()
-        if res != 0:
-            raise RuntimeError("Failed to generate host key, host: %s" % hostname)
+            generate_cmd = ['ecparam', '-name', 'secp384r1', '-genkey', '-noout']
+        else:
+            raise RuntimeError("Unsupported key algorithm %s" % algo)
 
-        with open(key_tmp_path, 'r') as old_key:
-            key = old_key.read()
+        with self.phase('key', algo=algo):
+            try:
+                key = self.openssl(generate_cmd)
+            except RuntimeError as e:
+                raise RuntimeError("Failed to generate host key, host: %s, %s" % (hostname, e.message))
 
         self._storage.write(path, key)
-        os.unlink(key_tmp_path)
 
         return key
 
-    def get_key_path(self, hostname):
-        return self.copy_to_fs(self.get_key_url(hostname))
+    def read_key(self, hostname):
+        return self._storage.read(self.get_key_url(hostname))
 
-    def get_fullchain_path(self, hostname):
-        return self.copy_to_fs(self.get_fullchain_url(hostname))
+    def get_key_path(self, hostname, scratch):
+        return self.copy_to_fs(self.get_key_url(hostname), scratch)
 
-    def get_csr_path(self, hostname):
-        return self.copy_to_fs(self.get_csr_url(hostname))
+    def get_fullchain_path(self, hostname, scratch):
+        return self.copy_to_fs(self.get_fullchain_url(hostname), scratch)
 
-    def copy_to_fs(self, path):
+    def copy_to_fs(self, path, scratch):
         """
-        Copy data from storage to temp file
+        Copy data from storage to file in scratch directory
 
         :param path:
-        :return:
+        :param scratch: file lives until scratch is released
+        :return: path of file
         """
-        temp_path = self.get_temp_path()
-        with open(temp_path, 'w') as out:
-            out.write(self._storage.read(path))
-
-        return temp_path
-
-    def copy_to_storage(self, temp_path, path, delete=True):
-        with open(temp_path, 'r') as src:
-            data = src.read()
-
-            self._storage.write(path, data)
-
-        if delete:
-            os.unlink(temp_path)
+        return scratch.write(path.split('/')[-1], self._storage.read(path))
 
     def certificate_exists(self, hostname, ip=None):
         #if ip:
@@ -167,8 +186,21 @@ class BaseCA:
         of old and unused hosts
         """
         ip = re.sub('[^0-9a-zA-Z]', '_', ip)
-        self.log("Request for %s IP: %s registered" % (hostname, ip))
-        self._storage.write(self.get_request_url(hostname, ip), str(time.time()))
+        # request time is only needed with precision of request_cleanup, skip frequent writes
+        key = hostname + '/' + ip
+        now = self.clock.time()
+        if self._registered.get(key, 0) > now - self._request_interval:
+            return
+
+        self._registered[key] = now
+        self.log("Request registered", level='debug', sample=100, hostname=hostname, ip=ip)
+        self._storage.write(self.get_request_url(hostname, ip), str(now))
+
+        if self._registered_pruned < now - self._request_interval:
+            self._registered_pruned = now
+            for registered in self._registered.keys():
+                if self._registered.get(registered, now) <= now - self._request_interval:
+                    self._registered.pop(registered, None)
 
     def have_requests(self, hostname):
         requests_dir = self._domain + '/' + hostname + '/requests'
@@ -184,23 +216,31 @@ class BaseCA:
         Cleanup host requests history, removes expired requests logs
 
         :param hostname:
-        :return:
+        :return: timestamp of oldest remaining request or None
         """
         requests_path = self._domain + '/' + hostname + '/requests'
         try:
             requests_hosts = self._storage.list(requests_path)
         except IndexError:
-            return True
+            return None
 
+        now = self.clock.time()
+        oldest = None
         for ip in requests_hosts:
             try:
                 timestamp = float(self._storage.read(requests_path + '/' + ip))
             except IndexError:
                 continue
 
-            if timestamp < time.time() - self._request_cleanup:
+            if timestamp < now - self._request_cleanup:
                 self._storage.delete(requests_path + '/' + ip)
-                self.log("No requests for %s from IP %s for %d days" % (hostname, ip, (time.time() - timestamp) / 86400))
+                self.log("No requests for %s from IP %s for %d days" % (hostname, ip, (now - timestamp) / 86400))
+                continue
+
+            if oldest is None or timestamp < oldest:
+                oldest = timestamp
+
+        return oldest
 
     def get_full_chain(self, hostname, force_reload=False):
         """
@@ -211,7 +251,8 @@ class BaseCA:
             return self._storage.read(self.get_fullchain_url(hostname))
 
         self.log("Loading certificate chain for %s" % hostname)
-        chain = (self.build_chain(self.get_cert(hostname)))
+        with self.phase('chain'):
+            chain = (self.build_chain(self.get_cert(hostname)))
 
         self._storage.write(self.get_fullchain_url(hostname), chain)
         self.log("Full-chain saved to %s" % self.get_fullchain_url(hostname))
@@ -223,21 +264,37 @@ class BaseCA:
         if not info:
             return ''
 
-        if not info['CaIssuer']:
-            self.log("Final cert: %s" % info['Subject'])
-            return crt
+        chain = crt
+        subject = info['Subject']
+        # fingerprints of certificates in chain, issuers pointing to each other must not loop forever
+        visited = set([info['Fingerprint']])
+        while info['CaIssuer'] or info['AuthorityKeyId']:
+            if info['AuthorityKeyId'] and info['AuthorityKeyId'] == info['SubjectKeyId']:
+                break
 
-        self.log("Loading parent cert for %s, url: %s" % (info['Subject'], info['CaIssuer']))
-        parent_cert_body = urlopen(info['CaIssuer']).read()
+            self.log("Loading parent cert for %s, url: %s" % (info['Subject'], info['CaIssuer']))
+            parent = self.issuers.get_issuer(info, self._storage, visited)
+            if parent is None:
+                if info['CaIssuer']:
+                    raise IOError("Failed to load issuer of %s from %s" % (info['Subject'], info['CaIssuer']))
+                break
 
-        return crt + self.build_chain(self.convert2pem(parent_cert_body))
+            if parent[1]['Fingerprint'] in visited:
+                self.log("Issuer %s is already in chain, stopping" % parent[1]['Subject'], level='warning')
+                break
 
-    def convert2pem(self, crt):
-        if crt[:27] == '-----BEGIN CERTIFICATE-----':
-            return crt
+            if len(visited) > self.issuers.max_depth:
+                raise IOError("Chain of %s is longer than %d certificates" % (subject, self.issuers.max_depth))
+
+            crt, info = parent
+            visited.add(info['Fingerprint'])
+            chain += crt
 
-        encoded = "\n".join(textwrap.wrap(base64.b64encode(crt)))
-        return """-----BEGIN CERTIFICATE-----\n%s\n-----END CERTIFICATE-----\n""" % encoded
+        self.log("Final cert: %s" % info['Subject'])
+        return chain
+
+    def convert2pem(self, crt):
+        return certinfo.convert2pem(crt)
 
     def get_cert_info(self, crt):
         """
@@ -246,38 +303,7 @@ class BaseCA:
         :param crt:
         :return:
         """
-        run = ["openssl", "x509", "-text", "-noout"]
-        cmd = subprocess.Popen(run, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.PIPE)
-        response = cmd.communicate(crt)
-
-        lines = response[0].split("\n")
-        res = None
-        while True:
-            res = cmd.poll()
-            if res is not None:
-                break
-
-        if res != 0:
-            return None
-
-        info = {
-            'NotBefore': False,
-            'NotAfter': False,
-            'CaIssuer': '',
-            'Subject': ''
-        }
-        for x in range(0, len(lines) - 1):
-            line = lines[x].strip()
-            if line[:12] == 'CA Issuers -':
-                info['CaIssuer'] = line[12:].replace('URI:', '').strip()
-            elif line[:11] == 'Not Before:':
-                info['NotBefore'] = datetime.datetime.strptime(line[12:].strip(), "%b %d %H:%M:%S %Y %Z")
-            elif line[:11] == 'Not After :':
-                info['NotAfter'] = datetime.datetime.strptime(line[12:].strip(), "%b %d %H:%M:%S %Y %Z")
-            elif line[:8] == 'Subject:':
-                info['Subject'] = line[8:].strip()
-
-        return info
+        return certinfo.read(crt)
 
     def get_csr(self, hostname):
         """
@@ -289,24 +315,20 @@ class BaseCA:
         if self._storage.exists(self.get_csr_url(hostname)):
             return self._storage.read(self.get_csr_url(hostname))
 
-        csr_temp_path = self.get_temp_path()
-        key_temp_path = self.copy_to_fs(self.get_key_url(hostname))
-
-        self.log("Generating new CSR request for %s, output %s" % (hostname, csr_temp_path))
-        generate_command = ["openssl", "req", "-key", key_temp_path, "-new", "-out", csr_temp_path, "-subj", "/CN=" + self.get_cert_subject(hostname)]
-        self.log("Running: %s" % " ".join(generate_command))
-
-        cmd = subprocess.Popen(generate_command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        exit_code = cmd.wait()
+        self.log("Generating new CSR request for %s" % hostname)
+        key = self._storage.read(self.get_key_url(hostname))
+        # key is passed through pipe and never written to disk
+        generate_command = ["req", "-new", "-key", "/dev/stdin", "-subj", "/CN=" + self.get_cert_subject(hostname)]
 
-        result = cmd.stdout.readlines()
-
-        if exit_code != 0:
-            raise RuntimeError("Failed to create certificate request. Exited: %d. Reply: %s" % (exit_code, result))
+        with self.phase('csr'):
+            try:
+                csr = self.openssl(generate_command, key)
+            except RuntimeError as e:
+                raise RuntimeError("Failed to create certificate request. %s" % e.message)
 
-        self.copy_to_storage(csr_temp_path, self.get_csr_url(hostname))
+        self._storage.write(self.get_csr_url(hostname), csr)
 
-        return self._storage.read(self.get_csr_url(hostname))
+        return csr
 
     def get_cert_subject(self, hostname):
         """
@@ -317,45 +339,77 @@ class BaseCA:
         """
         return "/CN=" + hostname
 
-    def cleanup_certificates(self):
+    def cleanup_host(self, hostname):
         """
-        Remove old and unused certificates, update expired certificates
+        Remove unused host certificate or renew it if it's going to expire
 
-        :return:
+        :param hostname:
+        :return: time when host should be checked again, None if host was removed
         """
+        oldest_request = self.cleanup_requests(hostname)
 
-        self.log("Running clean-up for %s" % self._domain)
-        try:
-            hostnames = self._storage.list(self._domain)
-        except IndexError:
-            return True
+        if oldest_request is None:
+            self.log("Certificates for %s is not needed anymore, deleting it" % hostname)
+            self._storage.delete(self._domain + '/' + hostname)
+            return None
 
-        self.log("Total number of domains: %d" % len(hostnames))
-        for hostname in hostnames:
-            self.cleanup_requests(hostname)
-            requests = self.have_requests(hostname)
+        # host becomes unused when its last request expires
+        request_expire = oldest_request + self._request_cleanup
 
-            if not self.have_requests(hostname):
-                self.log("Certificates for %s is not needed anymore, deleting it" % hostname)
-                self._storage.delete(self._domain + '/' + hostname)
+        cert = self.get_cert(hostname)
+        if not cert:
+            return min(request_expire, self.clock.time() + self._recheck_interval)
 
-            cert = self.get_cert(hostname)
-            if not cert:
-                continue
+        info = self.get_cert_info(cert)
+        if not info or not info['NotAfter']:
+            self.log("Failed to read certificate info for %s" % hostname)
+            return min(request_expire, self.clock.time() + self._recheck_interval)
+
+        renew_at = calendar.timegm(info['NotAfter'].timetuple()) - self._certificate_expiration
+        self.log("Certificate expiration time", level='debug', hostname=hostname, expire=info['NotAfter'])
+        if renew_at > self.clock.time():
+            return min(request_expire, renew_at)
+
+        self.log("Certificate for %s need to be renewed" % hostname)
+        if self._renewer:
+            self._renewer(hostname)
+        else:
+            try:
+                self.issue_certificate(hostname, force=True)
+            except RuntimeError:
+                self.log("Failed to issue new certificate for %s" % hostname)
+
+        return min(request_expire, self.clock.time() + self._recheck_interval)
+
+    def phase(self, name, **attrs):
+        """
+        Trace issue phase and observe its duration in metrics
 
-            info = self.get_cert_info(cert)
+        :param name:
+        :param attrs:
+        :return:
+        """
+        return scmt.tracing.timed(name, scmt.metrics.ISSUE_PHASE, (self._ca_name, name), **attrs)
 
-            self.log("%s expiration time %s, requests: %d" % (hostname, info['NotAfter'].strftime('%Y/%m/%d'), requests), level='debug')
-            if int(info['NotAfter'].strftime('%s')) - time.time() < self._certificate_expiration:
-                self.log("Certificate for %s need to be renewed" % hostname)
-                try:
-                    self.issue_certificate(hostname, force=True)
-                except RuntimeError:
-                    self.log("Failed to issue new certificate for %s" % hostname)
+    def set_clock(self, clock):
+        """
+        Set time source used for renewals, requests expiration and polling
 
-        self.log("Clean-up for %s finished." % self._domain)
+        :param clock:
+        :return:
+        """
+        self.clock = clock
 
-    def issue_certificate(self, hostname):
+    def set_renewer(self, renewer):
+        """
+        Set callback used to schedule renewals instead of issuing them during clean-up
+
+        :param renewer:
+        :return:
+        """
+        self._renewer = renewer
+
+    def issue_certificate(self, hostname, force=False):
         """
         This method should be redefined in child classes and will issue certificate for real
 
@@ -364,6 +418,30 @@ class BaseCA:
         """
         pass
 
+    def get_fingerprint(self, hostname):
+        """
+        Get SHA256 fingerprint of host full-chain, used by clients to detect changes
+
+        :param hostname:
+        :return: hex digest or None when certificate is not issued yet
+        """
+        try:
+            return hashlib.sha256(self._storage.read(self.get_fullchain_url(hostname))).hexdigest()
+        except IndexError:
+            return None
+
+    def certificate_issued(self, hostname):
+        """
+        Should be called by child classes when new certificate is saved
+
+        :param hostname:
+        :return:
+        """
+        for listener in self._listeners:
+            listener(hostname)
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
 
     def set_hook(self, hook):
         self._hook = hook
\ No newline at end of file
@@ -0,0 +1,92 @@
+import base64
+import datetime
+import hashlib
+import subprocess
+import textwrap
+import scmt.metrics
+
+
+def read(crt):
+    """
+    Read info from PEM encoded certificate
+
+    :param crt:
+    :return: dict with certificate info or None when certificate is invalid
+    """
+    run = ["openssl", "x509", "-text", "-noout"]
+    with scmt.metrics.OPENSSL.time(('x509',)):
+        cmd = subprocess.Popen(run, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.PIPE)
+        response = cmd.communicate(crt)
+
+    if cmd.returncode != 0:
+        return None
+
+    lines = response[0].split("\n")
+    info = {
+        'NotBefore': False,
+        'NotAfter': False,
+        'CaIssuer': '',
+        'Subject': '',
+        'Issuer': '',
+        'Fingerprint': fingerprint(crt),
+        'SubjectKeyId': '',
+        'AuthorityKeyId': ''
+    }
+    for x in range(0, len(lines) - 1):
+        line = lines[x].strip()
+        if line[:12] == 'CA Issuers -':
+            info['CaIssuer'] = line[12:].replace('URI:', '').strip()
+        elif line[:11] == 'Not Before:':
+            info['NotBefore'] = datetime.datetime.strptime(line[12:].strip(), "%b %d %H:%M:%S %Y %Z")
+        elif line[:11] == 'Not After :':
+            info['NotAfter'] = datetime.datetime.strptime(line[12:].strip(), "%b %d %H:%M:%S %Y %Z")
+        elif line[:8] == 'Subject:':
+            info['Subject'] = line[8:].strip()
+        elif line[:7] == 'Issuer:':
+            info['Issuer'] = line[7:].strip()
+        elif line[:29] == 'X509v3 Subject Key Identifier':
+            info['SubjectKeyId'] = key_id(lines[x + 1])
+        elif line[:31] == 'X509v3 Authority Key Identifier':
+            info['AuthorityKeyId'] = key_id(lines[x + 1])
+
+    return info
+
+
+def key_id(line):
+    """
+    Normalize key identifier, old openssl versions prefix it with keyid:
+
+    :param line:
+    :return:
+    """
+    return line.strip().replace('keyid:', '').replace(':', '').upper()
+
+
+def fingerprint(crt):
+    """
+    SHA-256 of DER encoded certificate, same for any wrapping of PEM
+
+    :param crt: PEM encoded certificate
+    :return:
+    """
+    body = crt.replace('-----BEGIN CERTIFICATE-----', '').replace('-----END CERTIFICATE-----', '')
+    return hashlib.sha256(base64.b64decode(''.join(body.split()))).hexdigest()
+
+
+def convert2pem(crt):
+    if crt[:27] == '-----BEGIN CERTIFICATE-----':
+        return crt
+
+    encoded = "\n".join(textwrap.wrap(base64.b64encode(crt)))
+    return """-----BEGIN CERTIFICATE-----\n%s\n-----END CERTIFICATE-----\n""" % encoded
+
+
+def split(bundle):
+    """
+    Split PEM bundle to list of certificates
+
+    :param bundle:
+    :return:
+    """
+    end = '-----END CERTIFICATE-----'
+    return [part.strip() + '\n' + end + '\n' for part in bundle.split(end)[:-1] if part.strip()]
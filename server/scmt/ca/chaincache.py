@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import scmt.loggable
+import certinfo
+import scmt.metrics
+import scmt.tracing
+
+try:
+    from urllib.request import urlopen # Python 3
+except ImportError:
+    from urllib2 import urlopen # Python 2
+
+
+class ChainCache(scmt.loggable.Loggable):
+    """
+    Issuer certificates used to build full chains. Certificates are kept by
+    fingerprint and indexed by subject key ID and by CA Issuers URL they were
+    loaded from, so cross-signed issuers sharing key ID don't replace each other.
+    Certificates are kept in memory and in storage, so chains are assembled
+    without network requests. Certificates from bundle are trusted forever,
+    downloaded ones are refreshed after TTL.
+    """
+    # storage path for downloaded issuers
+    storage_path = '_scmt/issuers'
+    # for how long should downloaded issuer be used without refresh
+    ttl = 86400 * 7
+    # timeout of issuer download
+    fetch_timeout = 10
+    # longest chain built, guards against issuers pointing to each other
+    max_depth = 10
+
+    def __init__(self):
+        # fingerprint => (cert, info)
+        self._certs = {}
+        # subject key ID => list of fingerprints
+        self._keys = {}
+        # CA Issuers URL => {'fingerprint': ..., 'fetched': ...}
+        self._urls = {}
+        self._lock = threading.Lock()
+
+    def load_bundle(self, path):
+        """
+        Load trusted issuers from PEM file or directory with PEM files
+
+        :param path:
+        :return: number of loaded certificates
+        """
+        if os.path.isdir(path):
+            files = [path + '/' + name for name in sorted(os.listdir(path))]
+        else:
+            files = [path]
+
+        loaded = 0
+        for file_path in files:
+            with open(file_path, 'r') as bundle:
+                for crt in certinfo.split(bundle.read()):
+                    if self.add(crt):
+                        loaded += 1
+
+        self.log("Loaded %d issuer certificates from %s" % (loaded, path))
+        return loaded
+
+    def add(self, crt, url=None, fetched=None):
+        """
+        Add issuer certificate to memory cache
+
+        :param crt: PEM encoded certificate
+        :param url: URL certificate was downloaded from
+        :param fetched: download time
+        :return: fingerprint or None when certificate is invalid
+        """
+        info = certinfo.read(crt)
+        if not info:
+            return None
+
+        fingerprint = info['Fingerprint']
+        with self._lock:
+            self._certs[fingerprint] = (crt, info)
+            if info['SubjectKeyId']:
+                fingerprints = self._keys.setdefault(info['SubjectKeyId'], [])
+                if fingerprint not in fingerprints:
+                    fingerprints.append(fingerprint)
+            if url:
+                self._urls[url] = {'fingerprint': fingerprint, 'fetched': fetched or time.time()}
+
+        return fingerprint
+
+    def get_issuer(self, info, storage=None, exclude=()):
+        """
+        Find issuer certificate of certificate
+
+        :param info: certificate info
+        :param storage: storage used to share downloaded issuers
+        :param exclude: fingerprints of certificates already in chain
+        :return: tuple of PEM encoded issuer and its info or None
+        """
+        url = info['CaIssuer']
+        with self._lock:
+            known = self._urls.get(url)
+            fresh = known and known['fetched'] > time.time() - self.ttl and known['fingerprint'] in self._certs
+
+            candidates = [fingerprint for fingerprint in self._keys.get(info['AuthorityKeyId'], [])
+                          if fingerprint not in exclude and self._certs[fingerprint][1]['Subject'] == info['Issuer']]
+            if candidates:
+                scmt.metrics.CACHE.inc(('issuers', 'hit'))
+                # cross-signed issuers share key ID, the one from CA Issuers URL is preferred
+                if fresh and known['fingerprint'] in candidates:
+                    return self._certs[known['fingerprint']]
+                return self._certs[max(candidates, key=lambda fingerprint: self._certs[fingerprint][1]['NotAfter'])]
+
+            if fresh:
+                scmt.metrics.CACHE.inc(('issuers', 'hit'))
+                return self._certs[known['fingerprint']]
+
+        if not url:
+            return None
+
+        if storage is not None and not known:
+            known = self._read(url, storage)
+            if known and known['fetched'] > time.time() - self.ttl:
+                scmt.metrics.CACHE.inc(('issuers', 'storage'))
+                return self._certs[known['fingerprint']]
+
+        scmt.metrics.CACHE.inc(('issuers', 'miss'))
+        try:
+            with scmt.tracing.span('issuer.fetch', url=url):
+                crt = certinfo.convert2pem(urlopen(url, timeout=self.fetch_timeout).read())
+        except IOError as e:
+            self.log("Failed to download issuer from %s: %s" % (url, str(e)))
+            # expired copy is better than nothing
+            if known and known['fingerprint'] in self._certs:
+                return self._certs[known['fingerprint']]
+            return None
+
+        fingerprint = self.add(crt, url)
+        if not fingerprint:
+            return None
+
+        if storage is not None:
+            storage.write(self.get_url_path(url), json.dumps({'url': url, 'fingerprint': fingerprint,
+                                                              'fetched': time.time()}))
+            storage.write(self.storage_path + '/certs/' + fingerprint, crt)
+
+        return self._certs[fingerprint]
+
+    def _read(self, url, storage):
+        try:
+            known = json.loads(storage.read(self.get_url_path(url)))
+            # issuers saved by older versions are stored by subject key ID
+            crt = storage.read(self.storage_path + '/certs/' + known.get('fingerprint', known.get('ski')))
+        except (IndexError, IOError, ValueError, KeyError, TypeError):
+            return None
+
+        if not self.add(crt, url, known['fetched']):
+            return None
+
+        return self._urls[url]
+
+    def get_url_path(self, url):
+        return self.storage_path + '/urls/' + hashlib.sha256(url).hexdigest()
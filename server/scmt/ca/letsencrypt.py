@@ -3,11 +3,14 @@ import subprocess
 import os
 import base64
 import binascii
-import time
 import hashlib
 import re
 import copy
+import threading
+import asn1
 from baseca import BaseCA
+import scmt.metrics
+import scmt.tracing
 try:
     from urllib.request import urlopen # Python 3
 except ImportError:
@@ -16,6 +19,9 @@ except ImportError:
 
 class LetsEncrypt(BaseCA):
     account_key_size = 4096
+    # (CA, account key) => lock, zones with same account register it only once
+    _accounts = {}
+    _accountsLock = threading.Lock()
     # for how long should we sleep when challenge is not ready
     _challenge_sleep = 20
     # challenge total timeout, after this time we consider that LetsEncrypt is down now and try
@@ -43,14 +49,19 @@ class LetsEncrypt(BaseCA):
 
         self._challenge = None
 
-        if os.path.exists(self.account_key):
-            self.log("LetsEncrypt initialized. Account key (%s) exists. CA %s" % (self.account_key, self.ca))
-            return
+        # zones are initialized in parallel, account could be registered by other zone right now
+        with LetsEncrypt._accountsLock:
+            account_lock = LetsEncrypt._accounts.setdefault((self.ca, self.account_key), threading.Lock())
 
-        code, result = self.register()
-        if code != 201:
-            self.log("Failed to register new LetsEncrypt account. Reply: %s" % str(result))
-            raise RuntimeError("Failed to register LetsEncrypt account")
+        with account_lock:
+            if os.path.exists(self.account_key):
+                self.log("LetsEncrypt initialized. Account key (%s) exists. CA %s" % (self.account_key, self.ca))
+                return
+
+            code, result = self.register()
+            if code != 201:
+                self.log("Failed to register new LetsEncrypt account. Reply: %s" % str(result))
+                raise RuntimeError("Failed to register LetsEncrypt account")
 
     def issue_certificate(self, hostname, force=False):
         if not force and self._storage.exists(self.get_fullchain_url(hostname)):
@@ -63,6 +74,7 @@ class LetsEncrypt(BaseCA):
         self.log("Generated certificate for %s, saved to %s" % (hostname, self.get_crt_url(hostname)))
 
         self.get_full_chain(hostname, force_reload=True)
+        self.certificate_issued(hostname)
 
     def get_account_key(self):
         """
@@ -74,8 +86,9 @@ class LetsEncrypt(BaseCA):
             return self.account_key
 
         generate_cmd = ['openssl', 'genrsa', '-out', self.account_key, str(self.account_key_size)]
-        cmd = subprocess.Popen(generate_cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        res = cmd.wait()
+        with scmt.metrics.OPENSSL.time(('genrsa',)):
+            cmd = subprocess.Popen(generate_cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            res = cmd.wait()
         self.log("Generating key size %d, path: %s" % (self.account_key_size, self.account_key))
         if res != 0:
             raise RuntimeError("Failed to generate account key, path: %s" % self.account_key)
@@ -86,9 +99,9 @@ class LetsEncrypt(BaseCA):
         return base64.urlsafe_b64encode(b).decode('utf8').replace("=", "")
 
     def _jwk(self):
-        proc = subprocess.Popen(["openssl", "rsa", "-in", self.get_account_key(), "-noout", "-text"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-
-        out, err = proc.communicate()
+        with scmt.metrics.OPENSSL.time(('rsa',)):
+            proc = subprocess.Popen(["openssl", "rsa", "-in", self.get_account_key(), "-noout", "-text"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            out, err = proc.communicate()
         if proc.returncode != 0:
             raise IOError("OpenSSL Error: {0}".format(err))
 
@@ -114,20 +127,21 @@ class LetsEncrypt(BaseCA):
         protected["nonce"] = urlopen(self.ca + "/directory", timeout=10).headers['Replay-Nonce']
 
         protected64 = self._b64(json.dumps(protected).encode('utf8'))
-        proc = subprocess.Popen(["openssl", "dgst", "-sha256", "-sign", self.get_account_key()], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-        out, err = proc.communicate("{0}.{1}".format(protected64, payload64).encode('utf8'))
+        with scmt.metrics.OPENSSL.time(('dgst',)):
+            proc = subprocess.Popen(["openssl", "dgst", "-sha256", "-sign", self.get_account_key()], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, err = proc.communicate("{0}.{1}".format(protected64, payload64).encode('utf8'))
         if proc.returncode != 0:
             raise IOError("OpenSSL Error: {0}".format(err))
         data = json.dumps({
             "header": header, "protected": protected64,
             "payload": payload64, "signature": self._b64(out),
         })
-        try:
-            resp = urlopen(url, data.encode('utf8'))
-            return resp.getcode(), resp.read()
-        except (IOError, OSError) as e:
-            return getattr(e, "code", None), getattr(e, "read", e.__str__)()
+        with scmt.tracing.span('acme.request', url=url):
+            try:
+                resp = urlopen(url, data.encode('utf8'))
+                return resp.getcode(), resp.read()
+            except (IOError, OSError) as e:
+                return getattr(e, "code", None), getattr(e, "read", e.__str__)()
 
     def register(self):
         """
@@ -165,15 +179,16 @@ class LetsEncrypt(BaseCA):
         """
 
         # lets check if this is a new issue or we are already have active certificate for this domain
-        if not self.certificate_exists(hostname) and self._rate_limit_last > time.time() - 43200:
-            mins_ago = int((time.time() - self._rate_limit_last)/60)
+        if not self.certificate_exists(hostname) and self._rate_limit_last > self.clock.time() - 43200:
+            mins_ago = int((self.clock.time() - self._rate_limit_last)/60)
             raise RuntimeError("Denied sign because we have reached cert limit. Last error was %d mins ago" % mins_ago)
 
         self.log("Signing new CSR, hostname %s" % hostname)
-        code, result = self._request(self.ca + "/acme/new-authz", {
-            "resource": "new-authz",
-            "identifier": {"type": "dns", "value": hostname},
-        })
+        with self.phase('authz'):
+            code, result = self._request(self.ca + "/acme/new-authz", {
+                "resource": "new-authz",
+                "identifier": {"type": "dns", "value": hostname},
+            })
 
         if code != 201:
             self.log("Failed to start new issue. Got reply code: %d, answer: %s" % (code, result))
@@ -188,28 +203,30 @@ class LetsEncrypt(BaseCA):
         key_authorization = "{0}.{1}".format(token, thumbprint)
 
         challenge_token = self._b64(hashlib.sha256(key_authorization.encode('utf8')).digest())
-        self._hook.deploy_challenge(hostname, challenge_token, key_authorization)
-        self.challenge(challenge['uri'], key_authorization)
-
-        try_until = time.time() + self._challenge_timeout
-        completed = False
-        self.log("Waiting for challenge verification for %s" % hostname)
-        while time.time() < try_until:
-            try:
-                resp = urlopen(challenge['uri'], timeout=10).read()
-                res = json.loads(resp)
-            except IOError as e:
-                self.log("IOError, failed to get response from challenge verification script. " % e.message)
-                time.sleep(self._challenge_sleep)
-                continue
-
-            if res['status'] != 'valid':
-                self.log("Challenge verification is not completed. Current status: %s" % res['status'])
-                time.sleep(self._challenge_sleep)
-
-            self.log("Challenge for %s completed" % hostname)
-            completed = True
-            break
+        with self.phase('challenge', type=challenge['type']):
+            with scmt.tracing.span('challenge.deploy'):
+                self._hook.deploy_challenge(hostname, challenge_token, key_authorization)
+            self.challenge(challenge['uri'], key_authorization)
+
+            try_until = self.clock.time() + self._challenge_timeout
+            completed = False
+            self.log("Waiting for challenge verification for %s" % hostname)
+            while self.clock.time() < try_until:
+                try:
+                    resp = urlopen(challenge['uri'], timeout=10).read()
+                    res = json.loads(resp)
+                except IOError as e:
+                    self.log("IOError, failed to get response from challenge verification script. " % e.message)
+                    self.clock.sleep(self._challenge_sleep)
+                    continue
+
+                if res['status'] != 'valid':
+                    self.log("Challenge verification is not completed. Current status: %s" % res['status'])
+                    self.clock.sleep(self._challenge_sleep)
+
+                self.log("Challenge for %s completed" % hostname)
+                completed = True
+                break
 
         if not completed:
             self.log("Failed to complete challenge in acceptable time. Timeout (%d) expired" % self._challenge_timeout)
@@ -219,13 +236,10 @@ class LetsEncrypt(BaseCA):
         # get the new certificate
         self.log("Signing certificate for %s" % hostname)
 
-        csr_temp_file = self.get_temp_path()
-        with open(csr_temp_file, 'w') as csr_file:
-            csr_file.write(csr)
+        csr_der = asn1.pem_decode(csr)[1]
 
-        proc = subprocess.Popen(["openssl", "req", "-in", csr_temp_file, "-outform", "DER"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        csr_der, err = proc.communicate()
-        code, result = self.new_cert(self._b64(csr_der))
+        with self.phase('finalize'):
+            code, result = self.new_cert(self._b64(csr_der))
 
         self._hook.clean_challenge(hostname, challenge_token)
 
@@ -233,7 +247,7 @@ class LetsEncrypt(BaseCA):
             info = json.loads(result)
             if 'type' in info:
                 if info['type'] == 'urn:acme:error:rateLimited':
-                    self._rate_limit_last = time.time()
+                    self._rate_limit_last = self.clock.time()
                     raise RuntimeError("Rate limit reached")
 
         if code != 201:
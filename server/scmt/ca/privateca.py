@@ -1,14 +1,13 @@
 import json
-import subprocess
 import os
-import shutil
 import base64
 import binascii
-import time
 import hashlib
 import re
 import copy
+import threading
 from baseca import BaseCA
+from signer import Signer
 
 try:
     from urllib.request import urlopen  # Python 3
@@ -18,75 +17,188 @@ except ImportError:
 
 class PrivateCA(BaseCA):
     account_key_size = 4096
+    # storage path for issued serials, grouped by day of expiration
+    serials_path = '_scmt/serials'
+    # serials are removed after certificate expiration and this period
+    serials_retention = 30 * 86400
+    # how often should expired serials be removed
+    serials_prune_interval = 86400
 
     def __init__(self, domain, options, storage):
         BaseCA.__init__(self, domain, options, storage)
 
         self.key = options['key'] if 'key' in options else self._dir + '/ca.pem'
         self.cert = options['cert'] if 'cert' in options else self._dir + '/cert.pem'
-        self.days = 365 if 'days' not in options else options['days']
+        self.days = 365 if 'days' not in options else int(options['days'])
         self.openssl_config = options['openssl_config'] if 'openssl_config' in options else ''
+        # native signs in process, openssl runs "openssl ca" with openssl_config,
+        # native signer doesn't apply extensions of openssl_config, so config selects openssl
+        if 'signer' in options:
+            self.signer = options['signer']
+        else:
+            self.signer = 'openssl' if self.openssl_config else 'native'
 
         self.subject = options['subject']
+        self._signer = None
+        self._signerLock = threading.Lock()
+        self._serialsPruned = 0
 
         self.log("Initialize PrivateCA, key: %s" % self.key)
 
-    def issue_certificate(self, hostname, force=False):
-        tmp_dir = self.tmp_dir + '/' + hostname + '/generate'
-        self.log("Issue cert for %s, tmp_path: %s" % (hostname, tmp_dir))
-        if not os.path.exists(tmp_dir):
-            os.makedirs(tmp_dir)
-
-        tmp_openssl = tmp_dir + '/openssl.cnf'
-
-        self.get_csr(hostname)
+    def get_signer(self):
+        """
+        Load CA key and certificate once, None if native signing is not possible
 
-        tmp_crt_path = self.get_temp_path()
-        tmp_csr_path = self.copy_to_fs(self.get_csr_url(hostname))
+        :return:
+        """
+        if self.signer != 'native':
+            return None
 
-        sign_command = [
-            "openssl",
-            "ca",
-            "-days", str(self.days),
-            "-notext",
-            "-md", "sha256",
-            "-in", tmp_csr_path,
-            "-out", tmp_crt_path,
-            "-outdir", tmp_dir,
-            "-keyfile", self.key,
-            "-cert", self.cert,
-            "-batch",
-            '-config', tmp_openssl
-        ]
+        with self._signerLock:
+            if self._signer is None:
+                with open(self.key, 'r') as key_file:
+                    key = key_file.read()
 
-        self.log("Running sign command: %s" % " ".join(sign_command))
+                if not Signer.supported(key):
+                    self.log("CA key %s can not be used for native signing, using openssl" % self.key)
+                    self.signer = 'openssl'
+                    return None
 
-        with open(self.openssl_config, 'r') as openssl_template:
-            with open(tmp_openssl, 'w') as openssl_result:
-                openssl_result.write(openssl_template.read().replace('%KEY_DIR%', tmp_dir))
+                with open(self.cert, 'r') as cert_file:
+                    self._signer = Signer(key, cert_file.read(), self.clock)
 
-        with open(tmp_dir + '/index.txt', 'w') as index_txt:
-            index_txt.write("")
+        return self._signer
 
-        with open(tmp_dir + '/serial', 'w') as serial:
-            serial.write('00')
+    def set_clock(self, clock):
+        BaseCA.set_clock(self, clock)
+        with self._signerLock:
+            if self._signer is not None:
+                self._signer.clock = clock
 
-        cmd = subprocess.Popen(sign_command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        exit_code = cmd.wait()
+    def issue_certificate(self, hostname, force=False):
+        signer = self.get_signer()
+        if signer is None:
+            return self.issue_certificate_openssl(hostname)
+
+        self.issue_certificates([hostname])
+
+    def issue_certificates(self, hostnames):
+        """
+        Issue certificates for list of hosts with one signer call
+
+        :param hostnames:
+        :return:
+        """
+        signer = self.get_signer()
+        if signer is None:
+            for hostname in hostnames:
+                self.issue_certificate_openssl(hostname)
+            return
+
+        requests = [(hostname, self.get_csr(hostname)) for hostname in hostnames]
+        with self.phase('finalize', count=len(requests)):
+            issued = signer.sign_many(requests, self.days)
+
+        for hostname, cert, serial, not_after in issued:
+            self._storage.write(self.get_crt_url(hostname), cert)
+            self._storage.write(self.get_fullchain_url(hostname), cert)
+            self.register_serial(hostname, serial, not_after)
+            self.log("Certificate successfully generated for %s, serial %x" % (hostname, serial))
+            self.certificate_issued(hostname)
+
+        self.prune_serials()
+
+    def register_serial(self, hostname, serial, not_after):
+        """
+        Keep record of issued certificate
+
+        :param hostname:
+        :param serial:
+        :param not_after:
+        :return:
+        """
+        self._storage.write('%s/%s/%d/%x' % (self.serials_path, self._domain, not_after // 86400, serial), json.dumps({
+            'hostname': hostname,
+            'issued': int(self.clock.time()),
+            'expire': not_after
+        }))
+
+    def prune_serials(self):
+        """
+        Remove records of certificates expired more than retention ago, whole days are removed at once
+
+        :return: number of removed days and serials of previous version
+        """
+        now = self.clock.time()
+        if self._serialsPruned > now - self.serials_prune_interval:
+            return 0
+
+        self._serialsPruned = now
+        path = self.serials_path + '/' + self._domain
+        try:
+            names = self._storage.list(path)
+        except IndexError:
+            return 0
+
+        oldest = int((now - self.serials_retention) // 86400)
+        removed = 0
+        for name in names:
+            if name.isdigit():
+                expired = int(name) < oldest
+            else:
+                # serial written by previous version directly under domain
+                try:
+                    expired = json.loads(self._storage.read(path + '/' + name))['expire'] // 86400 < oldest
+                except (IndexError, ValueError, KeyError):
+                    continue
+
+            if expired:
+                self._storage.delete(path + '/' + name)
+                removed += 1
+
+        if removed:
+            self.log("Removed serials of %d expiration days of %s" % (removed, self._domain))
+
+        return removed
+
+    def issue_certificate_openssl(self, hostname):
+        csr = self.get_csr(hostname)
+
+        # openssl ca needs its database files, CSR and certificate are passed through pipes
+        with self.scratch() as scratch:
+            self.log("Issue cert for %s, scratch: %s" % (hostname, scratch.path))
+            with open(self.openssl_config, 'r') as openssl_template:
+                tmp_openssl = scratch.write('openssl.cnf', openssl_template.read().replace('%KEY_DIR%', scratch.path))
+
+            scratch.write('index.txt', '')
+            scratch.write('serial', binascii.hexlify(os.urandom(16)))
+
+            sign_command = [
+                "ca",
+                "-days", str(self.days),
+                "-notext",
+                "-md", "sha256",
+                "-in", "/dev/stdin",
+                "-outdir", scratch.path,
+                "-keyfile", self.key,
+                "-cert", self.cert,
+                "-batch",
+                '-config', tmp_openssl
+            ]
+
+            self.log("Running sign command: openssl %s" % " ".join(sign_command))
+            with self.phase('finalize'):
+                cert = self.openssl(sign_command, csr)
 
-        result = cmd.stdout.readlines()
         self.log("OpenSSL sign completed for %s" % hostname)
-        if exit_code != 0:
-            raise RuntimeError("Wrong OpenSSL result code. Got: %d, result: %s" % (exit_code, str(result)))
-
-        if not os.path.isfile(tmp_crt_path):
-            raise RuntimeError("Failed to sign certificate for %s, error: %s" % (hostname, str(result)))
+        if '-----BEGIN CERTIFICATE-----' not in cert:
+            raise RuntimeError("Failed to sign certificate for %s, got: %s" % (hostname, cert))
 
-        self.copy_to_storage(tmp_crt_path, self.get_crt_url(hostname), delete=False)
-        self.copy_to_storage(tmp_crt_path, self.get_fullchain_url(hostname))
+        self._storage.write(self.get_crt_url(hostname), cert)
+        self._storage.write(self.get_fullchain_url(hostname), cert)
 
-        shutil.rmtree(tmp_dir)
         self.log("Certificate successfully generated for %s" % hostname)
+        self.certificate_issued(hostname)
 
     def get_cert_subject(self, hostname):
         return self.subject.replace('%COMMONNAME%', hostname)
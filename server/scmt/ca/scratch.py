@@ -0,0 +1,121 @@
+"""
+Scratch space for material which external tools can read only from files.
+Every operation gets its own private directory, on tmpfs when available, and
+the directory is removed when the last reference to it is released.
+"""
+import errno
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+
+def default_base():
+    """
+    Directory for scratch spaces, tmpfs is preferred so secrets never hit disk
+
+    :return:
+    """
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm/scmt'
+
+    return os.path.join(tempfile.gettempdir(), 'scmt')
+
+
+def cleanup_stale(base, max_age=86400):
+    """
+    Remove scratch spaces left by crashed processes
+
+    :param base:
+    :param max_age: spaces older than this are removed, no operation lasts that long
+    :return: number of removed spaces
+    """
+    removed = 0
+    try:
+        names = os.listdir(base)
+    except OSError:
+        return 0
+
+    for name in names:
+        path = os.path.join(base, name)
+        try:
+            if os.path.getmtime(path) < time.time() - max_age:
+                shutil.rmtree(path, ignore_errors=True)
+                removed += 1
+        except OSError:
+            continue
+
+    return removed
+
+
+class Scratch:
+    """
+    Private directory of one operation, use as context manager or call release()
+    """
+    def __init__(self, base=None):
+        base = base or default_base()
+        try:
+            os.makedirs(base, 0700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        self.path = tempfile.mkdtemp(dir=base)
+        self._refs = 1
+        self._lock = threading.Lock()
+
+    def join(self, name):
+        return os.path.join(self.path, name)
+
+    def write(self, name, data):
+        """
+        Create file readable only by current user
+
+        :param name:
+        :param data:
+        :return: path of created file
+        """
+        path = self.join(name)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+        with os.fdopen(fd, 'w') as output:
+            output.write(data)
+
+        return path
+
+    def read(self, name):
+        with open(self.join(name), 'r') as source:
+            return source.read()
+
+    def acquire(self):
+        """
+        Keep directory alive for one more user
+
+        :return:
+        """
+        with self._lock:
+            if not self._refs:
+                raise RuntimeError("Scratch space %s is already released" % self.path)
+            self._refs += 1
+
+        return self
+
+    def release(self):
+        """
+        Drop one reference, directory is removed with the last one
+
+        :return:
+        """
+        with self._lock:
+            self._refs -= 1
+            removed = self._refs == 0
+
+        if removed:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        return False
@@ -0,0 +1,386 @@
+import binascii
+import hashlib
+import os
+import scmt.clock
+import scmt.loggable
+import asn1
+
+RSA_ENCRYPTION = '1.2.840.113549.1.1.1'
+SHA256_WITH_RSA = '1.2.840.113549.1.1.11'
+EC_PUBLIC_KEY = '1.2.840.10045.2.1'
+SUBJECT_KEY_ID = '2.5.29.14'
+KEY_USAGE = '2.5.29.15'
+SUBJECT_ALT_NAME = '2.5.29.17'
+BASIC_CONSTRAINTS = '2.5.29.19'
+AUTHORITY_KEY_ID = '2.5.29.35'
+EXT_KEY_USAGE = '2.5.29.37'
+SERVER_AUTH = '1.3.6.1.5.5.7.3.1'
+CLIENT_AUTH = '1.3.6.1.5.5.7.3.2'
+
+# DER prefix of DigestInfo with SHA-256, RFC 8017 section 9.2
+SHA256_DIGEST_INFO = binascii.unhexlify('3031300d060960864801650304020105000420')
+
+# signature algorithms of certificate requests => (hash, DER prefix of DigestInfo for RSA)
+CSR_SIGNATURES = {
+    SHA256_WITH_RSA: (hashlib.sha256, SHA256_DIGEST_INFO),
+    '1.2.840.113549.1.1.12': (hashlib.sha384, binascii.unhexlify('3041300d060960864801650304020205000430')),
+    '1.2.840.113549.1.1.13': (hashlib.sha512, binascii.unhexlify('3051300d060960864801650304020305000440')),
+    '1.2.840.10045.4.3.2': (hashlib.sha256, None),
+    '1.2.840.10045.4.3.3': (hashlib.sha384, None),
+    '1.2.840.10045.4.3.4': (hashlib.sha512, None),
+}
+
+# curves of EC keys generated by BaseCA and clients: (p, order, generator x, generator y), a = -3
+CURVES = {
+    # P-256
+    '1.2.840.10045.3.1.7': (
+        2 ** 256 - 2 ** 224 + 2 ** 192 + 2 ** 96 - 1,
+        0xffffffff00000000ffffffffffffffffbce6faada7179e84f3b9cac2fc632551,
+        0x6b17d1f2e12c4247f8bce6e563a440f277037d812deb33a0f4a13945d898c296,
+        0x4fe342e2fe1a7f9b8ee7eb4a7c0f9e162bce33576b315ececbb6406837bf51f5),
+    # P-384
+    '1.3.132.0.34': (
+        2 ** 384 - 2 ** 128 - 2 ** 96 + 2 ** 32 - 1,
+        0xffffffffffffffffffffffffffffffffffffffffffffffffc7634d81f4372ddf581a0db248b0a77aecec196accc52973,
+        0xaa87ca22be8b05378eb1c71ef320ad746e1d3b628ba79b9859f741e082542a385502f25dbf55296c3a545e3872760ab7,
+        0x3617de4a96262c6f5d9e98bf9292dc29f8f41dbd289a147ce9da3113b5f0b8c00a60b1ce1d7e819d7a431d7c90ea0e5f),
+}
+
+
+def inverse(value, modulus):
+    """
+    Modular inverse by extended Euclid algorithm
+
+    :param value:
+    :param modulus:
+    :return:
+    """
+    a, b, x, y = value % modulus, modulus, 1, 0
+    while b:
+        quotient = a // b
+        a, b, x, y = b, a - quotient * b, y, x - quotient * y
+
+    if a != 1:
+        raise ValueError("%d has no inverse" % value)
+
+    return x % modulus
+
+
+def _ec_double(point, p):
+    # jacobian coordinates, curve parameter a = -3
+    if point is None or not point[1]:
+        return None
+
+    x, y, z = point
+    delta = z * z % p
+    gamma = y * y % p
+    beta = x * gamma % p
+    alpha = 3 * (x - delta) * (x + delta) % p
+    x3 = (alpha * alpha - 8 * beta) % p
+    z3 = ((y + z) ** 2 - gamma - delta) % p
+    y3 = (alpha * (4 * beta - x3) - 8 * gamma * gamma) % p
+
+    return x3, y3, z3
+
+
+def _ec_add(first, second, p):
+    if first is None:
+        return second
+    if second is None:
+        return first
+
+    x1, y1, z1 = first
+    x2, y2, z2 = second
+    z1z1 = z1 * z1 % p
+    z2z2 = z2 * z2 % p
+    u1 = x1 * z2z2 % p
+    u2 = x2 * z1z1 % p
+    s1 = y1 * z2 * z2z2 % p
+    s2 = y2 * z1 * z1z1 % p
+    if u1 == u2:
+        return _ec_double(first, p) if s1 == s2 else None
+
+    h = (u2 - u1) % p
+    r = (s2 - s1) % p
+    h2 = h * h % p
+    h3 = h * h2 % p
+    u1h2 = u1 * h2 % p
+    x3 = (r * r - h3 - 2 * u1h2) % p
+    y3 = (r * (u1h2 - x3) - s1 * h3) % p
+
+    return x3, y3, h * z1 * z2 % p
+
+
+def verify_ecdsa(curve, point, digest, signature):
+    """
+    Check ECDSA signature
+
+    :param curve: curve OID
+    :param point: uncompressed public key point
+    :param digest: message hash
+    :param signature: DER encoded r and s
+    :return: True when signature is valid
+    """
+    p, order, gx, gy = CURVES[curve]
+    if point[0] != '\x04':
+        raise ValueError("Only uncompressed EC points are supported")
+
+    size = (len(point) - 1) // 2
+    public = (asn1.bytes_to_int(point[1:1 + size]), asn1.bytes_to_int(point[1 + size:]), 1)
+    r, s = [asn1.bytes_to_int(content) for tag, content, raw in asn1.decode_all(asn1.decode(signature)[1])]
+    if not 0 < r < order or not 0 < s < order:
+        return False
+
+    e = asn1.bytes_to_int(digest)
+    if len(digest) * 8 > order.bit_length():
+        e >>= len(digest) * 8 - order.bit_length()
+
+    w = inverse(s, order)
+    u1 = e * w % order
+    u2 = r * w % order
+
+    # u1 * G + u2 * Q with one pass over bits
+    generator = (gx, gy, 1)
+    both = _ec_add(generator, public, p)
+    result = None
+    for bit in range(max(u1.bit_length(), u2.bit_length()) - 1, -1, -1):
+        result = _ec_double(result, p)
+        if (u1 >> bit) & 1 and (u2 >> bit) & 1:
+            result = _ec_add(result, both, p)
+        elif (u1 >> bit) & 1:
+            result = _ec_add(result, generator, p)
+        elif (u2 >> bit) & 1:
+            result = _ec_add(result, public, p)
+
+    if result is None:
+        return False
+
+    x = result[0] * inverse(result[2] * result[2], p) % p
+    return x % order == r
+
+
+class Signer(scmt.loggable.Loggable):
+    """
+    In-process certificate signer. RSA CA key is parsed once and kept in memory,
+    certificates are built in DER and signed with RSASSA-PKCS1-v1_5 SHA-256.
+    Signing uses blinding and every signature is verified before it is
+    released, so faulty CRT computation can't leak the key.
+    """
+    # certificates are valid from this number of seconds in the past, covers clock skew
+    backdate = 300
+    # time source of validity period
+    clock = scmt.clock.DEFAULT
+
+    def __init__(self, key_pem, cert_pem, clock=None):
+        self._key = self.read_key(key_pem)
+        if clock is not None:
+            self.clock = clock
+
+        label, cert = asn1.pem_decode(cert_pem)
+        tbs = asn1.decode_all(asn1.decode(asn1.decode(cert)[1])[1])
+        if tbs[0][0] == 0xa0:
+            tbs = tbs[1:]
+
+        # serial, signature, issuer, validity, subject, public key, extensions
+        self.subject = tbs[4][2]
+        self.key_id = None
+        for tag, content, raw in tbs[6:]:
+            if tag == 0xa3:
+                self.key_id = self._read_key_id(asn1.decode(content)[1])
+
+        if not self.key_id:
+            self.key_id = hashlib.sha1(asn1.decode(asn1.decode_all(tbs[5][1])[1][2])[1][1:]).digest()
+
+    @staticmethod
+    def read_key(key_pem):
+        """
+        Read RSA private key in PKCS#1 or PKCS#8 format
+
+        :param key_pem:
+        :return: dict with key numbers
+        """
+        label, der = asn1.pem_decode(key_pem)
+        if label == 'PRIVATE KEY':
+            items = asn1.decode_all(asn1.decode(der)[1])
+            if asn1.read_oid(asn1.decode(items[1][1])[1]) != RSA_ENCRYPTION:
+                raise ValueError("Only RSA keys are supported")
+            der = items[2][1]
+        elif label != 'RSA PRIVATE KEY':
+            raise ValueError("Unsupported key type %s" % label)
+
+        numbers = [asn1.bytes_to_int(content) for tag, content, raw in asn1.decode_all(asn1.decode(der)[1])]
+        names = ['version', 'n', 'e', 'd', 'p', 'q', 'dp', 'dq', 'qinv']
+
+        return dict(zip(names, numbers))
+
+    @staticmethod
+    def supported(key_pem):
+        try:
+            Signer.read_key(key_pem)
+        except (ValueError, IndexError, TypeError):
+            return False
+
+        return True
+
+    def _read_key_id(self, extensions):
+        for tag, content, raw in asn1.decode_all(extensions):
+            fields = asn1.decode_all(content)
+            if asn1.read_oid(fields[0][1]) == SUBJECT_KEY_ID:
+                return asn1.decode(fields[-1][1])[1]
+
+        return None
+
+    def read_csr(self, csr_pem):
+        """
+        Get subject and public key from certificate request, signature of request is verified
+
+        :param csr_pem:
+        :return: tuple of DER encoded subject and public key info
+        """
+        label, der = asn1.pem_decode(csr_pem)
+        request = asn1.decode_all(asn1.decode(der)[1])
+        info = asn1.decode_all(request[0][1])
+        algorithm = asn1.read_oid(asn1.decode(request[1][1])[1])
+        if algorithm not in CSR_SIGNATURES:
+            raise ValueError("Unsupported signature algorithm %s of certificate request" % algorithm)
+
+        if not self.verify_signature(info[2][1], algorithm, request[0][2], request[2][1][1:]):
+            raise ValueError("Invalid signature of certificate request")
+
+        return info[1][2], info[2][2]
+
+    def verify_signature(self, public_key, algorithm, data, signature):
+        """
+        Check signature made by key of certificate request
+
+        :param public_key: content of public key info
+        :param algorithm: signature algorithm OID
+        :param data: signed data
+        :param signature:
+        :return: True when signature is valid
+        """
+        key_algorithm, key_bits = asn1.decode_all(public_key)
+        algorithm_fields = asn1.decode_all(key_algorithm[1])
+        key_type = asn1.read_oid(algorithm_fields[0][1])
+        hash_function, digest_info = CSR_SIGNATURES[algorithm]
+        digest = hash_function(data).digest()
+
+        if key_type == RSA_ENCRYPTION and digest_info:
+            n, e = [asn1.bytes_to_int(content) for tag, content, raw in
+                    asn1.decode_all(asn1.decode(key_bits[1][1:])[1])]
+            size = (n.bit_length() + 7) // 8
+            expected = '\x00\x01' + '\xff' * (size - len(digest_info) - len(digest) - 3) + '\x00' + digest_info + digest
+            return asn1.int_to_bytes(pow(asn1.bytes_to_int(signature), e, n), size) == expected
+
+        if key_type == EC_PUBLIC_KEY and not digest_info:
+            curve = asn1.read_oid(algorithm_fields[1][1])
+            if curve not in CURVES:
+                raise ValueError("Unsupported curve %s of certificate request" % curve)
+
+            return verify_ecdsa(curve, key_bits[1][1:], digest, signature)
+
+        raise ValueError("Unsupported key %s of certificate request" % key_type)
+
+    def sign_rsa(self, data):
+        key = self._key
+        size = (key['n'].bit_length() + 7) // 8
+        digest_info = SHA256_DIGEST_INFO + hashlib.sha256(data).digest()
+        encoded = '\x00\x01' + '\xff' * (size - len(digest_info) - 3) + '\x00' + digest_info
+        message = asn1.bytes_to_int(encoded)
+
+        # blinding hides relation between message and timing of private key operation
+        while True:
+            blinding = asn1.bytes_to_int(os.urandom(size)) % key['n']
+            try:
+                unblinding = inverse(blinding, key['n'])
+                break
+            except ValueError:
+                continue
+        blinded = message * pow(blinding, key['e'], key['n']) % key['n']
+
+        if key['p'] and key['q']:
+            s1 = pow(blinded, key['dp'], key['p'])
+            s2 = pow(blinded, key['dq'], key['q'])
+            signature = s2 + ((key['qinv'] * (s1 - s2)) % key['p']) * key['q']
+        else:
+            signature = pow(blinded, key['d'], key['n'])
+        signature = signature * unblinding % key['n']
+
+        # faulty CRT result would reveal factor of n, never release unverified signature
+        if pow(signature, key['e'], key['n']) != message:
+            raise RuntimeError("RSA signature self-check failed")
+
+        return asn1.int_to_bytes(signature, size)
+
+    def new_serial(self):
+        # positive 159 bit number, RFC 5280 limits serial to 20 bytes
+        return (asn1.bytes_to_int(os.urandom(20)) >> 1) | 1
+
+    def extensions(self, hostname, public_key):
+        public_key_bits = asn1.decode(asn1.decode_all(asn1.decode(public_key)[1])[1][2])[1][1:]
+        extensions = [
+            (BASIC_CONSTRAINTS, True, asn1.sequence()),
+            # digitalSignature, keyEncipherment
+            (KEY_USAGE, True, asn1.bit_string('\xa0', 5)),
+            (EXT_KEY_USAGE, False, asn1.sequence(asn1.oid(SERVER_AUTH), asn1.oid(CLIENT_AUTH))),
+            (SUBJECT_KEY_ID, False, asn1.octet_string(hashlib.sha1(public_key_bits).digest())),
+            (AUTHORITY_KEY_ID, False, asn1.sequence(asn1.implicit(0, self.key_id))),
+        ]
+        if hostname:
+            extensions.append((SUBJECT_ALT_NAME, False, asn1.sequence(asn1.implicit(2, hostname))))
+
+        encoded = []
+        for name, critical, value in extensions:
+            fields = [asn1.oid(name)]
+            if critical:
+                fields.append(asn1.boolean(True))
+            fields.append(asn1.octet_string(value))
+            encoded.append(asn1.sequence(*fields))
+
+        return asn1.explicit(3, asn1.sequence(*encoded))
+
+    def sign(self, csr_pem, hostname=None, days=365):
+        """
+        Issue certificate for request
+
+        :param csr_pem: PEM encoded certificate request
+        :param hostname: added to subject alternative names
+        :param days: certificate validity
+        :return: tuple of PEM encoded certificate, serial and expiration time
+        """
+        subject, public_key = self.read_csr(csr_pem)
+        serial = self.new_serial()
+        now = int(self.clock.time())
+        not_before = now - self.backdate
+        not_after = now + int(days) * 86400
+        algorithm = asn1.sequence(asn1.oid(SHA256_WITH_RSA), asn1.null())
+
+        tbs = asn1.sequence(
+            asn1.explicit(0, asn1.integer(2)),
+            asn1.integer(serial),
+            algorithm,
+            self.subject,
+            asn1.sequence(asn1.timestamp(not_before), asn1.timestamp(not_after)),
+            subject,
+            public_key,
+            self.extensions(hostname, public_key)
+        )
+
+        cert = asn1.sequence(tbs, algorithm, asn1.bit_string(self.sign_rsa(tbs)))
+        return asn1.pem_encode(cert), serial, not_after
+
+    def sign_many(self, requests, days=365):
+        """
+        Issue certificates for list of requests
+
+        :param requests: list of (hostname, PEM encoded CSR) tuples
+        :param days:
+        :return: list of (hostname, certificate, serial, expiration time) tuples
+        """
+        issued = []
+        for hostname, csr in requests:
+            cert, serial, not_after = self.sign(csr, hostname, days)
+            issued.append((hostname, cert, serial, not_after))
+
+        self.log("Signed %d certificates" % len(issued))
+        return issued
@@ -0,0 +1,93 @@
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from baseca import BaseCA
+from chaincache import ChainCache
+import certinfo
+from scmt.storages.memory import MemoryStorage
+
+
+class ChainCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.root('root')
+        self.sign('int', 'root', 'basicConstraints=CA:TRUE\n', 'http://127.0.0.1:1/root.der')
+        self.sign('leaf', 'int', '', 'http://127.0.0.1:1/int.der')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def openssl(self, *args):
+        subprocess.check_call(('openssl',) + args, cwd=self.dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def root(self, name):
+        self.openssl('req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-keyout', name + '.key', '-out', name + '.pem',
+                     '-subj', '/CN=' + name, '-days', '30')
+
+    def sign(self, name, ca, extensions, issuer_url, key=None, subject=None):
+        with open(self.dir + '/' + name + '.ext', 'w') as ext:
+            ext.write(extensions + 'subjectKeyIdentifier=hash\nauthorityKeyIdentifier=keyid\n'
+                      'authorityInfoAccess=caIssuers;URI:' + issuer_url + '\n')
+
+        # existing key gives certificate with same subject key ID, like cross-signed issuer
+        if key:
+            request = ('req', '-new', '-key', key + '.key')
+        else:
+            request = ('req', '-newkey', 'rsa:2048', '-nodes', '-keyout', name + '.key')
+        self.openssl(*(request + ('-out', name + '.csr', '-subj', '/CN=' + (subject or name))))
+        self.openssl('x509', '-req', '-in', name + '.csr', '-CA', ca + '.pem', '-CAkey', ca + '.key',
+                     '-set_serial', '1', '-out', name + '.pem', '-days', '30', '-extfile', name + '.ext')
+
+    def pem(self, name):
+        with open(self.dir + '/' + name + '.pem') as crt:
+            return crt.read()
+
+    def test_bundle(self):
+        cache = ChainCache()
+        self.assertEqual(cache.load_bundle(self.dir + '/int.pem'), 1)
+
+        crt, info = cache.get_issuer(certinfo.read(self.pem('leaf')))
+        self.assertEqual(crt, self.pem('int'))
+        self.assertIn('int', info['Subject'])
+
+    def test_cross_signed(self):
+        self.root('root2')
+        self.sign('int2', 'root2', 'basicConstraints=CA:TRUE\n', 'http://127.0.0.1:1/root2.der', key='int', subject='int')
+        cache = ChainCache()
+        cache.add(self.pem('int2'))
+        cache.add(self.pem('int'), 'http://127.0.0.1:1/int.der')
+
+        # both issuers are kept, one from CA Issuers URL of leaf is preferred
+        leaf = certinfo.read(self.pem('leaf'))
+        self.assertEqual(cache.get_issuer(leaf)[0], self.pem('int'))
+        self.assertEqual(cache.get_issuer(leaf, exclude=[certinfo.fingerprint(self.pem('int'))])[0], self.pem('int2'))
+
+    def test_issuers_loop(self):
+        # root key certified by intermediate it signed
+        self.sign('rootx', 'int', '', 'http://127.0.0.1:1/int.der', key='root', subject='root')
+        ca = BaseCA('example.com', {'tmp': self.dir + '/tmp'}, MemoryStorage())
+        ca.issuers = ChainCache()
+        ca.issuers.add(self.pem('int'), 'http://127.0.0.1:1/int.der')
+        ca.issuers.add(self.pem('rootx'), 'http://127.0.0.1:1/root.der')
+
+        self.assertEqual(ca.build_chain(self.pem('leaf')), self.pem('leaf') + self.pem('int') + self.pem('rootx'))
+
+    def test_storage(self):
+        storage = MemoryStorage()
+        cache = ChainCache()
+        ski = cache.add(self.pem('int'), 'http://127.0.0.1:1/int.der')
+        storage.write(cache.get_url_path('http://127.0.0.1:1/int.der'), '{"ski": "%s", "fetched": 9e12}' % ski)
+        storage.write(cache.storage_path + '/certs/' + ski, self.pem('int'))
+
+        # new replica loads issuer from storage, download would fail
+        crt, info = ChainCache().get_issuer(certinfo.read(self.pem('leaf')), storage)
+        self.assertEqual(crt, self.pem('int'))
+
+        # missing issuer can not be downloaded
+        self.assertIsNone(ChainCache().get_issuer(certinfo.read(self.pem('int')), storage))
+
+
+if __name__ == '__main__':
+    unittest.main()
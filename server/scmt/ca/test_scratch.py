@@ -0,0 +1,43 @@
+import os
+import shutil
+import stat
+import tempfile
+import time
+import unittest
+
+from scratch import Scratch, cleanup_stale
+
+
+class ScratchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.base, ignore_errors=True)
+
+    def test_last_release_removes_directory(self):
+        scratch = Scratch(self.base)
+        path = scratch.write('key.pem', 'secret')
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0600)
+        self.assertEqual(scratch.read('key.pem'), 'secret')
+
+        scratch.acquire()
+        scratch.release()
+        self.assertTrue(os.path.exists(path))
+
+        scratch.release()
+        self.assertFalse(os.path.exists(scratch.path))
+        self.assertRaises(RuntimeError, scratch.acquire)
+
+    def test_cleanup_stale(self):
+        with Scratch(self.base) as fresh:
+            stale = Scratch(self.base)
+            os.utime(stale.path, (time.time() - 7200, time.time() - 7200))
+
+            self.assertEqual(cleanup_stale(self.base, max_age=3600), 1)
+            self.assertFalse(os.path.exists(stale.path))
+            self.assertTrue(os.path.exists(fresh.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
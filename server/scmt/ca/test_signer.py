@@ -0,0 +1,86 @@
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import asn1
+from scmt.clock import SimulatedClock
+from signer import Signer
+
+
+class SignerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.openssl('req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-keyout', 'ca.key', '-out', 'ca.pem',
+                     '-subj', '/CN=Test CA', '-days', '30')
+        self.openssl('req', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:secp384r1', '-nodes',
+                     '-keyout', 'host.key', '-out', 'host.csr', '-subj', '/CN=host.example.com')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def openssl(self, *args):
+        cmd = subprocess.Popen(('openssl',) + args, cwd=self.dir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = cmd.communicate()[0]
+        self.assertEqual(cmd.returncode, 0, output)
+
+        return output
+
+    def read(self, name):
+        with open(self.dir + '/' + name) as data:
+            return data.read()
+
+    def write(self, name, data):
+        with open(self.dir + '/' + name, 'w') as output:
+            output.write(data)
+
+    def test_sign(self):
+        signer = Signer(self.read('ca.key'), self.read('ca.pem'))
+        issued = signer.sign_many([('host.example.com', self.read('host.csr'))] * 2, days=10)
+
+        self.assertNotEqual(issued[0][2], issued[1][2])
+        self.write('host.pem', issued[0][1])
+        self.openssl('verify', '-CAfile', 'ca.pem', '-purpose', 'sslserver', 'host.pem')
+        self.assertIn('DNS:host.example.com', self.openssl('x509', '-in', 'host.pem', '-noout', '-text'))
+
+    def test_validity_from_clock(self):
+        signer = Signer(self.read('ca.key'), self.read('ca.pem'), SimulatedClock(86400))
+        cert, serial, not_after = signer.sign(self.read('host.csr'), 'host.example.com', days=10)
+
+        self.assertEqual(86400 + 10 * 86400, not_after)
+        self.write('host.pem', cert)
+        self.assertIn('notBefore=Jan  1 23:55:00 1970 GMT', self.openssl('x509', '-in', 'host.pem', '-noout', '-dates'))
+
+    def test_pkcs1_key(self):
+        self.openssl('rsa', '-in', 'ca.key', '-out', 'ca-rsa.key', '-traditional')
+        self.assertIn('BEGIN RSA PRIVATE KEY', self.read('ca-rsa.key'))
+
+        signer = Signer(self.read('ca-rsa.key'), self.read('ca.pem'))
+        self.write('host.pem', signer.sign(self.read('host.csr'), 'host.example.com')[0])
+        self.openssl('verify', '-CAfile', 'ca.pem', 'host.pem')
+
+    def test_csr_signature(self):
+        signer = Signer(self.read('ca.key'), self.read('ca.pem'))
+        self.openssl('req', '-newkey', 'rsa:2048', '-nodes', '-keyout', 'rsa.key', '-out', 'rsa.csr',
+                     '-subj', '/CN=rsa.example.com')
+        self.openssl('req', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1', '-nodes',
+                     '-keyout', 'p256.key', '-out', 'p256.csr', '-subj', '/CN=p256.example.com')
+        for name in ['host.csr', 'rsa.csr', 'p256.csr']:
+            signer.read_csr(self.read(name))
+
+        # request with subject changed after signing
+        label, der = asn1.pem_decode(self.read('rsa.csr'))
+        forged = asn1.pem_encode(der.replace('rsa.example.com', 'evl.example.com'), 'CERTIFICATE REQUEST')
+        self.assertRaises(ValueError, signer.read_csr, forged)
+
+    def test_faulty_signature_not_released(self):
+        signer = Signer(self.read('ca.key'), self.read('ca.pem'))
+        signer._key['dp'] += 1
+        self.assertRaises(RuntimeError, signer.sign_rsa, 'data')
+
+    def test_unsupported_key(self):
+        self.assertFalse(Signer.supported(self.read('host.key')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,176 @@
+"""
+Time source of scheduling code. Manager, CAs and hooks read time and sleep
+through a clock object, so simulation can replace real time with virtual one
+and run months of renewals in seconds.
+"""
+import heapq
+import threading
+import time
+
+
+class Clock:
+    """
+    Real time
+    """
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def wait(self, condition, timeout):
+        """
+        Wait for notification of condition, its lock should be acquired
+
+        :param condition:
+        :param timeout:
+        :return:
+        """
+        condition.wait(timeout)
+
+    def notify(self, condition, wake_all=False):
+        """
+        Wake threads waiting for condition, its lock should be acquired
+
+        :param condition:
+        :param wake_all: wake all waiting threads instead of one
+        :return:
+        """
+        if wake_all:
+            condition.notify_all()
+        else:
+            condition.notify()
+
+
+class SimulatedClock(Clock):
+    """
+    Virtual time which moves only when driver advances it. Threads sleeping or
+    waiting on the clock stay blocked until virtual time reaches their deadline
+    or they are notified, advance() wakes them in order of deadlines and moves
+    on only when every thread using the clock is blocked again, so simulated
+    threads run in lockstep with virtual time instead of spinning.
+    """
+    # how often should driver check activities which don't use the clock
+    poll_interval = 0.0001
+
+    def __init__(self, now=0):
+        self.now = now
+        self._lock = threading.Condition()
+        # heap of (deadline, number, timer), timers of notified threads are removed lazily
+        self._timers = []
+        self._number = 0
+        # threads which used the clock and number of them blocked on it
+        self._threads = set()
+        self._blocked = 0
+        self._activities = []
+
+    def time(self):
+        return self.now
+
+    def add_activity(self, busy):
+        """
+        Add function telling that work not using the clock is running, time doesn't move until it is done
+
+        :param busy:
+        :return:
+        """
+        self._activities.append(busy)
+
+    def _block(self, seconds, condition=None):
+        timer = {'condition': condition, 'fired': False}
+        with self._lock:
+            self._threads.add(threading.currentThread())
+            self._number += 1
+            heapq.heappush(self._timers, (self.now + max(0, seconds), self._number, timer))
+            self._blocked += 1
+            self._lock.notify_all()
+
+        return timer
+
+    def _fire(self, timer):
+        # clock lock should be acquired
+        if not timer['fired']:
+            timer['fired'] = True
+            self._blocked -= 1
+
+    def sleep(self, seconds):
+        timer = self._block(seconds)
+        with self._lock:
+            while not timer['fired']:
+                self._lock.wait()
+
+    def wait(self, condition, timeout):
+        # condition lock is held until wait, so driver can't notify before thread waits
+        timer = self._block(timeout, condition)
+        condition.wait()
+        with self._lock:
+            self._fire(timer)
+
+    def notify(self, condition, wake_all=False):
+        # all waiters are woken, so it is known which threads are running
+        with self._lock:
+            for deadline, number, timer in self._timers:
+                if timer['condition'] is condition:
+                    self._fire(timer)
+
+        condition.notify_all()
+
+    def wait_blocked(self, count):
+        """
+        Wait until given number of threads are blocked on the clock, used to start simulation
+
+        :param count:
+        :return:
+        """
+        with self._lock:
+            while self._blocked < count:
+                self._lock.wait()
+
+    def _wait_idle(self):
+        while True:
+            with self._lock:
+                self._threads = set([thread for thread in self._threads if thread.is_alive()])
+                if self._blocked < len(self._threads):
+                    self._lock.wait()
+                    continue
+
+            if not [busy for busy in self._activities if busy()]:
+                return
+
+            time.sleep(self.poll_interval)
+
+    def advance(self, seconds):
+        """
+        Move time forward waking threads whose deadlines passed
+
+        :param seconds:
+        :return: new time
+        """
+        end = self.now + max(0, seconds)
+        while True:
+            self._wait_idle()
+            with self._lock:
+                while self._timers and self._timers[0][2]['fired']:
+                    heapq.heappop(self._timers)
+
+                if not self._timers or self._timers[0][0] > end:
+                    self.now = end
+                    return self.now
+
+                self.now = max(self.now, self._timers[0][0])
+                conditions = []
+                while self._timers and self._timers[0][0] <= self.now:
+                    timer = heapq.heappop(self._timers)[2]
+                    if not timer['fired']:
+                        self._fire(timer)
+                        if timer['condition'] is not None:
+                            conditions.append(timer['condition'])
+                self._lock.notify_all()
+
+            for condition in conditions:
+                with condition:
+                    condition.notify_all()
+
+
+
+DEFAULT = Clock()
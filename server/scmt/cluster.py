@@ -0,0 +1,254 @@
+"""
+Ownership of hostnames between replicas sharing one storage. Every replica
+registers itself under _scmt/members, Consul session removes registration of
+replica which stopped renewing it. Hostnames of each domain are assigned to
+replicas serving this domain by consistent hashing, so replica renews only its
+share and membership change moves only hostnames of joined or left replica.
+Issues of hostnames owned by other replica are forwarded through storage queue.
+"""
+import atexit
+import bisect
+import hashlib
+import json
+import threading
+
+import loggable
+from clock import Clock
+
+
+def hash_key(key):
+    return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+
+class Ring:
+    """
+    Consistent hash ring of replicas
+    """
+    # points of every replica on ring, more points give more even distribution
+    points = 64
+
+    def __init__(self, nodes):
+        self.nodes = sorted(nodes)
+        self._ring = sorted([(hash_key('%s#%d' % (node, i)), node) for node in self.nodes for i in range(self.points)])
+        self._hashes = [point for point, node in self._ring]
+
+    def owner(self, key):
+        if not self._ring:
+            return None
+
+        position = bisect.bisect(self._hashes, hash_key(key)) % len(self._ring)
+        return self._ring[position][1]
+
+
+class Membership(loggable.Loggable, threading.Thread):
+    """
+    Registration of this replica and view of all live replicas
+    """
+    # storage path for registrations of replicas
+    storage_path = '_scmt/members'
+    # storage path for issues forwarded to owners
+    queue_path = '_scmt/queue'
+    # replica is considered dead when it did not renew registration for this time
+    ttl = 30
+    # how often should registration be renewed and forwarded issues taken
+    heartbeat_interval = 10
+
+    def __init__(self, storage, node, clock=None):
+        threading.Thread.__init__(self, name='membership')
+        self.daemon = True
+        self.node = node
+        self.clock = clock or Clock()
+        self._storage = storage
+        self._session = None
+        self._domains = []
+        # domain => ring of replicas serving it
+        self._rings = {}
+        self._members = None
+        self._listeners = []
+        self._receiver = None
+        # hostname => time of forwarding, same hostname is not forwarded again during ttl
+        self._forwarded = {}
+        self._lock = threading.Lock()
+
+    def set_domains(self, domains):
+        self._domains = sorted(domains)
+
+    def add_listener(self, listener):
+        """
+        Add function called when ownership changes
+
+        :param listener:
+        :return:
+        """
+        self._listeners.append(listener)
+
+    def set_receiver(self, receiver):
+        """
+        Set function which receives hostname and force flag of issues forwarded by other replicas
+
+        :param receiver:
+        :return:
+        """
+        self._receiver = receiver
+
+    def get_member_path(self, node):
+        return self.storage_path + '/' + node
+
+    def get_queue_path(self, node):
+        return self.queue_path + '/' + node
+
+    def start(self):
+        """
+        Register and read members before ownership is used, then keep registration in background
+
+        :return:
+        """
+        try:
+            self.register()
+            self.refresh()
+        except (IndexError, IOError, ValueError) as e:
+            self.log("Failed to join cluster, all hostnames are owned until next heartbeat: %s" % str(e), level='warning')
+
+        atexit.register(self.leave)
+        threading.Thread.start(self)
+
+    def run(self):
+        while True:
+            self.clock.sleep(self.heartbeat_interval)
+            try:
+                self.register()
+                self.refresh()
+                self.receive()
+            except (IndexError, IOError, ValueError) as e:
+                self.log("Membership heartbeat failed: %s" % str(e), level='warning')
+
+    def register(self):
+        """
+        Write registration of this replica, bound to Consul session when storage supports sessions
+
+        :return:
+        """
+        data = json.dumps({'node': self.node, 'domains': self._domains, 'seen': self.clock.time()})
+        if not hasattr(self._storage, 'create_session'):
+            self._storage.write(self.get_member_path(self.node), data)
+            return
+
+        if self._session is not None and not self._storage.renew_session(self._session):
+            self.log("Session %s of %s expired" % (self._session, self.node), level='warning')
+            self._session = None
+
+        if self._session is None:
+            self._session = self._storage.create_session('scmt-' + self.node, self.ttl)
+
+        if not self._storage.write(self.get_member_path(self.node), data, session=self._session):
+            raise IOError("Failed to acquire registration of %s" % self.node)
+
+    def leave(self):
+        try:
+            if self._session is not None:
+                self._storage.destroy_session(self._session)
+            self._storage.delete(self.get_member_path(self.node))
+        except (IndexError, IOError):
+            pass
+
+    def refresh(self):
+        """
+        Read live members and rebuild rings, listeners are notified when members changed
+
+        :return: True when members changed
+        """
+        try:
+            nodes = self._storage.list(self.storage_path)
+        except IndexError:
+            nodes = []
+
+        members = {}
+        for node in nodes:
+            try:
+                member = json.loads(self._storage.read(self.get_member_path(node)))
+            except (IndexError, ValueError):
+                continue
+
+            # registrations bound to sessions are removed by storage itself
+            if self._session is None and member['seen'] < self.clock.time() - self.ttl:
+                continue
+            members[member['node']] = member['domains']
+
+        if members == self._members:
+            return False
+
+        rings = {}
+        for domain in self._domains:
+            rings[domain] = Ring([node for node in members if domain in members[node]])
+
+        with self._lock:
+            self._members = members
+            self._rings = rings
+
+        self.log("Cluster members changed: %s" % ', '.join(sorted(members)))
+        for listener in self._listeners:
+            listener()
+
+        return True
+
+    def owner(self, hostname, domain):
+        ring = self._rings.get(domain)
+        return ring.owner(hostname) if ring else None
+
+    def owns(self, hostname, domain):
+        """
+        Check if hostname should be served by this replica, hostnames are owned
+        when ring is unknown, so renewals don't stop when storage is unavailable
+
+        :param hostname:
+        :param domain:
+        :return:
+        """
+        owner = self.owner(hostname, domain)
+        return owner is None or owner == self.node
+
+    def forward(self, hostname, domain, force=False):
+        """
+        Queue issue for replica owning hostname
+
+        :param hostname:
+        :param domain:
+        :param force:
+        :return:
+        """
+        now = self.clock.time()
+        if not force and self._forwarded.get(hostname, 0) > now - self.ttl:
+            return
+
+        owner = self.owner(hostname, domain)
+        self.log("Forwarding issue of %s to %s" % (hostname, owner), level='debug')
+        self._storage.write(self.get_queue_path(owner) + '/' + hostname, '1' if force else '0')
+        self._forwarded[hostname] = now
+
+        for forwarded in self._forwarded.keys():
+            if self._forwarded[forwarded] < now - self.ttl:
+                self._forwarded.pop(forwarded, None)
+
+    def receive(self):
+        """
+        Pass issues forwarded to this replica to receiver
+
+        :return: number of received issues
+        """
+        path = self.get_queue_path(self.node)
+        try:
+            hostnames = self._storage.list(path)
+        except IndexError:
+            return 0
+
+        for hostname in hostnames:
+            try:
+                force = self._storage.read(path + '/' + hostname) == '1'
+            except IndexError:
+                continue
+
+            self._storage.delete(path + '/' + hostname)
+            if self._receiver:
+                self._receiver(hostname, force)
+
+        return len(hostnames)
@@ -1,4 +1,5 @@
 import loggable
+import socket
 import ConfigParser
 from ConfigParser import NoOptionError
 
@@ -37,6 +38,53 @@ class ConfigReader(loggable.Loggable):
             self.ssl = False
             self.log("SSL support disabled")
 
+        try:
+            self.issue_workers = parser.getint('general', 'issue_workers')
+            self.log("Issue workers %d" % self.issue_workers)
+        except NoOptionError:
+            self.issue_workers = 1
+
+        try:
+            self.cleanup_workers = parser.getint('general', 'cleanup_workers')
+            self.log("Clean-up workers %d" % self.cleanup_workers)
+        except NoOptionError:
+            self.cleanup_workers = 8
+
+        try:
+            self.init_workers = parser.getint('general', 'init_workers')
+            self.log("Domain initialization workers %d" % self.init_workers)
+        except NoOptionError:
+            self.init_workers = 8
+
+        try:
+            self.processes = parser.getint('general', 'processes')
+            self.log("Worker processes %d" % self.processes)
+        except NoOptionError:
+            self.processes = 1
+
+        try:
+            self.cluster_storage = parser.get('general', 'cluster_storage')
+            self.log("Sharing hostnames with other replicas through storage %s" % self.cluster_storage)
+        except NoOptionError:
+            self.cluster_storage = False
+
+        try:
+            self.node = parser.get('general', 'node')
+        except NoOptionError:
+            self.node = socket.gethostname()
+
+        try:
+            self.profile_interval = parser.getfloat('general', 'profile_interval')
+            self.log("Sampling profiler interval %.3f" % self.profile_interval)
+        except NoOptionError:
+            self.profile_interval = 0
+
+        try:
+            self.log_level = parser.get('general', 'log_level')
+            self.log("Log level %s" % self.log_level)
+        except NoOptionError:
+            self.log_level = 'info'
+
         sections = parser.sections()
         sections.remove('general')
 
@@ -1,2 +0,0 @@
-import cloudflare
-import wellknown
\ No newline at end of file
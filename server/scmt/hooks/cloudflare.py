@@ -1,18 +1,84 @@
-import dns.exception
-import dns.resolver
 import requests
-import urllib2
-import sys
-import time
+import requests.adapters
+import json
+import os
+import threading
+from multiprocessing.pool import ThreadPool
 from tld import get_tld
 import scmt.loggable
+import scmt.tracing
+from propagation import PropagationChecker, PropagationCoordinator
+
+
+class Batcher:
+    """
+    Group commit of API calls. Caller finding no call in progress sends its item
+    at once, items submitted while call is in progress are sent together by next
+    call, so concurrent issues share API requests without waiting for window
+    """
+    def __init__(self, send):
+        # function called with list of items
+        self._send = send
+        self._pending = []
+        self._running = False
+        self._lock = threading.Condition()
+
+    def submit(self, item):
+        """
+        Send item together with items of other callers, error of batch is raised in every caller
+
+        :param item:
+        :return:
+        """
+        entry = {'item': item, 'done': False, 'error': None}
+        with self._lock:
+            self._pending.append(entry)
+            while self._running and not entry['done']:
+                self._lock.wait()
+
+            if entry['done']:
+                if entry['error'] is not None:
+                    raise entry['error']
+                return
+
+            self._running = True
+            batch, self._pending = self._pending, []
+
+        try:
+            self._send([pending['item'] for pending in batch])
+        except Exception as e:
+            self._finish(batch, e)
+            raise
+
+        self._finish(batch, None)
+
+    def _finish(self, batch, error):
+        with self._lock:
+            for entry in batch:
+                entry['done'] = True
+                entry['error'] = error
+            self._running = False
+            self._lock.notify_all()
 
 
 class Cloudflare(scmt.loggable.Loggable):
     api_url = 'https://api.cloudflare.com/client/v4/'
+    # max number of records sent in one batch request
+    batch_size = 100
+    # number of parallel API calls used for bulk operations
+    workers = 8
 
-    def __init__(self, options):
+    def __init__(self, options, storage=None):
         self._zoneCache = {}
+        self._zoneLock = threading.Lock()
+        # created challenge records, (name, token) => (zone_id, record_id)
+        self._records = {}
+        self._recordsLock = threading.Lock()
+        # zones already cleaned by verify, hook is shared by domains with same credentials
+        self._verified = set()
+        # challenges of concurrent issues are created and removed in shared batches
+        self._deploys = Batcher(self.deploy_challenges)
+        self._cleans = Batcher(self.clean_challenges)
 
         if 'email' not in options:
             raise RuntimeError("CloudFlare Hook Error. No Email provided.")
@@ -27,6 +93,39 @@ class Cloudflare(scmt.loggable.Loggable):
         else:
             self._dns = options['dns'].split(',')
 
+        nameservers = None
+        if 'nameservers' in options:
+            nameservers = []
+            for ns in options['nameservers'].split(','):
+                ip, _, port = ns.strip().partition(':')
+                nameservers.append((ip, int(port or 53)))
+
+        self._checker = PropagationChecker(resolvers=self._dns, nameservers=nameservers)
+        self._coordinator = PropagationCoordinator(self._checker)
+        if 'propagation_window' in options:
+            self._coordinator.window = float(options['propagation_window'])
+
+        if 'workers' in options:
+            self.workers = int(options['workers'])
+
+        if 'batch_size' in options:
+            self.batch_size = int(options['batch_size'])
+
+        if 'zone_cache' in options:
+            self._zone_cache_path = options['zone_cache']
+        elif 'dir' in options:
+            self._zone_cache_path = options['dir'] + '/cloudflare-zones.json'
+        else:
+            self._zone_cache_path = None
+
+        self._load_zone_cache()
+
+        self._session = requests.Session()
+        self._session.headers.update(self.get_headers())
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.workers)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+
         self.log("CloudFlare hook initialized, Email: %s" % self._email)
         self._timeout = 1800
         self._net_timeout = 120
@@ -38,85 +137,205 @@ class Cloudflare(scmt.loggable.Loggable):
             'Content-Type': 'application/json',
         }
 
-    def _propagated(self, name, token):
-        txt_records = []
+    def _load_zone_cache(self):
+        if not self._zone_cache_path or not os.path.exists(self._zone_cache_path):
+            return
+
         try:
-            if self._dns:
-                custom_resolver = dns.resolver.Resolver()
-                custom_resolver.nameservers = self._dns
-                dns_response = custom_resolver.query(name, 'TXT')
-            else:
-                dns_response = dns.resolver.query(name, 'TXT')
+            with open(self._zone_cache_path, 'r') as cache_file:
+                self._zoneCache = json.load(cache_file)
+        except (IOError, ValueError) as e:
+            self.log("Failed to load zone cache from %s: %s" % (self._zone_cache_path, str(e)))
+            return
 
-            for rdata in dns_response:
-                for txt_record in rdata.strings:
-                    txt_records.append(txt_record)
-        except dns.exception.DNSException:
-            return False
+        self.log("Loaded %d zone IDs from %s" % (len(self._zoneCache), self._zone_cache_path))
 
-        for txt_record in txt_records:
-            if txt_record == token:
-                return True
+    def _save_zone_cache(self):
+        if not self._zone_cache_path:
+            return
+
+        tmp_path = '%s.%d.tmp' % (self._zone_cache_path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as cache_file:
+                json.dump(self._zoneCache, cache_file)
+            os.rename(tmp_path, self._zone_cache_path)
+        except (IOError, OSError) as e:
+            self.log("Failed to save zone cache to %s: %s" % (self._zone_cache_path, str(e)))
+
+    def _call(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self._net_timeout)
+        r = self._session.request(method, self.get_full_url(url), **kwargs)
+        r.raise_for_status()
 
-        return False
+        return r.json()
 
     def _get_zone_id(self, domain):
         tld = get_tld('http://' + domain)
-        if tld in self._zoneCache:
-            return self._zoneCache[tld]
+        with self._zoneLock:
+            if tld in self._zoneCache:
+                return self._zoneCache[tld]
 
-        url = self.get_full_url("zones?name={0}").format(tld)
-        r = requests.get(url, headers=self.get_headers())
-        r.raise_for_status()
-
-        id = r.json()['result'][0]['id']
+        id = self._call('GET', "zones?name={0}".format(tld))['result'][0]['id']
         self.log("Zone ID for %s is %s" % (domain, id))
 
-        self._zoneCache[tld] = id
+        with self._zoneLock:
+            self._zoneCache[tld] = id
+            self._save_zone_cache()
 
         return id
 
     def _get_txt_record_id(self, zone_id, name, token):
-        url = self.get_full_url("zones/{0}/dns_records?type=TXT&name={1}&content={2}").format(zone_id, name, token)
-        r = requests.get(url, headers=self.get_headers())
-        r.raise_for_status()
+        url = "zones/{0}/dns_records?type=TXT&name={1}&content={2}".format(zone_id, name, token)
         try:
-            record_id = r.json()['result'][0]['id']
+            record_id = self._call('GET', url)['result'][0]['id']
         except IndexError:
             self.log("Unable to locate record named {0}".format(name))
             return
 
         return record_id
 
-    def deploy_challenge(self, domain, token, key_authorization = ''):
-        self.log("Creating new TXT record %s, token %s" % (domain, token))
-        zone_id = self._get_zone_id(domain)
-        name = "{0}.{1}".format('_acme-challenge', domain)
-        url = self.get_full_url("zones/{0}/dns_records").format(zone_id)
-        payload = {
-            'type': 'TXT',
-            'name': name,
-            'content': token,
-            'ttl': 1,
-        }
+    def _map(self, func, items):
+        """
+        Run func over items using bounded pool of API workers
 
-        headers = self.get_headers()
-        r = requests.post(url, headers=headers, json=payload)
-        r.raise_for_status()
-        record_id = r.json()['result']['id']
+        :param func:
+        :param items:
+        :return:
+        """
+        if len(items) <= 1:
+            return [func(item) for item in items]
 
-        self.log("Created new TXT record: %s" % record_id)
-        time.sleep(10)
+        pool = ThreadPool(min(self.workers, len(items)))
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+            pool.join()
 
-        end_time = time.time() + self._timeout
-        started = time.time()
-        while time.time() < end_time:
-            if self._propagated(name, token):
-                self.log("Domain %s propagated successfully" % domain)
-                break
+    def _batch(self, zone_id, posts=None, deletes=None):
+        """
+        Create and delete records of one zone using batch API, falls back to
+        parallel single record requests when batch API is not available
+
+        :param zone_id:
+        :param posts: list of record payloads to create
+        :param deletes: list of record IDs to delete
+        :return: list of created records IDs, records already created are removed when request fails
+        """
+        posts = posts or []
+        deletes = deletes or []
+        created = []
+
+        try:
+            for offset in range(0, max(len(posts), len(deletes)), self.batch_size):
+                posts_chunk = posts[offset:offset + self.batch_size]
+                deletes_chunk = deletes[offset:offset + self.batch_size]
+                payload = {
+                    'posts': posts_chunk,
+                    'deletes': [{'id': record_id} for record_id in deletes_chunk]
+                }
+
+                try:
+                    result = self._call('POST', "zones/{0}/dns_records/batch".format(zone_id), json=payload)['result']
+                except requests.HTTPError as e:
+                    self.log("Batch request failed for zone %s (%s), using single requests" % (zone_id, str(e)))
+                    created += self._create_records(zone_id, posts_chunk)
+                    self._map(lambda record_id: self._delete_record(zone_id, record_id), deletes_chunk)
+                    continue
+
+                created += [record['id'] for record in (result.get('posts') or [])]
+        except Exception:
+            self._rollback(zone_id, created)
+            raise
+
+        return created
+
+    def _create_records(self, zone_id, posts):
+        """
+        Create records by single requests, records created before failure are removed
+
+        :param zone_id:
+        :param posts: list of record payloads
+        :return: list of created records IDs
+        """
+        def create(post):
+            try:
+                return self._call('POST', "zones/{0}/dns_records".format(zone_id), json=post)['result']['id'], None
+            except Exception as e:
+                return None, e
+
+        results = self._map(create, posts)
+        errors = [error for record_id, error in results if error is not None]
+        if errors:
+            self._rollback(zone_id, [record_id for record_id, error in results if record_id])
+            raise errors[0]
+
+        return [record_id for record_id, error in results]
+
+    def _rollback(self, zone_id, created):
+        def delete(record_id):
+            try:
+                self._delete_record(zone_id, record_id)
+            except requests.RequestException as e:
+                self.log("Failed to remove record %s of failed request: %s" % (record_id, str(e)), level='warning')
+
+        if created:
+            self.log("Removing %d records created by failed request in zone %s" % (len(created), zone_id))
+            self._map(delete, created)
+
+    def deploy_challenges(self, challenges):
+        """
+        Create TXT records for list of challenges at once
+
+        :param challenges: list of (domain, token) tuples
+        :return: list of challenge record names
+        """
+        zones = {}
+        names = []
+        for domain, token in challenges:
+            name = self.get_record_name(domain)
+            names.append(name)
+            zones.setdefault(self._get_zone_id(domain), []).append((name, token))
+
+        created = {}
+        try:
+            for zone_id in zones:
+                records = zones[zone_id]
+                self.log("Creating %d TXT records in zone %s" % (len(records), zone_id))
+                created[zone_id] = self._batch(zone_id, posts=[{
+                    'type': 'TXT',
+                    'name': name,
+                    'content': token,
+                    'ttl': 1,
+                } for name, token in records])
+                self.log("Created new TXT records: %s" % ", ".join(created[zone_id]))
+        except Exception:
+            # records of zones created before failure are removed too, caller cleans nothing after error
+            for zone_id in created:
+                self._rollback(zone_id, created[zone_id])
+            raise
+
+        with self._recordsLock:
+            for zone_id in created:
+                for record, record_id in zip(zones[zone_id], created[zone_id]):
+                    self._records[record] = (zone_id, record_id)
+
+        return names
+
+    def get_record_name(self, domain):
+        return "{0}.{1}".format('_acme-challenge', domain)
+
+    def deploy_challenge(self, domain, token, key_authorization = ''):
+        self.log("Creating new TXT record %s, token %s" % (domain, token))
+        with scmt.tracing.span('cloudflare.deploy'):
+            self._deploys.submit((domain, token))
+        name = self.get_record_name(domain)
 
-            self.log("DNS not propagated, waiting 30s, total time: %d..." % (time.time() - started))
-            time.sleep(30)
+        with scmt.tracing.span('dns.propagation', record=name):
+            propagated = self._coordinator.wait(self._get_zone_id(domain), name, token, timeout=self._timeout)
+
+        if propagated:
+            self.log("Domain %s propagated successfully" % domain)
 
     def verify(self, domain):
         """
@@ -124,14 +343,24 @@ class Cloudflare(scmt.loggable.Loggable):
 
         :return:
         """
-        records = self.get_records(domain)
-        self.log("Cleanup old data to prevent errors. Total domains: %d" % len(records))
-
         zone_id = self._get_zone_id(domain)
-        for i in self.get_records(domain):
-            if i['name'][:16] == '_acme-challenge.':
-                self.log("Remove old acme challenge record: %s" % i['name'])
-                self._delete_record(zone_id, i['id'])
+        with self._zoneLock:
+            if zone_id in self._verified:
+                return True
+            self._verified.add(zone_id)
+
+        try:
+            records = self.get_records(domain)
+            self.log("Cleanup old data to prevent errors. Total domains: %d" % len(records))
+
+            stale = [i['id'] for i in records if i['name'][:16] == '_acme-challenge.']
+            if stale:
+                self.log("Remove %d old acme challenge records" % len(stale))
+                self._batch(zone_id, deletes=stale)
+        except:
+            with self._zoneLock:
+                self._verified.discard(zone_id)
+            raise
 
         return True
 
@@ -141,10 +370,7 @@ class Cloudflare(scmt.loggable.Loggable):
 
         items = []
         while True:
-            r = requests.get(self.get_full_url('zones/%s/dns_records?type=TXT&per_page=100&page=%d' % (id, page)), headers=self.get_headers())
-            r.raise_for_status()
-
-            result = r.json()
+            result = self._call('GET', 'zones/%s/dns_records?type=TXT&per_page=100&page=%d' % (id, page))
 
             for record in result['result']:
                 items.append({
@@ -152,28 +378,58 @@ class Cloudflare(scmt.loggable.Loggable):
                     'name': record['name']
                 })
             page += 1
-            if int(result['result_info']['total_pages']) <= page:
+            if int(result['result_info']['total_pages']) < page:
                 break
 
         return items
 
-    def clean_challenge(self, domain, token):
-        zone_id = self._get_zone_id(domain)
-        name = "{0}.{1}".format('_acme-challenge', domain)
-        record_id = self._get_txt_record_id(zone_id, name, token)
+    def clean_challenges(self, challenges):
+        """
+        Remove TXT records for list of challenges at once
 
-        self.log("Deleting TXT record name: %s" % name)
-        url = self.get_full_url("zones/{0}/dns_records/{1}").format(zone_id, record_id)
-        r = requests.delete(url, headers=self.get_headers(), timeout=self._net_timeout)
-        r.raise_for_status()
+        :param challenges: list of (domain, token) tuples
+        :return:
+        """
+        zones = {}
+        for domain, token in challenges:
+            name = self.get_record_name(domain)
+            with self._recordsLock:
+                known = self._records.pop((name, token), None)
+
+            if known:
+                zone_id, record_id = known
+            else:
+                zone_id = self._get_zone_id(domain)
+                record_id = self._get_txt_record_id(zone_id, name, token)
+
+            if not record_id:
+                continue
+
+            self.log("Deleting TXT record name: %s" % name)
+            zones.setdefault(zone_id, []).append(record_id)
+
+        for zone_id in zones:
+            self._batch(zone_id, deletes=zones[zone_id])
+
+    def clean_challenge(self, domain, token):
+        with scmt.tracing.span('cloudflare.clean'):
+            self._cleans.submit((domain, token))
 
     def _delete_record(self, zone_id, record_id):
-        url = self.get_full_url("zones/%s/dns_records/%s" % (zone_id, record_id))
-        r = requests.delete(url, headers=self.get_headers(), timeout=self._net_timeout)
-        r.raise_for_status()
+        self._call('DELETE', "zones/%s/dns_records/%s" % (zone_id, record_id))
 
     def get_full_url(self, url):
         return self.api_url + url
 
     def get_challenge_type(self):
-        return 'dns-01'
\ No newline at end of file
+        return 'dns-01'
+
+    def set_clock(self, clock):
+        """
+        Set time source of propagation polling
+
+        :param clock:
+        :return:
+        """
+        self._checker.clock = clock
+        self._coordinator.clock = clock
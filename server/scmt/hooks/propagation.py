@@ -0,0 +1,307 @@
+import dns.exception
+import dns.flags
+import dns.message
+import dns.name
+import dns.query
+import dns.rdatatype
+import dns.resolver
+import errno
+import select
+import socket
+import threading
+import time
+import scmt.clock
+import scmt.loggable
+
+
+class PropagationChecker(scmt.loggable.Loggable):
+    """
+    Check that TXT records are served by every authoritative nameserver of zone.
+    All names are queried against all nameservers in one pass, queries are sent
+    in parallel over one UDP socket per nameserver.
+    """
+    # timeout for one pass of queries
+    query_timeout = 2
+    # delay between passes while waiting for propagation
+    interval = 5
+    # for how long should we keep discovered nameservers
+    ns_cache_time = 3600
+    # time source of propagation polling
+    clock = scmt.clock.DEFAULT
+
+    def __init__(self, resolvers=None, nameservers=None, port=53):
+        """
+        :param resolvers: recursive resolvers used to discover zone and its nameservers
+        :param nameservers: static list of (ip, port) nameservers, skips discovery
+        :param port: DNS port of authoritative nameservers
+        """
+        self._resolvers = resolvers
+        self._nameservers = nameservers
+        self._port = port
+        self._cache = {}
+        self._cacheLock = threading.Lock()
+
+    def _resolver(self):
+        resolver = dns.resolver.Resolver()
+        if self._resolvers:
+            resolver.nameservers = self._resolvers
+        resolver.lifetime = self.query_timeout * 2
+
+        return resolver
+
+    def get_zone(self, name):
+        """
+        Detect zone which contains name
+
+        :param name:
+        :return:
+        """
+        return dns.resolver.zone_for_name(name, resolver=self._resolver()).to_text()
+
+    def get_nameservers(self, zone):
+        """
+        Get list of authoritative nameservers addresses for zone
+
+        :param zone:
+        :return: list of (ip, port) tuples
+        """
+        if self._nameservers:
+            return self._nameservers
+
+        with self._cacheLock:
+            if zone in self._cache and self._cache[zone]['expire'] > self.clock.time():
+                return self._cache[zone]['value']
+
+        resolver = self._resolver()
+        nameservers = []
+        for ns in resolver.query(zone, 'NS'):
+            try:
+                for address in resolver.query(ns.target, 'A'):
+                    nameservers.append((address.address, self._port))
+            except dns.exception.DNSException as e:
+                self.log("Failed to resolve nameserver %s: %s" % (ns.target, str(e)))
+
+        if not nameservers:
+            raise RuntimeError("No authoritative nameservers found for %s" % zone)
+
+        self.log("Authoritative nameservers for %s: %s" % (zone, ", ".join([ip for ip, port in nameservers])))
+        with self._cacheLock:
+            self._cache[zone] = {'expire': self.clock.time() + self.ns_cache_time, 'value': nameservers}
+
+        return nameservers
+
+    def _served(self, response, tokens):
+        """
+        Check that response contains all expected tokens
+
+        :param response:
+        :param tokens: token or set of tokens, several challenges could share one name
+        :return:
+        """
+        if isinstance(tokens, basestring):
+            tokens = [tokens]
+
+        found = set()
+        for rrset in response.answer:
+            if rrset.rdtype != dns.rdatatype.TXT:
+                continue
+
+            for rdata in rrset:
+                found.update(rdata.strings)
+
+        return set(tokens) <= found
+
+    def check(self, records, nameservers):
+        """
+        Query every nameserver for every record once
+
+        :param records: dict name => expected TXT token or set of tokens
+        :param nameservers: list of (ip, port) tuples
+        :return: set of names served by all nameservers
+        """
+        pending = {}
+        sockets = []
+        served = {}
+
+        try:
+            for nameserver in nameservers:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                sock.setblocking(0)
+                sockets.append(sock)
+
+                for name in records:
+                    query = dns.message.make_query(name, 'TXT')
+                    # ids of different names could collide, question tells them apart
+                    pending[(sock.fileno(), query.id, query.question[0].name)] = (nameserver, name, query)
+                    try:
+                        sock.sendto(query.to_wire(), nameserver)
+                    except socket.error as e:
+                        self.log("Failed to query %s for %s: %s" % (nameserver[0], name, str(e)))
+
+            deadline = time.time() + self.query_timeout
+            while pending and time.time() < deadline:
+                readable = select.select(sockets, [], [], max(0, deadline - time.time()))[0]
+                for sock in readable:
+                    try:
+                        wire = sock.recv(65535)
+                    except socket.error as e:
+                        if e.errno in (errno.EAGAIN, errno.ECONNREFUSED):
+                            continue
+                        raise
+
+                    try:
+                        response = dns.message.from_wire(wire)
+                    except dns.exception.DNSException:
+                        continue
+
+                    if not response.question:
+                        continue
+
+                    # response should answer the same question, otherwise it is stray or spoofed
+                    key = (sock.fileno(), response.id, response.question[0].name)
+                    if key not in pending or not pending[key][2].is_response(response):
+                        continue
+
+                    nameserver, name, query = pending.pop(key)
+                    if response.flags & dns.flags.TC:
+                        try:
+                            response = dns.query.tcp(query, nameserver[0], timeout=self.query_timeout, port=nameserver[1])
+                        except (dns.exception.DNSException, socket.error):
+                            continue
+
+                    if self._served(response, records[name]):
+                        served[name] = served.get(name, 0) + 1
+        finally:
+            for sock in sockets:
+                sock.close()
+
+        return set([name for name in served if served[name] == len(nameservers)])
+
+    def wait(self, records, zone=None, timeout=1800):
+        """
+        Wait until all records are served by all authoritative nameservers
+
+        :param records: dict name => expected TXT token or set of tokens
+        :param zone: zone name, detected from first record when not specified
+        :param timeout:
+        :return: True when all records propagated
+        """
+        return not self.pending(records, zone, timeout)
+
+    def pending(self, records, zone=None, timeout=1800):
+        """
+        Wait for records propagation, same as wait() but reports which records are not propagated
+
+        :param records: dict name => expected TXT token or set of tokens
+        :param zone: zone name, detected from first record when not specified
+        :param timeout:
+        :return: set of names which are not propagated in time
+        """
+        records = dict(records)
+        if not records:
+            return set()
+
+        try:
+            nameservers = self._nameservers or self.get_nameservers(zone or self.get_zone(records.keys()[0]))
+        except (dns.exception.DNSException, RuntimeError) as e:
+            self.log("Failed to detect authoritative nameservers: %s, using resolvers" % str(e))
+            nameservers = [(ip, 53) for ip in (self._resolvers or self._resolver().nameservers)]
+
+        started = self.clock.time()
+        while True:
+            for name in self.check(records, nameservers):
+                del records[name]
+
+            if not records:
+                self.log("All records propagated in %d sec" % (self.clock.time() - started))
+                return set()
+
+            if self.clock.time() - started > timeout:
+                self.log("DNS propagation timeout, %d records pending" % len(records))
+                return set(records.keys())
+
+            self.log("DNS not propagated for %d records, total time: %d..." % (len(records), self.clock.time() - started))
+            self.clock.sleep(self.interval)
+
+
+class PropagationCoordinator(scmt.loggable.Loggable):
+    """
+    Wait for propagation of challenges of one zone with shared DNS sweeps. Caller
+    finding no sweep of its zone running starts one at once, challenges deployed
+    while sweep is running are grouped and checked together by next sweep, so
+    single issue worker waits for nothing and concurrent issues share queries.
+    First caller of a group becomes its leader and runs the checker, others wait
+    for the result.
+    """
+    # for how long should leader collect more challenges before checking, grouping
+    # needs no window, it only makes groups bigger when issues start at once
+    window = 0
+    # time source of grouping window
+    clock = scmt.clock.DEFAULT
+
+    def __init__(self, checker):
+        self._checker = checker
+        # zone => group collecting records for next sweep
+        self._groups = {}
+        # zones with running sweep
+        self._running = set()
+        self._lock = threading.Condition()
+
+    def wait(self, zone, name, token, timeout=1800):
+        """
+        Wait until record is propagated, record is propagated when all tokens of its name are served
+
+        :param zone: grouping key, challenges in one zone share nameservers
+        :param name:
+        :param token:
+        :param timeout:
+        :return: True when record propagated
+        """
+        with self._lock:
+            group = self._groups.get(zone)
+            leader = group is None
+            if leader:
+                group = {
+                    'records': {},
+                    'pending': set(),
+                    'error': None,
+                    'done': threading.Event()
+                }
+                self._groups[zone] = group
+
+            # example.com and *.example.com share one name, both tokens should be served
+            group['records'].setdefault(name, set()).add(token)
+
+        if leader:
+            self._lead(zone, group, timeout)
+        else:
+            group['done'].wait()
+
+        if group['error']:
+            raise group['error']
+
+        return name not in group['pending']
+
+    def _lead(self, zone, group, timeout):
+        # group keeps collecting records while previous sweep of zone is running
+        with self._lock:
+            while zone in self._running:
+                self._lock.wait()
+
+        if self.window:
+            self.clock.sleep(self.window)
+
+        with self._lock:
+            del self._groups[zone]
+            self._running.add(zone)
+
+        self.log("Checking propagation of %d records in zone %s" % (len(group['records']), zone))
+        try:
+            group['pending'] = self._checker.pending(group['records'], timeout=timeout)
+        except Exception as e:
+            group['error'] = e
+        finally:
+            with self._lock:
+                self._running.discard(zone)
+                self._lock.notify_all()
+            group['done'].set()
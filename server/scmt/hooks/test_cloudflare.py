@@ -0,0 +1,139 @@
+import threading
+import unittest
+import urlparse
+
+import requests
+
+import cloudflare
+
+
+class Response:
+    def __init__(self, code, result, **extra):
+        self.status_code = code
+        self.body = dict({'success': code < 400, 'result': result}, **extra)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError("%d error" % self.status_code)
+
+    def json(self):
+        return self.body
+
+
+class StubSession:
+    """
+    Cloudflare API answering from memory, batch API and creation of some
+    records could be disabled
+    """
+    def __init__(self, batch=True, failing=()):
+        self.batch = batch
+        self.failing = failing
+        self.records = {}
+        self.calls = []
+        self._lock = threading.Lock()
+        self._next_id = 0
+
+    def request(self, method, url, json=None, **kwargs):
+        parsed = urlparse.urlparse(url)
+        parts = parsed.path[len('/client/v4/'):].split('/')
+        query = urlparse.parse_qs(parsed.query)
+        with self._lock:
+            self.calls.append((method, '/'.join(parts)))
+
+            if parts == ['zones']:
+                return Response(200, [{'id': 'zone'}])
+            if method == 'GET':
+                per_page, page = int(query['per_page'][0]), int(query['page'][0])
+                records = sorted(self.records.values(), key=lambda record: record['id'])
+                return Response(200, records[(page - 1) * per_page:page * per_page],
+                                result_info={'total_pages': (len(records) + per_page - 1) // per_page})
+            if method == 'DELETE':
+                self.records.pop(parts[-1], None)
+                return Response(200, {'id': parts[-1]})
+            if parts[-1] == 'batch':
+                if not self.batch:
+                    return Response(404, None)
+                for record in json['deletes']:
+                    self.records.pop(record['id'], None)
+                return Response(200, {'posts': [self.create(post) for post in json['posts']]})
+
+            if json['content'] in self.failing:
+                return Response(500, None)
+            return Response(200, self.create(json))
+
+    def create(self, post):
+        self._next_id += 1
+        record = dict(post, id='%04d' % self._next_id)
+        self.records[record['id']] = record
+        return record
+
+
+class CloudflareTestCase(unittest.TestCase):
+    def hook(self, session):
+        hook = cloudflare.Cloudflare({'email': 'test@example.com', 'key': 'key'})
+        hook._session = session
+        return hook
+
+    def test_batch(self):
+        session = StubSession()
+        hook = self.hook(session)
+
+        hook.deploy_challenges([('a.example.com', 'token-a'), ('b.example.com', 'token-b')])
+        self.assertEqual(sorted([(record['name'], record['content']) for record in session.records.values()]),
+                         [('_acme-challenge.a.example.com', 'token-a'), ('_acme-challenge.b.example.com', 'token-b')])
+
+        hook.clean_challenges([('a.example.com', 'token-a'), ('b.example.com', 'token-b')])
+        self.assertEqual(session.records, {})
+        self.assertEqual(len([call for call in session.calls if call[0] == 'POST']), 2)
+
+    def test_single_requests_rolled_back(self):
+        session = StubSession(batch=False, failing=['token-b'])
+        hook = self.hook(session)
+
+        self.assertRaises(requests.HTTPError, hook.deploy_challenges,
+                          [('a.example.com', 'token-a'), ('b.example.com', 'token-b'), ('c.example.com', 'token-c')])
+        # records created before failure are removed
+        self.assertEqual(session.records, {})
+
+        session.failing = []
+        hook.deploy_challenges([('a.example.com', 'token-a')])
+        self.assertEqual(len(session.records), 1)
+
+    def test_get_records_pages(self):
+        session = StubSession()
+        hook = self.hook(session)
+        for i in range(250):
+            session.create({'type': 'TXT', 'name': 'host%d.example.com' % i, 'content': 'x'})
+
+        self.assertEqual(len(hook.get_records('example.com')), 250)
+        self.assertEqual(len([call for call in session.calls if call[0] == 'GET' and call[1] != 'zones']), 3)
+
+    def test_concurrent_challenges_share_call(self):
+        sent = []
+        release = threading.Event()
+
+        def send(items):
+            sent.append(items)
+            release.wait(5)
+
+        batcher = cloudflare.Batcher(send)
+        first = threading.Thread(target=batcher.submit, args=('a',))
+        first.start()
+        while not sent:
+            first.join(0.001)
+
+        # submitted while first call runs, sent together by one call
+        waiters = [threading.Thread(target=batcher.submit, args=(item,)) for item in ['b', 'c']]
+        for waiter in waiters:
+            waiter.start()
+        while len(batcher._pending) < 2:
+            first.join(0.001)
+        release.set()
+        for thread in [first] + waiters:
+            thread.join(5)
+
+        self.assertEqual(sent, [['a'], ['b', 'c']])
+
+
+if __name__ == '__main__':
+    unittest.main()
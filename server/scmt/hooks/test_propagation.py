@@ -0,0 +1,183 @@
+import unittest
+import socket
+import threading
+import dns.message
+import dns.name
+import dns.rrset
+import propagation
+
+
+class StubNameserver(threading.Thread):
+    """
+    Minimal authoritative nameserver answering TXT queries from dict
+    """
+    def __init__(self, records):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.records = records
+        # answer every query as if it asked for this name
+        self.spoof = None
+        self.queries = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.address = self.sock.getsockname()
+
+    def run(self):
+        while True:
+            try:
+                wire, client = self.sock.recvfrom(65535)
+            except socket.error:
+                return
+
+            self.queries += 1
+            query = dns.message.from_wire(wire)
+            response = dns.message.make_response(query)
+            name = query.question[0].name.to_text()
+            if self.spoof:
+                name = self.spoof
+                response.question = [dns.rrset.RRset(dns.name.from_text(name), query.question[0].rdclass,
+                                                     query.question[0].rdtype)]
+            if name in self.records:
+                tokens = self.records[name] if isinstance(self.records[name], list) else [self.records[name]]
+                response.answer.append(dns.rrset.from_text(name, 1, 'IN', 'TXT', *['"%s"' % token for token in tokens]))
+
+            self.sock.sendto(response.to_wire(), client)
+
+    def stop(self):
+        self.sock.close()
+
+
+class PropagationCheckerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.servers = [StubNameserver({}), StubNameserver({})]
+        for server in self.servers:
+            server.start()
+
+        self.checker = propagation.PropagationChecker(nameservers=[s.address for s in self.servers])
+        self.checker.query_timeout = 0.5
+        self.checker.interval = 0.1
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+
+    def test_check_requires_all_nameservers(self):
+        records = {'_acme-challenge.a.example.com.': 'token-a', '_acme-challenge.b.example.com.': 'token-b'}
+        self.servers[0].records.update(records)
+        self.servers[1].records['_acme-challenge.a.example.com.'] = 'token-a'
+
+        served = self.checker.check(records, self.checker.get_nameservers('example.com.'))
+        self.assertEqual(set(['_acme-challenge.a.example.com.']), served)
+        self.assertEqual(2, self.servers[0].queries)
+
+    def test_response_for_other_question_is_ignored(self):
+        for server in self.servers:
+            server.records['_acme-challenge.b.example.com.'] = 'token-a'
+            server.spoof = '_acme-challenge.b.example.com.'
+
+        served = self.checker.check({'_acme-challenge.a.example.com.': 'token-a'}, self.checker.get_nameservers('example.com.'))
+        self.assertEqual(set(), served)
+
+    def test_wrong_token_is_not_served(self):
+        for server in self.servers:
+            server.records['_acme-challenge.a.example.com.'] = 'old-token'
+
+        self.assertFalse(self.checker.wait({'_acme-challenge.a.example.com.': 'token-a'}, zone='example.com.', timeout=0.3))
+
+    def test_wait_returns_when_propagated(self):
+        records = dict(('_acme-challenge.h%d.example.com.' % i, 'token%d' % i) for i in range(50))
+        self.servers[0].records.update(records)
+
+        def propagate():
+            self.servers[1].records.update(records)
+
+        timer = threading.Timer(0.2, propagate)
+        timer.start()
+
+        self.assertTrue(self.checker.wait(records, zone='example.com.', timeout=5))
+        timer.join()
+
+
+class PropagationCoordinatorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = StubNameserver({})
+        self.server.start()
+
+        self.checker = propagation.PropagationChecker(nameservers=[self.server.address])
+        self.checker.query_timeout = 0.5
+        self.checker.interval = 0.1
+        self.coordinator = propagation.PropagationCoordinator(self.checker)
+        self.coordinator.window = 0.2
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_concurrent_challenges_share_one_sweep(self):
+        names = ['_acme-challenge.h%d.example.com.' % i for i in range(20)]
+        for name in names[:-1]:
+            self.server.records[name] = 'token'
+
+        results = {}
+
+        def deploy(name):
+            results[name] = self.coordinator.wait('example.com', name, 'token', timeout=0.3)
+
+        threads = [threading.Thread(target=deploy, args=(name,)) for name in names]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(names), len(results))
+        self.assertFalse(results[names[-1]])
+        self.assertTrue(all([results[name] for name in names[:-1]]))
+        # one query per record for first pass plus retries of the missing record only
+        self.assertTrue(self.server.queries < len(names) * 2)
+
+    def test_challenges_deployed_during_sweep_share_next_one(self):
+        self.coordinator.window = 0
+        names = ['_acme-challenge.h%d.example.com.' % i for i in range(10)]
+        for name in names:
+            self.server.records[name] = 'token'
+
+        sweeps = []
+        pending = self.checker.pending
+        self.checker.pending = lambda records, timeout: sweeps.append(sorted(records)) or pending(records, timeout=timeout)
+
+        results = {}
+        missing = threading.Thread(target=lambda: results.update(
+            missing=self.coordinator.wait('example.com', '_acme-challenge.missing.example.com.', 'token', timeout=0.3)))
+        missing.start()
+        while not sweeps:
+            missing.join(0.001)
+
+        threads = [threading.Thread(target=lambda name=name: results.update({name: self.coordinator.wait(
+            'example.com', name, 'token', timeout=0.3)})) for name in names]
+        for thread in threads:
+            thread.start()
+        for thread in [missing] + threads:
+            thread.join()
+
+        # first challenge is checked at once, others wait for running sweep and share one
+        self.assertEqual(sweeps, [['_acme-challenge.missing.example.com.'], names])
+        self.assertFalse(results['missing'])
+        self.assertTrue(all([results[name] for name in names]))
+
+    def test_shared_name_requires_all_tokens(self):
+        name = '_acme-challenge.example.com.'
+        self.server.records[name] = ['token-host']
+        results = {}
+
+        def deploy(token):
+            results[token] = self.coordinator.wait('example.com', name, token, timeout=0.3)
+
+        threads = [threading.Thread(target=deploy, args=(token,)) for token in ['token-host', 'token-wildcard']]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual({'token-host': False, 'token-wildcard': False}, results)
+
+        self.server.records[name] = ['token-host', 'token-wildcard']
+        self.assertTrue(self.coordinator.wait('example.com', name, 'token-wildcard', timeout=0.3))
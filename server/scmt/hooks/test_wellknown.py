@@ -0,0 +1,108 @@
+import json
+import socket
+import time
+import unittest
+import httplib
+import scmt.clock
+import wellknown
+from scmt.storages.memory import MemoryStorage
+
+
+class ChallengeStoreTestCase(unittest.TestCase):
+    def test_clean_by_challenge_token(self):
+        store = wellknown.ChallengeStore()
+        store.add('acme-token', 'a.example.com', 'challenge-token', 'acme-token.thumbprint')
+        self.assertEqual('acme-token.thumbprint', store.get('acme-token')['key'])
+
+        self.assertTrue(store.remove('challenge-token'))
+        self.assertRaises(IndexError, store.get, 'acme-token')
+        self.assertEqual(0, len(store))
+
+    def test_expired_challenges_evicted(self):
+        store = wellknown.ChallengeStore(ttl=-1)
+        store.add('acme-token', 'a.example.com', 'challenge-token', 'acme-token.thumbprint')
+
+        self.assertRaises(IndexError, store.get, 'acme-token')
+        self.assertEqual(1, store.evict())
+        self.assertEqual(0, len(store))
+
+
+    def test_shared_between_replicas(self):
+        storage = MemoryStorage()
+        first = wellknown.ChallengeStore()
+        second = wellknown.ChallengeStore()
+        first.attach(storage)
+        second.attach(storage)
+
+        first.add('acme-token', 'a.example.com', 'challenge-token', 'acme-token.thumbprint', storage)
+        self.assertEqual('acme-token.thumbprint', second.get('acme-token')['key'])
+
+        second.remove('challenge-token')
+        self.assertEqual([], storage.keys())
+
+
+class WellKnownServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+
+    def test_keep_alive_requests(self):
+        store = wellknown.ChallengeStore()
+        server = wellknown.WellKnownServer.get('127.0.0.1', 0, store)
+        self.servers.append(server)
+        store.add('acme-token', 'a.example.com', 'challenge-token', 'acme-token.thumbprint')
+
+        connection = httplib.HTTPConnection('127.0.0.1', server.socket.getsockname()[1], timeout=5)
+        for i in range(3):
+            connection.request('GET', '/.well-known/acme-challenge/acme-token')
+            response = connection.getresponse()
+            self.assertEqual(200, response.status)
+            self.assertEqual('acme-token.thumbprint', response.read())
+
+        connection.request('GET', '/.well-known/acme-challenge/unknown')
+        response = connection.getresponse()
+        self.assertEqual(404, response.status)
+        response.read()
+        self.assertEqual(1, len([channel for channel in server.map.values()
+                                 if isinstance(channel, wellknown.WellKnownChannel)]))
+        connection.close()
+
+        client = socket.create_connection(('127.0.0.1', server.socket.getsockname()[1]), timeout=5)
+        client.sendall('garbage\r\n\r\n')
+        self.assertTrue(client.recv(1024).startswith('HTTP/1.1 400 Bad Request\r\n'))
+        client.close()
+
+    def test_hooks_have_own_stores(self):
+        first = wellknown.WellKnown({'host': '127.0.0.1', 'port': 0, 'ttl': 60})
+        second = wellknown.WellKnown({'host': '127.0.0.1', 'port': 0, 'ttl': 600})
+        server = wellknown.WellKnownServer.get('127.0.0.1', 0, first.challenges)
+        self.servers.append(server)
+
+        second.set_clock(scmt.clock.SimulatedClock(time.time()))
+        self.assertIsNot(first.challenges, second.challenges)
+        self.assertEqual((60, 600), (first.challenges.ttl, second.challenges.ttl))
+        self.assertIsNot(first.challenges.clock, second.challenges.clock)
+
+        # both hooks listen on the same address, so server answers from either store
+        second.challenges.add('acme-token', 'a.example.com', 'challenge-token', 'acme-token.thumbprint')
+        self.assertEqual((200, 'acme-token.thumbprint'), server.respond('/.well-known/acme-challenge/acme-token'))
+        self.assertEqual(404, server.respond('/.well-known/acme-challenge/unknown')[0])
+
+    def test_read_through_off_event_loop(self):
+        storage = MemoryStorage()
+        store = wellknown.ChallengeStore()
+        store.attach(storage)
+        server = wellknown.WellKnownServer('127.0.0.1', 0, store)
+        storage.write(store.storage_path + '/acme-token', json.dumps({
+            'domain': 'a.example.com', 'token': 'challenge-token', 'key': 'acme-token.thumbprint',
+            'created': time.time(), 'expire': time.time() + 60}))
+
+        self.assertIsNone(server.respond('/.well-known/acme-challenge/acme-token'))
+        self.assertEqual((200, 'acme-token.thumbprint'),
+                         server.respond('/.well-known/acme-challenge/acme-token', read_through=True))
+        # known challenges are answered by event loop
+        self.assertEqual((200, 'acme-token.thumbprint'), server.respond('/.well-known/acme-challenge/acme-token'))
+        server.close()
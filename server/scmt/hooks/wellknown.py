@@ -1,108 +1,534 @@
-import requests
-import time
-import sys
+import Queue
+import asynchat
+import asyncore
+import httplib
+import json
 import socket
+import sys
+import time
+import scmt.clock
 import scmt.loggable
+import scmt.tracing
 import threading
 
-import SocketServer
-import BaseHTTPServer
-import SimpleHTTPServer
-from SocketServer import ThreadingMixIn
 
+class ChallengeStore(scmt.loggable.Loggable):
+    """
+    Deployed HTTP challenges indexed by ACME token, entries expire after TTL.
+    Challenges are published to attached storages, so any scmt replica sharing
+    the storage can answer validation requests. Storages supporting watch()
+    are followed in background to keep local copy up to date, other misses are
+    read through from storage by worker threads of the server.
+    """
+    # storage path for shared challenges
+    storage_path = '_scmt/challenges'
+    # for how long should unknown tokens be remembered
+    miss_ttl = 5
+    # time source of challenges expiration
+    clock = scmt.clock.DEFAULT
+
+    def __init__(self, ttl=1800):
+        self.ttl = ttl
+        self._challenges = {}
+        # challenge token => ACME token, used to clean challenges
+        self._tokens = {}
+        self._misses = {}
+        self._storages = []
+        self._lock = threading.Lock()
+
+    def attach(self, storage):
+        """
+        Share challenges using storage
+
+        :param storage:
+        :return:
+        """
+        with self._lock:
+            if storage in self._storages:
+                return
 
-class WellKnownHttpHandler(SimpleHTTPServer.SimpleHTTPRequestHandler, scmt.loggable.Loggable):
-    # client IP detected by headers or directly
-    client_ip = '127.0.0.1'
-    answer = False
+            self._storages.append(storage)
 
-    def do_GET(self):
-        path_data = self.path.split("/")
-        if path_data[1] != '.well-known':
-            return self.fail()
+        if hasattr(storage, 'watch'):
+            watch_thread = threading.Thread(target=self._watch, args=(storage,), name='wellknown-watch')
+            watch_thread.daemon = True
+            watch_thread.start()
 
-        if path_data[2] == 'acme-test':
-            return self.ok('available')
+    def _set(self, key, challenge):
+        self._challenges[key] = challenge
+        self._tokens[challenge['token']] = key
+        self._misses.pop(key, None)
 
-        token = path_data[-1]
-        try:
-            reply = self.server.hook.get_challenge(token)
-        except IndexError:
-            return self.fail()
+    def add(self, key, domain, token, key_authorization, storage=None):
+        challenge = {
+            'domain': domain,
+            'token': token,
+            'key': key_authorization,
+            'created': self.clock.time(),
+            'expire': self.clock.time() + self.ttl
+        }
+
+        with self._lock:
+            self._set(key, dict(challenge, storage=storage))
+
+        if storage is not None:
+            storage.write(self.storage_path + '/' + key, json.dumps(challenge))
+
+    def knows(self, key):
+        return key in self._challenges
 
-        return self.ok(reply)
+    def needs_read(self, key):
+        """
+        Check if challenge is not known locally and should be read from storage
 
-    def ok(self, msg):
-        self.send_response(200)
-        self.send_header('Content-type', 'text/plain')
-        self.end_headers()
+        :param key:
+        :return:
+        """
+        return bool(self._storages) and key not in self._challenges and self._misses.get(key, 0) < self.clock.time()
 
-        self.wfile.write(msg)
+    def get(self, key):
+        """
+        Get challenge, blocks while challenge is read from storage
 
-    def do_HEAD(self):
-        return self.fail()
+        :param key:
+        :return:
+        """
+        challenge = self._challenges.get(key)
+        if not challenge and self._misses.get(key, 0) < self.clock.time():
+            challenge = self._read_through(key)
 
-    def do_POST(self):
-        return self.fail()
+        if not challenge or challenge['expire'] < self.clock.time():
+            raise IndexError("no such challenge %s" % key)
 
-    def fail(self):
-        self.send_response(404)
-        self.send_header('Content-type', 'text/plain')
-        self.end_headers()
+        return challenge
 
-        self.wfile.write("No such file or directory. Request to %s is invalid" % self.path)
+    def _read_through(self, key):
+        for storage in self._storages:
+            try:
+                challenge = json.loads(storage.read(self.storage_path + '/' + key))
+            except (IndexError, IOError, ValueError):
+                continue
 
+            with self._lock:
+                self._set(key, dict(challenge, storage=storage))
 
-class WellKnownHttpApi(ThreadingMixIn, BaseHTTPServer.HTTPServer, scmt.loggable.Loggable):
-    def __init__(self, server_address, RequestHandlerClass, bind_and_activate=True, hook=False):
-        self.hook = hook
-        BaseHTTPServer.HTTPServer.__init__(self, server_address, RequestHandlerClass, bind_and_activate)
+            return self._challenges[key]
+
+        self._misses[key] = self.clock.time() + self.miss_ttl
+        return None
+
+    def remove(self, token):
+        with self._lock:
+            key = self._tokens.pop(token, token)
+            challenge = self._challenges.pop(key, None)
+
+        if challenge and challenge['storage'] is not None:
+            challenge['storage'].delete(self.storage_path + '/' + key)
+
+        return challenge is not None
+
+    def _watch(self, storage):
+        """
+        Follow challenges published by other replicas
+
+        :param storage:
+        :return:
+        """
+        index = 0
+        while True:
+            try:
+                index, items = storage.watch(self.storage_path, index)
+            except (IndexError, IOError, ValueError) as e:
+                self.log("Failed to watch shared challenges: %s" % str(e))
+                time.sleep(5)
+                continue
+
+            remote = {}
+            for path in items:
+                try:
+                    remote[path.split('/')[-1]] = json.loads(items[path])
+                except ValueError:
+                    continue
+
+            with self._lock:
+                for key in remote:
+                    self._set(key, dict(remote[key], storage=storage))
+
+                for key in self._challenges.keys():
+                    if key not in remote and self._challenges[key]['storage'] is storage:
+                        self._tokens.pop(self._challenges.pop(key)['token'], None)
+
+    def evict(self):
+        """
+        Remove expired challenges
+
+        :return: number of removed challenges
+        """
+        now = self.clock.time()
+        with self._lock:
+            expired = [(key, self._challenges.pop(key)) for key in self._challenges.keys() if self._challenges[key]['expire'] < now]
+            for key, challenge in expired:
+                self._tokens.pop(challenge['token'], None)
+
+            for key in [key for key in self._misses if self._misses[key] < now]:
+                del self._misses[key]
+
+        for key, challenge in expired:
+            if challenge['storage'] is not None:
+                challenge['storage'].delete(self.storage_path + '/' + key)
+
+        return len(expired)
+
+    def __len__(self):
+        return len(self._challenges)
+
+
+class WellKnownChannel(asynchat.async_chat):
+    """
+    One keep-alive HTTP connection of challenge server
+    """
+    max_request_size = 8192
+
+    def __init__(self, sock, server):
+        asynchat.async_chat.__init__(self, sock, map=server.map)
+        self.server = server
+        self.last_activity = time.time()
+        # response is prepared by read worker, next requests wait until it is sent
+        self.deferred = False
+        self._waiting = []
+        self._buffer = []
+        self._size = 0
+        self.set_terminator('\r\n\r\n')
+
+    def readable(self):
+        return not self.deferred and asynchat.async_chat.readable(self)
+
+    def collect_incoming_data(self, data):
+        self.last_activity = time.time()
+        self._size += len(data)
+        if self._size > self.max_request_size:
+            self.close()
+            return
+
+        self._buffer.append(data)
+
+    def found_terminator(self):
+        request = ''.join(self._buffer)
+        self._buffer = []
+        self._size = 0
+        if self.deferred:
+            self._waiting.append(request)
+        else:
+            self.handle_request(request)
+
+    def handle_request(self, request):
+        lines = request.split('\r\n')
+        try:
+            method, path, version = lines[0].split(' ', 2)
+        except ValueError:
+            return self.reply(400, 'Bad request', keep_alive=False)
+
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.0':
+            keep_alive = connection == 'keep-alive'
+        else:
+            keep_alive = connection != 'close'
+
+        if method != 'GET':
+            return self.reply(404, "No such file or directory. Request to %s is invalid" % path, keep_alive=False)
+
+        response = self.server.respond(path)
+        if response is None:
+            self.deferred = True
+            return self.server.defer(self, path, keep_alive)
+
+        self.reply(response[0], response[1], keep_alive)
+
+    def reply(self, code, body, keep_alive=True):
+        if isinstance(body, unicode):
+            # challenges read from storage are decoded by json
+            body = body.encode('utf-8')
+
+        status = httplib.responses.get(code, 'Unknown')
+        headers = [
+            'HTTP/1.1 %d %s' % (code, status),
+            'Content-Type: text/plain',
+            'Content-Length: %d' % len(body),
+            'Connection: %s' % ('keep-alive' if keep_alive else 'close')
+        ]
+        self.push('\r\n'.join(headers) + '\r\n\r\n' + body)
+        if not keep_alive:
+            self.close_when_done()
+
+    def complete(self, code, body, keep_alive):
+        """
+        Send response prepared by read worker and handle requests received meanwhile
+
+        :param code:
+        :param body:
+        :param keep_alive:
+        :return:
+        """
+        self.deferred = False
+        self.reply(code, body, keep_alive)
+        while self._waiting and not self.deferred and keep_alive:
+            self.handle_request(self._waiting.pop(0))
+
+    def handle_error(self):
+        self.server.log("Connection error: %s" % str(sys.exc_info()[1]))
+        self.close()
+
+
+class WakeUp(asyncore.dispatcher):
+    """
+    Wakes event loop when read workers completed responses
+    """
+    def __init__(self, sock, server):
+        asyncore.dispatcher.__init__(self, sock, map=server.map)
+        self.server = server
+        self.last_activity = float('inf')
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+        self.server.complete()
+
+
+class WellKnownServer(scmt.loggable.Loggable, asyncore.dispatcher):
+    """
+    Event-loop HTTP server answering ACME challenges, one thread per listen address.
+    Hooks listening on the same address register their challenge stores in it
+    """
+    # maximum number of simultaneously open connections
+    max_connections = 512
+    # idle keep-alive connections are closed after this timeout
+    keep_alive_timeout = 15
+    # how often should expired challenges be removed
+    evict_interval = 60
+    # threads reading challenges missing in local copy from storage
+    read_workers = 4
+
+    _servers = {}
+    _serversLock = threading.Lock()
+
+    def __init__(self, host, port, store=None):
+        self.map = {}
+        self.stores = [store] if store is not None else []
+        self.running = True
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(128)
+
+        self._address = '%s:%d' % (host, port)
+        self._last_evict = time.time()
+        self._last_housekeeping = time.time()
+
+        # read-through requests and responses ready to be sent by event loop
+        self._reads = Queue.Queue()
+        self._completed = Queue.Queue()
+        wakeup, self._wakeup = socket.socketpair()
+        self._wakeup.setblocking(False)
+        WakeUp(wakeup, self)
+        for i in range(self.read_workers):
+            worker = threading.Thread(target=self.read_worker, name='wellknown-read-%d' % i)
+            worker.daemon = True
+            worker.start()
+
+    @staticmethod
+    def get(host, port, store):
+        """
+        Get running server for address, starts new one if there is no server yet
+
+        :param host:
+        :param port:
+        :param store:
+        :return:
+        """
+        with WellKnownServer._serversLock:
+            if (host, port) not in WellKnownServer._servers:
+                server = WellKnownServer(host, port)
+                daemon_thread = threading.Thread(target=server.serve, name='wellknown-%d' % port)
+                daemon_thread.daemon = True
+                daemon_thread.start()
+                WellKnownServer._servers[(host, port)] = server
+
+            server = WellKnownServer._servers[(host, port)]
+            if store not in server.stores:
+                server.stores = server.stores + [store]
+
+            return server
+
+    def serve(self):
+        self.log("Started challenge server on %s" % self._address)
+        while self.running:
+            asyncore.loop(timeout=1, map=self.map, use_poll=True, count=1)
+            self.housekeeping()
+
+        asyncore.close_all(self.map)
+        self.log("Stopped challenge server on %s" % self._address)
+
+    def stop(self):
+        """
+        Stop event loop and read workers, server is not returned by get() anymore
 
-    def finish(self, *args, **kw):
+        :return:
+        """
+        with WellKnownServer._serversLock:
+            for address in WellKnownServer._servers.keys():
+                if WellKnownServer._servers[address] is self:
+                    del WellKnownServer._servers[address]
+
+        self.running = False
+        for i in range(self.read_workers):
+            self._reads.put((None, None, None))
         try:
-            if not self.wfile.closed:
-                self.wfile.flush()
-                self.wfile.close()
+            self._wakeup.send('x')
         except socket.error:
-            self.log("""Exception: %s""" % sys.exc_info()[1])
             pass
 
-        self.rfile.close()
+    def housekeeping(self):
+        now = time.time()
+        if self._last_housekeeping > now - 1:
+            return
 
+        self._last_housekeeping = now
+        for channel in self.map.values():
+            if channel is not self and channel.last_activity < now - self.keep_alive_timeout:
+                channel.close()
 
-class WellKnown(scmt.loggable.Loggable):
-    challenges = {}
+        if self._last_evict < now - self.evict_interval:
+            self._last_evict = now
+            evicted = sum([store.evict() for store in self.stores])
+            if evicted:
+                self.log("Evicted %d expired challenges" % evicted)
+
+    def readable(self):
+        # stop accepting connections when limit reached, they will wait in listen backlog
+        return len(self.map) <= self.max_connections + 1
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+
+        WellKnownChannel(pair[0], self)
+
+    def defer(self, channel, path, keep_alive):
+        """
+        Respond from read worker, storage reads don't block event loop
+
+        :param channel:
+        :param path:
+        :param keep_alive:
+        :return:
+        """
+        self._reads.put((channel, path, keep_alive))
+
+    def read_worker(self):
+        while True:
+            channel, path, keep_alive = self._reads.get()
+            if channel is None:
+                return
+
+            try:
+                code, body = self.respond(path, read_through=True)
+            except Exception as e:
+                self.log("Failed to read challenge for %s: %s" % (path, str(e)))
+                code, body = 404, "No such file or directory. Request to %s is invalid" % path
+
+            self._completed.put((channel, code, body, keep_alive))
+            try:
+                self._wakeup.send('x')
+            except socket.error:
+                pass
+
+    def complete(self):
+        """
+        Send responses prepared by read workers, called by event loop
+
+        :return:
+        """
+        while True:
+            try:
+                channel, code, body, keep_alive = self._completed.get_nowait()
+            except Queue.Empty:
+                return
 
-    def __init__(self, options):
+            if channel.connected:
+                channel.complete(code, body, keep_alive)
+
+    def respond(self, path, read_through=False):
+        """
+        Prepare response for request path
+
+        :param path:
+        :param read_through: read challenge from storage when it is not known locally
+        :return: tuple of code and body, None when challenge should be read by worker
+        """
+        path_data = path.split('?')[0].split("/")
+        if len(path_data) < 3 or path_data[1] != '.well-known':
+            return 404, "No such file or directory. Request to %s is invalid" % path
+
+        if path_data[2] == 'acme-test':
+            return 200, 'available'
+
+        token = path_data[-1]
+        # stores knowing challenge are asked first, so event loop never reads storage
+        known = [store for store in self.stores if store.knows(token)]
+        if not read_through and not known and [store for store in self.stores if store.needs_read(token)]:
+            return None
+
+        for store in known + [store for store in self.stores if store not in known]:
+            try:
+                challenge = store.get(token)
+            except IndexError:
+                continue
+
+            self.log("Request for challenge %s" % token)
+            return 200, challenge['key']
+
+        return 404, "No such file or directory. Request to %s is invalid" % path
+
+    def handle_error(self):
+        self.log("Challenge server error: %s" % str(sys.exc_info()[1]))
+
+
+class WellKnown(scmt.loggable.Loggable):
+    def __init__(self, options, storage=None):
         if 'port' not in options:
             raise RuntimeError("WellKnown Hook Error. Not found port, please specify hook.port in config")
 
         self._port = int(options['port'])
+        self._host = options['host'] if 'host' in options else '0.0.0.0'
 
-        self.log("WellKnown hook initialized, port: %d" % self._port)
+        # every hook has own TTL and clock, server on shared address answers from stores of all its hooks
+        if 'ttl' in options:
+            self.challenges = ChallengeStore(int(options['ttl']))
+        else:
+            self.challenges = ChallengeStore()
 
-        daemon_thread = threading.Thread(target=self.daemonize)
-        daemon_thread.start()
+        self._storage = storage
+        if storage is not None:
+            self.challenges.attach(storage)
 
-    def daemonize(self):
-        self.log("Started daemon thread for hook on port %d" % self._port)
+        self.log("WellKnown hook initialized, port: %d" % self._port)
 
-        http_handler = WellKnownHttpHandler
-        SocketServer.TCPServer.allow_reuse_address = True
-
-        well_known_server = WellKnownHttpApi(('0.0.0.0', self._port), http_handler, hook=self)
-        while True:
-            well_known_server.handle_request()
+        self._server = WellKnownServer.get(self._host, self._port, self.challenges)
 
     def deploy_challenge(self, domain, token, key_authorization):
         self.log("Challenge URL: http://%s/.well-known/acme-challenge/%s" % (domain, token))
 
-        self.challenges[key_authorization.split(".")[0]] = {
-            'domain': domain,
-            'token': token,
-            'key': key_authorization,
-            'created': time.time()
-        }
+        with scmt.tracing.span('wellknown.deploy'):
+            self.challenges.add(key_authorization.split(".")[0], domain, token, key_authorization, self._storage)
 
         self.log("New challenge for %s, token %s, key: %s" % (domain, token, key_authorization))
 
@@ -112,11 +538,7 @@ class WellKnown(scmt.loggable.Loggable):
         :param token:
         :return:
         """
-        self.log("Request for challenge %s" % token)
-        if token not in self.challenges:
-            raise IndexError("no such challenge %s" % token)
-
-        return self.challenges[token]['key']
+        return self.challenges.get(token)['key']
 
     def verify(self, domain):
         """
@@ -128,7 +550,17 @@ class WellKnown(scmt.loggable.Loggable):
         return True
 
     def clean_challenge(self, domain, token):
-        pass
+        if self.challenges.remove(token):
+            self.log("Removed challenge for %s, token %s" % (domain, token))
 
     def get_challenge_type(self):
-        return 'http-01'
\ No newline at end of file
+        return 'http-01'
+
+    def set_clock(self, clock):
+        """
+        Set time source of challenges expiration
+
+        :param clock:
+        :return:
+        """
+        self.challenges.clock = clock
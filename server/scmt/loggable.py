@@ -1,14 +1,171 @@
 # coding: utf-8
-import time
-import threading
+"""
+Logging pipeline. log() checks level and puts record to bounded queue, writer
+thread formats records and writes them to stdout in batches with one flush per
+batch. Extra fields are written as key=value pairs, hot-path messages could be
+sampled per call site.
+"""
+import Queue
+import atexit
+import json
 import sys
+import threading
+import time
+
+LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+# records below this level are dropped before queueing
+threshold = LEVELS['info']
+# maximum number of records waiting for writer, new records are dropped when queue is full
+queue_size = 10000
+# maximum number of records written with one flush
+batch_size = 500
+
+_queue = Queue.Queue(queue_size)
+_writer = None
+_writerLock = threading.Lock()
+_dropped = 0
+# call site => number of calls, used for sampling
+_calls = {}
+
+
+def set_level(name):
+    """
+    Set minimal level of written records
+
+    :param name: debug, info, warning or error
+    :return:
+    """
+    global threshold
+    if name not in LEVELS:
+        raise RuntimeError("Unknown log level %s" % name)
+
+    threshold = LEVELS[name]
+
+
+def _start_writer():
+    global _writer
+    with _writerLock:
+        if _writer is None:
+            _writer = threading.Thread(target=_write, name='log-writer')
+            _writer.daemon = True
+            _writer.start()
+
+
+def _text(value):
+    # str() of unicode fails on non-ASCII characters, such text is written as UTF-8
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+
+    return str(value)
+
+
+def _format_value(value):
+    value = _text(value)
+    if not value or ' ' in value or '"' in value or '=' in value:
+        return json.dumps(value)
+
+    return value
+
+
+def _write():
+    global _dropped
+    prefix_minute = None
+    prefix = ''
+    while True:
+        records = [_queue.get()]
+        try:
+            while len(records) < batch_size:
+                records.append(_queue.get_nowait())
+        except Queue.Empty:
+            pass
+
+        lines = []
+        for created, thread_name, record_level, msg, fields in records:
+            # timestamp has minute precision, format it once per minute
+            if int(created // 60) != prefix_minute:
+                prefix_minute = int(created // 60)
+                prefix = time.strftime('%Y/%m/%d %R ', time.localtime(created))
+
+            # record which can't be formatted must not stop writer, it is written as repr
+            try:
+                line = prefix + '[' + _text(thread_name) + '] [' + _text(record_level) + '] ' + _text(msg).strip()
+                if fields:
+                    line += ' ' + ' '.join(['%s=%s' % (key, _format_value(fields[key])) for key in sorted(fields)])
+            except Exception:
+                line = prefix + '[log-writer] [error] Failed to format record: ' + repr((thread_name, msg, fields))
+            lines.append(line + "\n")
+
+        dropped, _dropped = _dropped, 0
+        if dropped:
+            lines.append(time.strftime('%Y/%m/%d %R ') + '[log-writer] [warning] Dropped %d log records\n' % dropped)
+
+        try:
+            sys.stdout.write(''.join(lines))
+            sys.stdout.flush()
+        except (IOError, ValueError, UnicodeError):
+            pass
+
+        for _ in records:
+            _queue.task_done()
+
+
+def flush(timeout=5):
+    """
+    Wait until queued records are written
+
+    :param timeout:
+    :return:
+    """
+    deadline = time.time() + timeout
+    while _writer is not None and _queue.unfinished_tasks and time.time() < deadline:
+        time.sleep(0.01)
+
+
+atexit.register(flush)
+
+
+def reset():
+    """
+    Forget writer thread and queue inherited from parent, should be called in forked process.
+    Writer thread doesn't exist after fork and queue lock could be left acquired by it
+
+    :return:
+    """
+    global _queue, _writer, _writerLock, _dropped
+    _queue = Queue.Queue(queue_size)
+    _writer = None
+    _writerLock = threading.Lock()
+    _dropped = 0
 
 
 class Loggable:
-    def log(self, msg, level='info'):
-        thread_name = threading.currentThread().name
+    def log(self, msg, level='info', sample=None, **fields):
+        """
+        Write log record
+
+        :param msg:
+        :param level: debug, info, warning or error
+        :param sample: write only every N-th record of this call site
+        :param fields: written as key=value pairs, formatted by writer thread
+        :return:
+        """
+        global _dropped
+        if LEVELS.get(level, LEVELS['info']) < threshold:
+            return
+
+        if sample:
+            caller = sys._getframe(1)
+            site = (caller.f_code, caller.f_lineno)
+            calls = _calls.get(site, 0)
+            _calls[site] = calls + 1
+            if calls % sample:
+                return
+            fields['sampled'] = sample
+
+        if _writer is None:
+            _start_writer()
 
-        sys.stdout.write(time.strftime('%Y/%m/%d %R ', time.localtime()) + '['
-                         + str(thread_name)
-                         + '] [' + str(level) + '] ' + msg.strip() + "\n")
-        sys.stdout.flush()
+        try:
+            _queue.put_nowait((time.time(), threading.currentThread().name, level, msg, fields))
+        except Queue.Full:
+            _dropped += 1
@@ -1,64 +1,245 @@
+import collections
 import os
 import threading
 import time
 
 import loggable
+import metrics
+import plugins
+import tracing
 import sys
 import socket
+import hashlib
+import json
+from multiprocessing.pool import ThreadPool
 
-from hooks.cloudflare import Cloudflare
-from hooks.wellknown import WellKnown
+from clock import Clock
+from reconciler import Reconciler
 
-from ca.letsencrypt import LetsEncrypt
-from ca.privateca import PrivateCA
+ISSUES = metrics.histogram('scmt_issue_seconds', 'Total duration of certificate issue', ('result',))
 
 
 class Manager(loggable.Loggable, threading.Thread):
-    def __init__(self, dir, domains, storages):
+    # maximum time of watch request
+    watch_timeout = 300
+    # how often should watch requests recheck storage
+    watch_recheck = 60
+
+    # for how long should serialized certificate responses be used, other replicas could renew certificates
+    response_cache_time = 60
+    # how often should next slice of hosts be reconciled
+    cleanup_interval = 60
+    # for how long should idle issue worker wait for task before checking clean-up
+    queue_timeout = 10
+    # how long should failed zone wait before next initialization attempt
+    init_retry_interval = 300
+
+    def __init__(self, dir, domains, storages, issue_workers=1, cleanup_workers=8, clock=None, membership=None,
+                 init_workers=8):
         self.log("Initializing manager")
 
         self._dir = dir
+        # time source of scheduling, replaced by simulated clock in simulations
+        self.clock = clock or Clock()
+        # ownership of hostnames between replicas, None when replica runs alone
+        self.membership = membership
         self._locks = {}
         self.queueLock = threading.Lock()
-        self.queue = []
+        self.queueCondition = threading.Condition(self.queueLock)
+        # hostname => time when it was added to queue, in order of adding
+        self.queue = collections.OrderedDict()
+        # hostnames which should be re-issued even if certificate exists
+        self._forced = set()
+        # hostnames being issued right now
+        self._active = set()
         self.is_active = True
         self.last_cleanup = 0
+        self.issue_workers = issue_workers
+        self.cleanup_workers = cleanup_workers
+        self.init_workers = init_workers
+        self._cleanup_thread = None
+        # clean-up workers, created on first clean-up
+        self._cleanup_pool = None
+        # notified each time when new certificate issued
+        self._issuedLock = threading.Lock()
+        self.issued = threading.Condition(self._issuedLock)
+        self.issued_count = 0
+        # hostname => conditions of watches waiting for it, hostname => number of issues while watched
+        self._versions = {}
+        self._watchers = {}
+        # hostname => serialized available response
+        self._responses = {}
+
+        metrics.gauge('scmt_queue_depth', 'Number of hostnames waiting for issue').callback = lambda: {(): len(self.queue)}
+        metrics.gauge('scmt_queue_oldest_seconds', 'Age of oldest hostname in issue queue').callback = self.get_queue_age
+        metrics.gauge('scmt_issue_active', 'Number of certificates being issued now').callback = lambda: {(): len(self._active)}
 
         if not os.path.exists(self._dir):
             os.makedirs(self._dir)
             self.log("Creating path %s" % self._dir)
         self.domains = {}
+        self.reconcilers = {}
+
+        self._configs = domains
+        self._storages = storages
+        # zone => initialization status, zones are served only when ready
+        self.zones = {}
+        # zones waiting for initialization, requested zones are moved to front
+        self._pending = collections.deque()
+        self._zonesLock = threading.Lock()
+        self._zonesCondition = threading.Condition(self._zonesLock)
+        # hooks shared by zones with same options
+        self._hooks = {}
+        self._hooksLock = threading.Lock()
 
         for domain in domains:
-            options = domains[domain]
-            storage = options['storage']
+            storage = domains[domain]['storage']
             if storage not in storages:
                 raise IndexError("Unknown storage %s for domain %s" % (storage, domain))
 
-            try:
-                self.domains[domain] = self.init_domain(domain, domains[domain], storages[storage])
-            except IndexError:
-                self.log("Failed to initialize domain: %s" % domain)
-                continue
+            self.zones[domain] = {'status': 'pending', 'error': None, 'since': self.clock.time()}
+            self._pending.append(domain)
+
+        metrics.gauge('scmt_zones', 'Number of configured zones by initialization status', ('status',)).callback = self.count_zones
 
-            self._locks[domain] = threading.Lock()
+        if self.membership is not None:
+            self.membership.set_domains(self.zones.keys())
+            self.membership.add_listener(self.rebalance)
+            self.membership.set_receiver(self.add_to_queue)
 
         threading.Thread.__init__(self)
+        self.start_init()
+
+    def start_init(self):
+        """
+        Initialize pending zones in background, API serves zones as soon as they are ready
+
+        :return:
+        """
+        with self._zonesLock:
+            workers = min(self.init_workers, len(self._pending))
+
+        for i in range(workers):
+            worker = threading.Thread(target=self.init_worker, name='init-%d' % i)
+            worker.daemon = True
+            worker.start()
+
+    def init_worker(self):
+        while True:
+            with self._zonesLock:
+                if not self._pending:
+                    return
+
+                domain = self._pending.popleft()
+                self.zones[domain] = {'status': 'initializing', 'error': None, 'since': self.clock.time()}
+
+            self.init_zone(domain)
+
+    def init_zone(self, domain):
+        """
+        Initialize zone and start serving it, failed zones are retried by clean-up
+
+        :param domain:
+        :return:
+        """
+        config = self._configs[domain]
+        storage = self._storages[config['storage']]
+        started = time.time()
+        try:
+            ca = self.init_domain(domain, config, storage)
+            self.add_domain(domain, ca, storage)
+        except Exception as e:
+            self.log("Failed to initialize domain %s: %s" % (domain, str(e)), level='error')
+            status = {'status': 'failed', 'error': str(e), 'since': self.clock.time()}
+        else:
+            status = {'status': 'ready', 'error': None, 'since': self.clock.time()}
+            self.log("Domain %s is ready" % domain, seconds='%.3f' % (time.time() - started))
+
+        with self._zonesCondition:
+            self.zones[domain] = status
+            self._zonesCondition.notify_all()
+
+    def retry_zones(self):
+        """
+        Queue failed zones for next initialization attempt
+
+        :return:
+        """
+        with self._zonesLock:
+            failed = [domain for domain in self.zones if self.zones[domain]['status'] == 'failed'
+                      and self.zones[domain]['since'] < self.clock.time() - self.init_retry_interval]
+            for domain in failed:
+                self.zones[domain] = {'status': 'pending', 'error': None, 'since': self.clock.time()}
+                self._pending.append(domain)
+
+        if failed:
+            self.start_init()
+
+    def request_zone(self, domain):
+        """
+        Move pending zone to front of initialization queue, used when zone is requested by clients
+
+        :param domain:
+        :return:
+        """
+        with self._zonesLock:
+            if domain in self._pending and self._pending[0] != domain:
+                self._pending.remove(domain)
+                self._pending.appendleft(domain)
+
+    def wait_ready(self, timeout=None):
+        """
+        Wait until all zones are initialized, successfully or not
+
+        :param timeout:
+        :return: True when all zones are ready
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._zonesCondition:
+            while [domain for domain in self.zones if self.zones[domain]['status'] in ('pending', 'initializing')]:
+                if deadline is not None and deadline <= time.time():
+                    break
+                self._zonesCondition.wait(deadline - time.time() if deadline is not None else 1)
+
+            return not [domain for domain in self.zones if self.zones[domain]['status'] != 'ready']
+
+    def get_readiness(self):
+        """
+        Initialization status of every configured zone
+
+        :return:
+        """
+        with self._zonesLock:
+            zones = dict([(domain, dict(self.zones[domain])) for domain in self.zones])
+
+        now = self.clock.time()
+        for domain in zones:
+            zones[domain]['seconds'] = now - zones[domain].pop('since')
+
+        return {'ready': not [zone for zone in zones.values() if zone['status'] != 'ready'], 'zones': zones}
+
+    def count_zones(self):
+        counts = {}
+        with self._zonesLock:
+            for zone in self.zones.values():
+                counts[(zone['status'],)] = counts.get((zone['status'],), 0) + 1
+
+        return counts
 
     def init_domain(self, domain, config, storage):
-        if 'ca' not in config or config['ca'] not in ['letsencrypt', 'privateca']:
+        if 'ca' not in config:
             raise RuntimeError("Failed to initialize domain %s, no CA or wrong CA type" % domain)
 
+        try:
+            ca_class = plugins.get('ca', config['ca'])
+        except IndexError as e:
+            raise RuntimeError("Wrong CA name for %s, CA %s is unacceptable: %s" % (domain, config['ca'], str(e)))
+
         config['dir'] = self._dir + '/' + domain
         if not os.path.exists(config['dir']):
             os.makedirs(config['dir'])
 
-        if config['ca'] == 'letsencrypt':
-            ca = LetsEncrypt(domain, config, storage)
-        elif config['ca'] == 'privateca':
-            ca = PrivateCA(domain, config, storage)
-        else:
-            raise RuntimeError("Wrong CA name for %s, CA %s is unacceptable" % (domain, config['ca']))
+        ca = ca_class(domain, config, storage)
 
         if 'hook' in config:
             hook_opts = {}
@@ -67,10 +248,10 @@ class Manager(loggable.Loggable, threading.Thread):
                     continue
                 hook_opts[opt[5:]] = config[opt]
 
-            if config['hook'] == 'cloudflare':
-                hook = Cloudflare(hook_opts)
-            elif config['hook'] == 'well-known':
-                hook = WellKnown(hook_opts)
+            if 'dir' not in hook_opts:
+                hook_opts['dir'] = config['dir']
+
+            hook = self.get_hook(config['hook'], hook_opts, storage)
             ca.set_hook(hook)
 
             if not hook.verify(domain):
@@ -79,65 +260,278 @@ class Manager(loggable.Loggable, threading.Thread):
         self.log("Initialized domain %s" % domain)
         return ca
 
+    def get_hook(self, name, options, storage):
+        """
+        Create hook or reuse hook of other zone with same options, so zones with
+        same credentials share API connections, caches and propagation checks
+
+        :param name:
+        :param options:
+        :param storage:
+        :return:
+        """
+        shared = dict(options)
+        # directory of zone keeps only hook caches
+        shared.pop('dir', None)
+        key = (name, tuple(sorted(shared.items())), id(storage) if name == 'well-known' else None)
+
+        with self._hooksLock:
+            if key in self._hooks:
+                return self._hooks[key]
+
+            try:
+                hook = plugins.get('hook', name)(options, storage)
+            except IndexError as e:
+                raise RuntimeError("Unknown hook %s: %s" % (name, str(e)))
+
+            hook.set_clock(self.clock)
+            self._hooks[key] = hook
+
+        return hook
+
+    def add_domain(self, domain, ca, storage):
+        """
+        Start serving domain by initialized CA
+
+        :param domain:
+        :param ca:
+        :param storage:
+        :return:
+        """
+        ca.set_clock(self.clock)
+        ca.add_listener(self.certificate_issued)
+        ca.set_renewer(self.renew)
+
+        self._locks[domain] = threading.Lock()
+        self.reconcilers[domain] = Reconciler(domain, ca, storage, self.clock, self.membership)
+        ca.add_listener(self.reconcilers[domain].mark)
+        self.domains[domain] = ca
+        with self._zonesLock:
+            self.zones.setdefault(domain, {'status': 'ready', 'error': None, 'since': self.clock.time()})
+
     def run(self):
         """
-        Proceed certificate issue requests in separate thread
+        Proceed certificate issue requests in separate threads, run clean-up in background
 
         :return:
         """
         self.log("Initialized manager thread")
+        if self.membership is not None:
+            self.membership.start()
+
+        for i in range(1, self.issue_workers):
+            worker = threading.Thread(target=self.issue_worker, name='issuer-%d' % i)
+            worker.daemon = True
+            worker.start()
+
+        self.issue_worker()
+        self.log("Manager thread stopped")
+
+    def issue_worker(self):
         while self.is_active:
-            if self.last_cleanup < time.time() - 3600:
-                self.log("Starting certificates cleanup")
-                self.last_cleanup = time.time()
-                for zone in self.domains:
-                    try:
-                        self.domains[zone].cleanup_certificates()
-                    except:
-                        self.log("Failed to cleanup certificates %s" % str(sys.exc_info()))
-                        pass
-
-                self.log("Certificate cleanup finished")
-
-            hostname = self.get_from_queue()
-            if not hostname:
-                time.sleep(10)
+            if self.last_cleanup < self.clock.time() - self.cleanup_interval and not self.cleanup_running():
+                self.last_cleanup = self.clock.time()
+                self._cleanup_thread = threading.Thread(target=self.cleanup, name='cleanup')
+                self._cleanup_thread.daemon = True
+                self._cleanup_thread.start()
+
+            task = self.get_from_queue()
+            if not task:
                 continue
 
+            self.issue(*task)
+
+    def issue(self, hostname, force=False):
+        """
+        Issue certificate for hostname taken from queue
+
+        :param hostname:
+        :param force:
+        :return: True when certificate issued
+        """
+        started = time.time()
+        result = 'error'
+        tracing.start('issue', hostname=hostname, force=force)
+        try:
             ca = self.get_ca(hostname)
+            ca.issue_certificate(hostname, force=force)
+            # initial request
+            ca.register_request(hostname, '127.0.0.1')
+            result = 'ok'
+        except (RuntimeError, IndexError, IOError, socket.timeout) as e:
+            self.log("Failed to issue certificate for %s, got error: %s" % (hostname, e.message))
+        finally:
+            ISSUES.observe(time.time() - started, (result,))
+            tracing.finish(result)
+            self.task_done(hostname, issued=result == 'ok')
+
+        return result == 'ok'
+
+    def cleanup_running(self):
+        return self._cleanup_thread is not None and self._cleanup_thread.is_alive()
+
+    def cleanup(self):
+        """
+        Check due hosts of all domains using bounded pool, renewals are sent to issue queue
+
+        :return:
+        """
+        tasks = []
+        for zone in self.reconcilers.keys():
+            reconciler = self.reconcilers[zone]
             try:
-                ca.issue_certificate(hostname)
-                # initial request
-                ca.register_request(hostname, '127.0.0.1')
-            except (RuntimeError, IndexError, IOError, socket.timeout) as e:
-                self.log("Failed to issue certificate for %s, got error: %s" % (hostname, e.message))
-                
-        self.log("Manager thread stopped")
+                reconciler.refresh()
+                tasks += [(reconciler, hostname) for hostname in reconciler.next_slice()]
+            except:
+                self.log("Failed to read changes of %s %s" % (zone, str(sys.exc_info())))
+
+        for hostname, cached in self._responses.items():
+            if cached['expire'] < self.clock.time():
+                self._responses.pop(hostname, None)
+
+        self.retry_zones()
+
+        if not tasks:
+            return
+
+        if self.cleanup_workers <= 1:
+            map(self._cleanup_host, tasks)
+        else:
+            if self._cleanup_pool is None:
+                self._cleanup_pool = ThreadPool(self.cleanup_workers)
+            self._cleanup_pool.map(self._cleanup_host, tasks)
+
+        for zone in self.reconcilers.keys():
+            self.reconcilers[zone].save_state()
+
+        self.log("Certificate cleanup finished, checked %d hosts" % len(tasks))
+
+    def _cleanup_host(self, task):
+        reconciler, hostname = task
+        reconciler.check(hostname)
+
+    def renew(self, hostname):
+        self.add_to_queue(hostname, force=True)
+
+    def rebalance(self):
+        for zone in self.reconcilers.keys():
+            self.reconcilers[zone].rebalance()
+
+    def owns(self, hostname):
+        """
+        Check if hostname is served by this replica
+
+        :param hostname:
+        :return:
+        """
+        zone = self.find_zone(hostname)
+        return self.membership is None or zone is None or self.membership.owns(hostname, zone)
+
+    def add_to_queue(self, hostname, force=False):
+        if not self.owns(hostname):
+            try:
+                self.membership.forward(hostname, self.find_zone(hostname), force)
+            except (IndexError, IOError) as e:
+                self.log("Failed to forward issue of %s: %s" % (hostname, str(e)))
+            return
 
-    def add_to_queue(self, hostname):
         with self.queueLock:
+            if force:
+                self._forced.add(hostname)
+
             if hostname not in self.queue:
                 self.log("Added new task for queue: %s" % hostname)
-                self.queue.append(hostname)
+                self.queue[hostname] = self.clock.time()
+                self.clock.notify(self.queueCondition)
+
+    def get_from_queue(self, timeout=None):
+        """
+        Get next hostname to issue, hostnames being issued by other worker are skipped
+
+        :param timeout: for how long should we wait for new task, queue_timeout by default
+        :return: tuple of hostname and force flag or None
+        """
+        if timeout is None:
+            timeout = self.queue_timeout
 
-    def get_from_queue(self):
         with self.queueLock:
-            if len(self.queue) == 0:
-                return None
+            hostname = self._next_task()
+            if hostname is None:
+                self.clock.wait(self.queueCondition, timeout)
+                hostname = self._next_task()
+                if hostname is None:
+                    return None
 
-            hostname = self.queue.pop(0)
+            del self.queue[hostname]
+            self._active.add(hostname)
+            force = hostname in self._forced
+            self._forced.discard(hostname)
 
-        return hostname
+        return hostname, force
 
-    def get_ca(self, hostname):
+    def _next_task(self):
+        # only hostnames being issued are skipped, so scan is bounded by number of workers
+        for hostname in self.queue:
+            if hostname not in self._active:
+                return hostname
+
+        return None
+
+    def get_queue_age(self):
+        with self.queueLock:
+            oldest = next(self.queue.itervalues(), None)
+
+        return {(): self.clock.time() - oldest if oldest is not None else 0}
+
+    def task_done(self, hostname, issued=False):
+        """
+        Release hostname taken from queue
+
+        :param hostname:
+        :param issued: certificate was issued, so hostname queued again during issue is dropped,
+            otherwise renewal found due while it was issued would issue it second time
+        :return:
+        """
+        with self.queueLock:
+            self._active.discard(hostname)
+            if issued and hostname in self.queue:
+                del self.queue[hostname]
+                self._forced.discard(hostname)
+            if self.queue:
+                self.clock.notify(self.queueCondition)
+
+    def get_domain(self, hostname):
         for domain in self.domains.keys():
             if hostname[-len(domain)-1:] != '.' + domain and hostname != domain:
                 continue
 
-            return self.domains[domain]
+            return domain
+
+        zone = self.find_zone(hostname)
+        if zone is not None:
+            self.request_zone(zone)
+            raise RuntimeError("Domain %s of %s is not ready: %s" % (zone, hostname, self.zones[zone]['status']))
 
         raise RuntimeError("Failed to detect CA for %s" % hostname)
 
+    def find_zone(self, hostname):
+        """
+        Find configured zone of hostname, zone could be not initialized yet
+
+        :param hostname:
+        :return: zone or None
+        """
+        for domain in self.zones.keys():
+            if hostname[-len(domain)-1:] != '.' + domain and hostname != domain:
+                continue
+
+            return domain
+
+        return None
+
+    def get_ca(self, hostname):
+        return self.domains[self.get_domain(hostname)]
+
     def get_key(self, req):
         """
         Generate new key for account
@@ -158,11 +552,32 @@ class Manager(loggable.Loggable, threading.Thread):
 
         return ['RSA', 'EC-SECP384R1']
 
-    def get_key_path(self, hostname):
-        return self.get_ca(hostname).get_key_path(hostname)
+    def get_key_path(self, hostname, scratch):
+        return self.get_ca(hostname).get_key_path(hostname, scratch)
+
+    def get_fullchain_path(self, hostname, scratch):
+        return self.get_ca(hostname).get_fullchain_path(hostname, scratch)
+
+    def read_key(self, hostname):
+        return self.get_ca(hostname).read_key(hostname)
+
+    def get_full_chain(self, hostname):
+        return self.get_ca(hostname).get_full_chain(hostname)
+
+    def render_metrics(self):
+        return metrics.render()
 
-    def get_fullchain_path(self, hostname):
-        return self.get_ca(hostname).get_fullchain_path(hostname)
+    def collect_metrics(self, extra=()):
+        return metrics.collect(extra)
+
+    def get_traces(self, limit=10):
+        """
+        Slowest recent issues and issues running now
+
+        :param limit:
+        :return:
+        """
+        return {'slowest': tracing.slowest(limit, 'issue'), 'active': tracing.active()}
 
     def cert(self, req):
         """
@@ -173,9 +588,15 @@ class Manager(loggable.Loggable, threading.Thread):
         """
         hostname = req['hostname']
         ip = req['ip']
+        zone = self.find_zone(hostname)
+        if zone is not None and zone not in self.domains:
+            # zone is initialized in background, clients retry pending requests
+            self.request_zone(zone)
+            return {'status': 'pending'}
+
         ca = self.get_ca(hostname)
 
-        self.log("Certificate request from %s for %s" % (ip, hostname))
+        self.log("Certificate request", level='debug', sample=100, hostname=hostname, ip=ip)
 
         if not ca.certificate_exists(hostname, ip):
             self.log("Not found certificate for %s/IP: %s" % (hostname, ip))
@@ -189,11 +610,126 @@ class Manager(loggable.Loggable, threading.Thread):
             self.log("Failed to get certificate. Got exception: %s" % str(sys.exc_info()))
             return {'status': 'pending'}
 
+        fingerprint = hashlib.sha256(chain).hexdigest()
+        if req.get('fingerprint') == fingerprint:
+            return {'status': 'not_modified', 'fingerprint': fingerprint}
+
         return {
             'status': 'available',
             'cert': cert,
-            'fullchain': chain
+            'fullchain': chain,
+            'fingerprint': fingerprint
         }
 
+    def cert_response(self, req):
+        """
+        Same as cert() but returns serialized response, available responses are cached
+
+        :param req:
+        :return:
+        """
+        hostname = req['hostname']
+        cached = self._responses.get(hostname)
+        if cached and cached['expire'] > self.clock.time():
+            metrics.CACHE.inc(('cert_response', 'hit'))
+            self.get_ca(hostname).register_request(hostname, req['ip'])
+            if req.get('fingerprint') == cached['fingerprint']:
+                return json.dumps({'status': 'not_modified', 'fingerprint': cached['fingerprint']})
+
+            return cached['body']
+
+        metrics.CACHE.inc(('cert_response', 'miss'))
+        response = self.cert(req)
+        if response['status'] == 'not_modified':
+            return json.dumps(response)
+
+        body = json.dumps(response)
+        if response['status'] == 'available':
+            self._responses[hostname] = {
+                'body': body,
+                'fingerprint': response['fingerprint'],
+                'expire': self.clock.time() + self.response_cache_time
+            }
+
+        return body
+
+    def certificate_issued(self, hostname):
+        """
+        Wake up watching clients when certificate is issued or renewed
+
+        :param hostname:
+        :return:
+        """
+        self._responses.pop(hostname, None)
+        with self.issued:
+            self.issued_count += 1
+            self.clock.notify(self.issued, wake_all=True)
+            # only watches of this hostname are woken up
+            if hostname in self._watchers:
+                self._versions[hostname] = self._versions.get(hostname, 0) + 1
+                for waiter in self._watchers[hostname]:
+                    self.clock.notify(waiter)
+
+    def get_fingerprints(self, hostnames):
+        fingerprints = {}
+        for hostname in hostnames:
+            try:
+                fingerprints[hostname] = self.get_ca(hostname).get_fingerprint(hostname) or ''
+            except RuntimeError:
+                fingerprints[hostname] = ''
+
+        return fingerprints
+
+    def watch(self, req):
+        """
+        Wait until certificate of any requested host changes
+
+        :param req: hostnames is dict hostname => fingerprint known by client
+        :return:
+        """
+        known = req['hostnames']
+        timeout = max(0, min(float(req.get('timeout', self.watch_timeout)), self.watch_timeout))
+        try_until = self.clock.time() + timeout
+
+        waiter = threading.Condition(self._issuedLock)
+        with self.issued:
+            for hostname in known:
+                self._watchers.setdefault(hostname, set()).add(waiter)
+
+        try:
+            current = {}
+            seen = {}
+            check = known.keys()
+            while True:
+                with self.issued:
+                    for hostname in check:
+                        seen[hostname] = self._versions.get(hostname, 0)
+
+                current.update(self.get_fingerprints(check))
+                changed = [hostname for hostname in known if current[hostname] != known[hostname]]
+                if changed:
+                    return {'status': 'changed', 'hostnames': changed, 'fingerprints': current}
+
+                remaining = try_until - self.clock.time()
+                if remaining <= 0:
+                    return {'status': 'timeout'}
+
+                with self.issued:
+                    check = [hostname for hostname in known if self._versions.get(hostname, 0) != seen[hostname]]
+                    if not check:
+                        self.clock.wait(waiter, min(remaining, self.watch_recheck))
+                        check = [hostname for hostname in known if self._versions.get(hostname, 0) != seen[hostname]]
+
+                if not check:
+                    # certificates could be renewed by other replica, so recheck storage from time to time
+                    check = known.keys()
+        finally:
+            with self.issued:
+                for hostname in known:
+                    self._watchers[hostname].discard(waiter)
+                    if not self._watchers[hostname]:
+                        del self._watchers[hostname]
+                        self._versions.pop(hostname, None)
+
     def request_key(self, hostname):
         pass
\ No newline at end of file
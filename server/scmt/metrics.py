@@ -0,0 +1,237 @@
+"""
+Process metrics exported in Prometheus text format on /metrics
+"""
+import threading
+import time
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def format_labels(self, values, extra=()):
+        pairs = zip(self.labels, values) + list(extra)
+
+        if not pairs:
+            return ''
+
+        return '{' + ','.join(['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                               for name, value in pairs]) + '}'
+
+    def samples(self, extra=()):
+        with self._lock:
+            values = self._values.items()
+
+        return [(self.name + self.format_labels(labels, extra), value) for labels, value in sorted(values)]
+
+    def header(self):
+        return ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.type)]
+
+    def render_samples(self, extra=()):
+        """
+        Render sample lines without header
+
+        :param extra: label pairs added to every sample, e.g. shard of process
+        :return: list of lines
+        """
+        return ['%s %s' % (name, repr(float(value))) for name, value in self.samples(extra)]
+
+    def render(self):
+        return '\n'.join(self.header() + self.render_samples())
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name, help, labels=(), callback=None):
+        Metric.__init__(self, name, help, labels)
+        # called during collection, returns dict labels => value
+        self.callback = callback
+
+    def set(self, value, labels=()):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, labels=(), amount=1):
+        self.inc(labels, -amount)
+
+    def samples(self, extra=()):
+        if self.callback:
+            try:
+                values = self.callback()
+            except Exception:
+                values = {}
+
+            with self._lock:
+                self._values = dict(values)
+
+        return Metric.samples(self, extra)
+
+
+class Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.time() - self.started, self.labels)
+        return False
+
+
+class Histogram(Metric):
+    type = 'histogram'
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+    def __init__(self, name, help, labels=(), buckets=None):
+        Metric.__init__(self, name, help, labels)
+        if buckets:
+            self.buckets = buckets
+
+    def observe(self, value, labels=()):
+        with self._lock:
+            data = self._values.get(labels)
+            if data is None:
+                # buckets counters, sum, count
+                data = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+
+            for i in range(len(self.buckets)):
+                if value <= self.buckets[i]:
+                    data[0][i] += 1
+                    break
+
+            data[1] += value
+            data[2] += 1
+
+    def time(self, labels=()):
+        """
+        Measure duration of with block
+
+        :param labels:
+        :return:
+        """
+        return Timer(self, labels)
+
+    def render_samples(self, extra=()):
+        lines = []
+        with self._lock:
+            values = [(labels, [list(data[0]), data[1], data[2]]) for labels, data in self._values.items()]
+
+        extra = list(extra)
+        for labels, data in sorted(values):
+            total = 0
+            for i in range(len(self.buckets)):
+                total += data[0][i]
+                lines.append('%s_bucket%s %d' % (self.name, self.format_labels(labels, extra + [('le', repr(float(self.buckets[i])))]), total))
+
+            lines.append('%s_bucket%s %d' % (self.name, self.format_labels(labels, extra + [('le', '+Inf')]), data[2]))
+            lines.append('%s_sum%s %s' % (self.name, self.format_labels(labels, extra), repr(data[1])))
+            lines.append('%s_count%s %d' % (self.name, self.format_labels(labels, extra), data[2]))
+
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """
+        Register metric, existing metric with same name is returned if already registered
+
+        :param metric:
+        :return:
+        """
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def collect(self, extra=()):
+        """
+        Get rendered metrics in form which could be sent to other process and merged
+
+        :param extra: label pairs added to every sample
+        :return: list of tuples name, header lines, sample lines
+        """
+        with self._lock:
+            metrics = [self._metrics[name] for name in sorted(self._metrics)]
+
+        return [(metric.name, metric.header(), metric.render_samples(extra)) for metric in metrics]
+
+    def render(self):
+        return merge(self.collect())
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help, labels=()):
+    return REGISTRY.register(Counter(name, help, labels))
+
+
+def gauge(name, help, labels=(), callback=None):
+    return REGISTRY.register(Gauge(name, help, labels, callback))
+
+
+def histogram(name, help, labels=(), buckets=None):
+    return REGISTRY.register(Histogram(name, help, labels, buckets))
+
+
+def collect(extra=()):
+    return REGISTRY.collect(extra)
+
+
+def merge(*collected):
+    """
+    Render metrics collected by several processes, samples of same metric are grouped under one header
+
+    :param collected: results of collect()
+    :return:
+    """
+    headers = {}
+    samples = {}
+    for metrics in collected:
+        for name, header, lines in metrics:
+            headers.setdefault(name, header)
+            samples.setdefault(name, []).extend(lines)
+
+    return '\n'.join(['\n'.join(headers[name] + samples[name]) for name in sorted(headers)]) + '\n'
+
+
+def render(*collected):
+    """
+    Render metrics of this process together with metrics collected from other processes
+
+    :param collected:
+    :return:
+    """
+    return merge(REGISTRY.collect(), *collected)
+
+
+# metrics shared by several modules
+ISSUE_PHASE = histogram('scmt_issue_phase_seconds', 'Duration of certificate issue phases', ('ca', 'phase'))
+OPENSSL = histogram('scmt_openssl_seconds', 'Duration of openssl commands', ('command',))
+STORAGE = histogram('scmt_storage_seconds', 'Latency of storage operations', ('backend', 'op'))
+STORAGE_ERRORS = counter('scmt_storage_errors_total', 'Failed storage operations', ('backend', 'op'))
+CACHE = counter('scmt_cache_requests_total', 'Cache lookups', ('cache', 'result'))
@@ -0,0 +1,108 @@
+"""
+Registry of CA, hook and storage implementations. Implementations are named
+by "module:attribute" strings and imported on first use, so deployment which
+doesn't use Cloudflare or Consul never imports dns, requests or tld. Config
+could also name implementation directly, e.g. "ca = mypackage.ca:MyCA", and
+installed packages could provide "scmt.ca", "scmt.hook" or "scmt.storage"
+entry points.
+
+Constructors: CA is called with (domain, options, storage), hook with
+(options, storage), storage with (options).
+"""
+import importlib
+import threading
+
+# kind => name => implementation
+_registry = {
+    'ca': {
+        'letsencrypt': 'scmt.ca.letsencrypt:LetsEncrypt',
+        'privateca': 'scmt.ca.privateca:PrivateCA'
+    },
+    'hook': {
+        'cloudflare': 'scmt.hooks.cloudflare:Cloudflare',
+        'well-known': 'scmt.hooks.wellknown:WellKnown'
+    },
+    'storage': {
+        'consul': 'scmt.storages.consul:Consul.from_options'
+    }
+}
+_lock = threading.Lock()
+
+
+def register(kind, name, target):
+    """
+    Add implementation
+
+    :param kind: ca, hook or storage
+    :param name: name used in config
+    :param target: "module:attribute" string or implementation itself
+    :return:
+    """
+    with _lock:
+        _registry.setdefault(kind, {})[name] = target
+
+
+def names(kind):
+    return sorted(_registry.get(kind, {}).keys())
+
+
+def load(target):
+    """
+    Import implementation named by "module:attribute" string
+
+    :param target:
+    :return:
+    """
+    module_name, _, attributes = target.partition(':')
+    if not attributes:
+        raise IndexError("Implementation %s should be in module:attribute form" % target)
+
+    try:
+        implementation = importlib.import_module(module_name)
+    except ImportError as e:
+        raise IndexError("Failed to import %s: %s" % (module_name, str(e)))
+
+    for attribute in attributes.split('.'):
+        if not hasattr(implementation, attribute):
+            raise IndexError("No %s in module %s" % (attributes, module_name))
+        implementation = getattr(implementation, attribute)
+
+    return implementation
+
+
+def _entry_point(kind, name):
+    try:
+        import pkg_resources
+    except ImportError:
+        return None
+
+    for entry_point in pkg_resources.iter_entry_points('scmt.' + kind, name):
+        return entry_point.load()
+
+    return None
+
+
+def get(kind, name):
+    """
+    Get implementation by name, it is imported on first call
+
+    :param kind: ca, hook or storage
+    :param name: registered name or "module:attribute"
+    :return:
+    """
+    with _lock:
+        target = _registry.get(kind, {}).get(name)
+
+    if target is None and ':' in name:
+        target = name
+    if target is None:
+        # entry points are searched only for unknown names, pkg_resources is slow to import
+        target = _entry_point(kind, name)
+    if target is None:
+        raise IndexError("No such %s %s, known: %s" % (kind, name, ', '.join(names(kind))))
+
+    if isinstance(target, basestring):
+        target = load(target)
+        register(kind, name, target)
+
+    return target
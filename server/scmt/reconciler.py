@@ -0,0 +1,355 @@
+import heapq
+import json
+import threading
+import zlib
+
+import loggable
+from clock import Clock
+
+
+class Reconciler(loggable.Loggable):
+    """
+    Incremental clean-up of one domain. Every host has "next due" time stored
+    in storage together with change cursor of the domain, so each tick checks
+    only hosts which are due or were changed since previous tick, and progress
+    survives restarts.
+
+    Issued hosts are marked under _scmt/changes/<domain>/<hour>/<hostname>,
+    storages with change index return only marks written after the cursor,
+    so polling requests written under host directories don't cause rescans.
+    Full listing is read every list_interval for new and deleted hosts, with
+    marks it is only needed for hosts added or deleted by other replicas.
+    """
+    # storage path for reconciliation state
+    storage_path = '_scmt/reconcile'
+    # tick checks all due hosts, at most this number, so tick of large backlog still saves progress
+    slice_size = 10000
+    # how often should full listing be read, storages with change index read it every
+    # changes_list_interval and when cursor was not read for changes_retention
+    list_interval = 3600
+    changes_list_interval = 86400 * 7
+    # storage path for marks of changed hosts
+    changes_path = '_scmt/changes'
+    # marks are grouped by this period and removed after retention
+    changes_bucket = 3600
+    changes_retention = 86400
+    # check host at least once per this period even if nothing changed
+    max_interval = 86400
+    # retry delay for hosts which failed to be checked
+    retry_interval = 600
+    # how often should state be saved, hosts checked after last save are rechecked after restart
+    save_interval = 300
+    # hosts are saved in this number of keys, so state of large domain fits into storage value limit
+    state_buckets = 256
+
+    def __init__(self, domain, ca, storage, clock=None, membership=None):
+        self._domain = domain
+        self._ca = ca
+        self._storage = storage
+        # hosts owned by other replicas are not checked, None when replica runs alone
+        self.membership = membership
+        self._lock = threading.Lock()
+        self.clock = clock or Clock()
+        # buckets changed since last save
+        self._dirty = set()
+        self._pruned = 0
+        self.state = self.load_state()
+        self._saved = 0
+        # (due, hostname) of all hosts, entries with outdated due are skipped
+        self._queue = [(host['due'], hostname) for hostname, host in self.state['hosts'].items()]
+        heapq.heapify(self._queue)
+
+    def get_state_path(self):
+        if self.membership is not None:
+            # schedules of replicas differ, every replica keeps its own
+            return self.storage_path + '/' + self.membership.node + '/' + self._domain
+
+        return self.storage_path + '/' + self._domain
+
+    def owns(self, hostname):
+        return self.membership is None or self.membership.owns(hostname, self._domain)
+
+    def get_bucket(self, hostname):
+        return (zlib.crc32(hostname) & 0xffffffff) % self.state_buckets
+
+    def get_bucket_path(self, bucket):
+        return self.get_state_path() + '/hosts/%d' % bucket
+
+    def load_state(self):
+        """
+        Read cursor of the domain and schedules of hosts from all buckets
+
+        :return:
+        """
+        try:
+            state = json.loads(self._storage.read(self.get_state_path()))
+        except (IndexError, IOError, ValueError):
+            return {'index': 0, 'listed': 0, 'refreshed': 0, 'hosts': {}}
+
+        if 'hosts' in state:
+            # state of previous version, all hosts in one value
+            self._dirty = set([self.get_bucket(hostname) for hostname in state['hosts']])
+        else:
+            state['hosts'] = {}
+            try:
+                buckets = self._storage.list(self.get_state_path() + '/hosts')
+            except IndexError:
+                buckets = []
+
+            for bucket in buckets:
+                try:
+                    state['hosts'].update(json.loads(self._storage.read(self.get_bucket_path(int(bucket)))))
+                except (IndexError, IOError, ValueError) as e:
+                    # hosts of lost bucket are found again by next full listing
+                    self.log("Failed to load reconciliation bucket %s of %s: %s" % (bucket, self._domain, str(e)))
+                    state['listed'] = 0
+
+        self.log("Loaded reconciliation state of %s, %d hosts" % (self._domain, len(state['hosts'])))
+        return state
+
+    def save_state(self, force=False):
+        """
+        Write cursor and buckets changed since previous save
+
+        :param force: save even if save interval is not passed
+        :return:
+        """
+        now = self.clock.time()
+        if not force and self._saved > now - self.save_interval:
+            return
+
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            buckets = dict([(bucket, {}) for bucket in dirty])
+            for hostname, host in self.state['hosts'].items():
+                bucket = self.get_bucket(hostname)
+                if bucket in buckets:
+                    buckets[bucket][hostname] = host
+            data = json.dumps({'index': self.state['index'], 'listed': self.state['listed'],
+                               'refreshed': self.state.get('refreshed', 0)})
+            self._saved = now
+
+        try:
+            for bucket in sorted(buckets):
+                if buckets[bucket]:
+                    self._storage.write(self.get_bucket_path(bucket), json.dumps(buckets[bucket]))
+                else:
+                    self._storage.delete(self.get_bucket_path(bucket))
+                dirty.discard(bucket)
+
+            self._storage.write(self.get_state_path(), data)
+        except (IndexError, IOError) as e:
+            self.log("Failed to save reconciliation state of %s: %s" % (self._domain, str(e)))
+            with self._lock:
+                self._dirty.update(dirty)
+
+    def get_changes_path(self):
+        return self.changes_path + '/' + self._domain
+
+    def mark(self, hostname):
+        """
+        Mark host as changed, so all replicas check it on next tick
+
+        :param hostname:
+        :return:
+        """
+        if not hasattr(self._storage, 'changes'):
+            return
+
+        bucket = int(self.clock.time() // self.changes_bucket)
+        try:
+            self._storage.write('%s/%d/%s' % (self.get_changes_path(), bucket, hostname), str(self.clock.time()))
+        except (IndexError, IOError) as e:
+            self.log("Failed to mark %s as changed: %s" % (hostname, str(e)))
+
+    def prune_changes(self):
+        """
+        Remove marks older than retention
+
+        :return:
+        """
+        oldest = int((self.clock.time() - self.changes_retention) // self.changes_bucket)
+        try:
+            buckets = self._storage.list(self.get_changes_path())
+        except IndexError:
+            return
+
+        for bucket in buckets:
+            if bucket.isdigit() and int(bucket) < oldest:
+                self._storage.delete(self.get_changes_path() + '/' + bucket)
+
+    def relist(self):
+        """
+        Read full listing of the domain, new hosts become due immediately.
+        Only hosts owned by this replica are kept
+
+        :return: number of added hosts
+        """
+        try:
+            listed = set([hostname for hostname in self._storage.list(self._domain) if self.owns(hostname)])
+        except IndexError:
+            listed = set()
+
+        added = 0
+        with self._lock:
+            hosts = self.state['hosts']
+            for hostname in hosts.keys():
+                if hostname not in listed:
+                    del hosts[hostname]
+                    self._dirty.add(self.get_bucket(hostname))
+
+            for hostname in listed:
+                if hostname not in hosts:
+                    hosts[hostname] = {'due': 0}
+                    self._dirty.add(self.get_bucket(hostname))
+                    heapq.heappush(self._queue, (0, hostname))
+                    added += 1
+
+            self.state['listed'] = self.clock.time()
+
+        return added
+
+    def refresh(self):
+        """
+        Update list of known hosts, changed and new hosts become due immediately
+
+        :return: number of hosts which became due
+        """
+        now = self.clock.time()
+        changed = 0
+        indexed = hasattr(self._storage, 'changes')
+        if not indexed:
+            if self.state['listed'] <= now - self.list_interval:
+                changed += self.relist()
+        else:
+            # marks older than retention are removed, cursor not read for so long could miss them
+            if self.state['listed'] <= now - self.changes_list_interval or \
+                    self.state.get('refreshed', 0) <= now - self.changes_retention:
+                changed += self.relist()
+
+            if self._pruned <= now - self.changes_bucket:
+                self._pruned = now
+                self.prune_changes()
+
+            index, marks = self._storage.changes(self.get_changes_path(), self.state['index'])
+            with self._lock:
+                hosts = self.state['hosts']
+                for hostname in set([key.split('/')[-1] for key in marks or {}]):
+                    if hosts.get(hostname, {}).get('due') == 0 or not self.owns(hostname):
+                        continue
+
+                    hosts[hostname] = {'due': 0}
+                    self._dirty.add(self.get_bucket(hostname))
+                    heapq.heappush(self._queue, (0, hostname))
+                    changed += 1
+
+                self.state['index'] = index
+                self.state['refreshed'] = now
+
+        if changed:
+            self.log("%d hosts of %s changed since last check" % (changed, self._domain))
+
+        return changed
+
+    def next_slice(self):
+        """
+        Get hosts which should be checked now, most overdue first
+
+        :return:
+        """
+        now = self.clock.time()
+        due = []
+        with self._lock:
+            hosts = self.state['hosts']
+            while self._queue and self._queue[0][0] <= now and len(due) < self.slice_size:
+                entry = heapq.heappop(self._queue)
+                host = hosts.get(entry[1])
+                if host is None or host['due'] != entry[0] or entry[1] in due:
+                    continue
+
+                if not self.owns(entry[1]):
+                    # owner checks it
+                    del hosts[entry[1]]
+                    self._dirty.add(self.get_bucket(entry[1]))
+                    continue
+
+                due.append(entry[1])
+
+            # hosts stay due until they are checked
+            for hostname in due:
+                heapq.heappush(self._queue, (hosts[hostname]['due'], hostname))
+
+            if len(self._queue) > 2 * len(hosts) + self.slice_size:
+                self._queue = [(host['due'], hostname) for hostname, host in hosts.items()]
+                heapq.heapify(self._queue)
+
+        return due
+
+    def rebalance(self):
+        """
+        Take hosts which became owned by this replica and forget hosts of other replicas
+
+        :return: number of taken hosts
+        """
+        taken = self.relist()
+        if taken:
+            self.log("Took %d hosts of %s from other replicas" % (taken, self._domain))
+
+        return taken
+
+    def next_due(self):
+        """
+        Get time when the next host should be checked
+
+        :return: timestamp or None when there are no hosts
+        """
+        with self._lock:
+            hosts = self.state['hosts']
+            while self._queue:
+                due, hostname = self._queue[0]
+                if hostname in hosts and hosts[hostname]['due'] == due:
+                    return due
+
+                heapq.heappop(self._queue)
+
+        return None
+
+    def check(self, hostname):
+        """
+        Run clean-up for host and schedule its next check
+
+        :param hostname:
+        :return:
+        """
+        try:
+            due = self._ca.cleanup_host(hostname)
+        except Exception as e:
+            self.log("Failed to check %s: %s" % (hostname, str(e)))
+            due = self.clock.time() + self.retry_interval
+
+        with self._lock:
+            self._dirty.add(self.get_bucket(hostname))
+            if due is None:
+                self.state['hosts'].pop(hostname, None)
+            elif hostname in self.state['hosts']:
+                due = min(due, self.clock.time() + self.max_interval)
+                self.state['hosts'][hostname]['due'] = due
+                heapq.heappush(self._queue, (due, hostname))
+
+    def tick(self, executor=None):
+        """
+        Check one slice of due hosts and persist progress
+
+        :param executor: pool used to check hosts in parallel
+        :return: number of checked hosts
+        """
+        self.refresh()
+        hostnames = self.next_slice()
+        if executor:
+            executor.map(self.check, hostnames)
+        else:
+            for hostname in hostnames:
+                self.check(hostname)
+
+        self.save_state()
+        return len(hostnames)
@@ -0,0 +1,374 @@
+"""
+Multi-process mode. Domains are split between worker processes, every worker
+runs its own Manager with storages, CAs and hooks of its domains and serves
+calls over unix socket. API process keeps only ShardRouter, which has the same
+interface as Manager and forwards each call to worker owning the hostname, so
+issuance, reconciliation and response serialization of different domains run
+on different cores.
+"""
+import Queue
+import os
+import threading
+import time
+from multiprocessing import Process
+from multiprocessing.connection import Client, Listener
+
+import loggable
+import metrics
+import storages.builder
+import tracing
+from cluster import Membership
+from manager import Manager
+
+# Manager methods which could be called by API process
+METHODS = ['get_key', 'get_supported_keys_algo', 'cert', 'cert_response', 'watch', 'get_fingerprints',
+           'read_key', 'get_full_chain', 'collect_metrics', 'get_traces', 'get_readiness']
+
+
+def split_domains(domains, processes):
+    """
+    Assign domains to shards, domains are sorted so every start gives same assignment
+
+    :param domains: domain => options, as returned by ConfigReader.get_domains()
+    :param processes: number of shards, never more than number of domains
+    :return: list of dicts domain => options
+    """
+    shards = [{} for _ in range(max(1, min(processes, len(domains))))]
+    for i, domain in enumerate(sorted(domains)):
+        shards[i % len(shards)][domain] = domains[domain]
+
+    return shards
+
+
+def find_domain(domains, hostname):
+    """
+    Find most specific domain serving hostname
+
+    :param domains: list of domains
+    :param hostname:
+    :return: domain or None
+    """
+    found = None
+    for domain in domains:
+        if hostname[-len(domain)-1:] != '.' + domain and hostname != domain:
+            continue
+
+        if found is None or len(domain) > len(found):
+            found = domain
+
+    return found
+
+
+class ShardWorker(Process, loggable.Loggable):
+    """
+    Process running Manager of one shard
+    """
+    def __init__(self, number, address, authkey, config, domains):
+        Process.__init__(self, name='shard-%d' % number)
+        self.daemon = True
+        self.number = number
+        self.address = address
+        self.authkey = authkey
+        self.config = config
+        self.domains = domains
+        self.manager = None
+
+    def run(self):
+        loggable.reset()
+        threading.currentThread().name = self.name
+        self.log("Starting shard with domains: %s" % ', '.join(sorted(self.domains)))
+
+        storage_configs = self.config.get_storages()
+        storage_list = {}
+        for storage_name in storage_configs:
+            storage_list[storage_name] = storages.builder.build(storage_configs[storage_name])
+
+        membership = None
+        if self.config.cluster_storage:
+            # every shard is separate replica serving its domains
+            membership = Membership(storage_list[self.config.cluster_storage], '%s-%d' % (self.config.node, self.number))
+
+        self.manager = Manager(self.config.dir, self.domains, storage_list,
+                               issue_workers=self.config.issue_workers, cleanup_workers=self.config.cleanup_workers,
+                               membership=membership, init_workers=self.config.init_workers)
+        self.manager.daemon = True
+        self.manager.start()
+        if self.config.profile_interval:
+            tracing.Profiler(self.config.profile_interval).start()
+
+        watchdog = threading.Thread(target=self.watch_parent, args=(os.getppid(),), name='watchdog')
+        watchdog.daemon = True
+        watchdog.start()
+
+        listener = Listener(self.address, 'AF_UNIX', authkey=self.authkey)
+        self.log("Shard is listening on %s" % self.address)
+        while True:
+            connection = listener.accept()
+            handler = threading.Thread(target=self.serve, args=(connection,), name='%s-ipc' % self.name)
+            handler.daemon = True
+            handler.start()
+
+    def watch_parent(self, parent):
+        """
+        Exit when API process is gone, otherwise worker would keep renewing certificates forever
+
+        :param parent: pid of API process
+        :return:
+        """
+        while os.getppid() == parent:
+            time.sleep(1)
+
+        self.log("API process %d exited, stopping shard" % parent)
+        loggable.flush()
+        os._exit(0)
+
+    def serve(self, connection):
+        """
+        Execute calls received from one connection of API process
+
+        :param connection:
+        :return:
+        """
+        while True:
+            try:
+                method, args = connection.recv()
+            except (EOFError, IOError):
+                break
+
+            if method not in METHODS:
+                response = ('error', "Unknown shard method %s" % method)
+            else:
+                try:
+                    response = ('ok', getattr(self.manager, method)(*args))
+                except Exception as e:
+                    response = ('error', "%s: %s" % (e.__class__.__name__, str(e)))
+
+            try:
+                connection.send(response)
+            except (EOFError, IOError):
+                break
+
+        connection.close()
+
+
+class ShardRouter(loggable.Loggable):
+    """
+    Manager replacement in API process, forwards calls to worker owning hostname
+    """
+    # how often should dead workers be restarted
+    supervise_interval = 5
+    # for how long should router wait for worker socket on start
+    start_timeout = 60
+
+    def __init__(self, config, processes):
+        self.config = config
+        self._authkey = os.urandom(32)
+        self._domains = {}
+        self._idle = {}
+        self._idleLock = threading.Lock()
+        self.workers = []
+
+        for number, domains in enumerate(split_domains(config.get_domains(), processes)):
+            for domain in domains:
+                self._domains[domain] = number
+            self._idle[number] = []
+            self.workers.append(self.create_worker(number, domains))
+
+    def create_worker(self, number, domains):
+        address = os.path.join(self.config.dir, 'shard-%d.sock' % number)
+        return ShardWorker(number, address, self._authkey, self.config, domains)
+
+    def start(self):
+        """
+        Start workers and wait until they accept connections
+
+        :return:
+        """
+        if not os.path.exists(self.config.dir):
+            os.makedirs(self.config.dir)
+
+        for worker in self.workers:
+            self.start_worker(worker)
+
+        deadline = time.time() + self.start_timeout
+        for worker in self.workers:
+            while not os.path.exists(worker.address) and time.time() < deadline:
+                time.sleep(0.1)
+
+        supervisor = threading.Thread(target=self.supervise, name='shards')
+        supervisor.daemon = True
+        supervisor.start()
+
+    def start_worker(self, worker):
+        # socket left by previous run would look like ready worker
+        if os.path.exists(worker.address):
+            os.unlink(worker.address)
+
+        worker.start()
+        self.log("Started shard %d, pid %d" % (worker.number, worker.pid))
+
+    def supervise(self):
+        while True:
+            time.sleep(self.supervise_interval)
+            for number in range(len(self.workers)):
+                worker = self.workers[number]
+                if worker.is_alive():
+                    continue
+
+                self.log("Shard %d exited with code %s, restarting" % (number, worker.exitcode), level='error')
+                with self._idleLock:
+                    for connection in self._idle[number]:
+                        connection.close()
+                    self._idle[number] = []
+
+                self.workers[number] = self.create_worker(number, worker.domains)
+                self.start_worker(self.workers[number])
+
+    def get_shard(self, hostname):
+        domain = find_domain(self._domains.keys(), hostname)
+        if domain is None:
+            raise RuntimeError("Failed to detect CA for %s" % hostname)
+
+        return self._domains[domain]
+
+    def call(self, shard, method, *args):
+        """
+        Call Manager method in worker process, connections are reused
+
+        :param shard:
+        :param method:
+        :param args:
+        :return:
+        """
+        with self._idleLock:
+            connection = self._idle[shard].pop() if self._idle[shard] else None
+
+        try:
+            if connection is None:
+                connection = Client(self.workers[shard].address, 'AF_UNIX', authkey=self._authkey)
+            connection.send((method, args))
+            response = connection.recv()
+        except (EOFError, IOError) as e:
+            if connection is not None:
+                connection.close()
+            raise RuntimeError("Shard %d is not available: %s" % (shard, str(e)))
+
+        with self._idleLock:
+            self._idle[shard].append(connection)
+
+        if response[0] == 'error':
+            raise RuntimeError(response[1])
+
+        return response[1]
+
+    def get_key(self, req):
+        return self.call(self.get_shard(req['hostname']), 'get_key', req)
+
+    def get_supported_keys_algo(self, hostname):
+        return self.call(self.get_shard(hostname), 'get_supported_keys_algo', hostname)
+
+    def cert(self, req):
+        return self.call(self.get_shard(req['hostname']), 'cert', req)
+
+    def cert_response(self, req):
+        return self.call(self.get_shard(req['hostname']), 'cert_response', req)
+
+    def get_key_path(self, hostname, scratch):
+        return scratch.write('key.pem', self.call(self.get_shard(hostname), 'read_key', hostname))
+
+    def get_fullchain_path(self, hostname, scratch):
+        return scratch.write('fullchain.pem', self.call(self.get_shard(hostname), 'get_full_chain', hostname))
+
+    def watch(self, req):
+        """
+        Forward watch request, hostnames of several shards are watched in parallel
+        and first change is returned. Watches of other shards end by their timeout
+
+        :param req:
+        :return:
+        """
+        groups = {}
+        for hostname in req['hostnames']:
+            try:
+                shard = self.get_shard(hostname)
+            except RuntimeError:
+                # unknown hostname never changes, same as in Manager
+                continue
+            groups.setdefault(shard, {})[hostname] = req['hostnames'][hostname]
+
+        if not groups:
+            return {'status': 'timeout'}
+
+        if len(groups) == 1:
+            shard, hostnames = groups.items()[0]
+            return self.call(shard, 'watch', dict(req, hostnames=hostnames))
+
+        results = Queue.Queue()
+
+        def watch_shard(shard, hostnames):
+            try:
+                results.put(self.call(shard, 'watch', dict(req, hostnames=hostnames)))
+            except RuntimeError as e:
+                self.log("Failed to watch shard %d: %s" % (shard, e.message))
+                results.put({'status': 'timeout'})
+
+        for shard in groups:
+            watcher = threading.Thread(target=watch_shard, args=(shard, groups[shard]), name='watch-shard-%d' % shard)
+            watcher.daemon = True
+            watcher.start()
+
+        for _ in groups:
+            result = results.get()
+            if result['status'] == 'changed':
+                return result
+
+        return {'status': 'timeout'}
+
+    def render_metrics(self):
+        """
+        Metrics of API process together with metrics of all workers labeled by shard
+
+        :return:
+        """
+        collected = []
+        for shard in range(len(self.workers)):
+            try:
+                collected.append(self.call(shard, 'collect_metrics', [('shard', str(shard))]))
+            except RuntimeError as e:
+                self.log("Failed to collect metrics of shard %d: %s" % (shard, e.message))
+
+        return metrics.render(*collected)
+
+    def get_readiness(self):
+        """
+        Zones of all workers, zones of unavailable worker are reported as failed
+
+        :return:
+        """
+        readiness = {'ready': True, 'zones': {}}
+        for shard in range(len(self.workers)):
+            try:
+                result = self.call(shard, 'get_readiness')
+            except RuntimeError as e:
+                result = {'ready': False, 'zones': dict([(domain, {'status': 'failed', 'error': str(e), 'seconds': 0})
+                                                         for domain in self.workers[shard].domains])}
+
+            readiness['ready'] = readiness['ready'] and result['ready']
+            readiness['zones'].update(result['zones'])
+
+        return readiness
+
+    def get_traces(self, limit=10):
+        traces = {'slowest': [], 'active': []}
+        for shard in range(len(self.workers)):
+            try:
+                result = self.call(shard, 'get_traces', limit)
+            except RuntimeError as e:
+                self.log("Failed to collect traces of shard %d: %s" % (shard, e.message))
+                continue
+
+            traces['slowest'] += result['slowest']
+            traces['active'] += result['active']
+
+        traces['slowest'] = sorted(traces['slowest'], key=lambda trace: -trace['duration'])[:limit]
+        return traces
@@ -1,3 +0,0 @@
-__author__ = 'dev'
-
-import consul
\ No newline at end of file
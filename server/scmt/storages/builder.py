@@ -1,8 +1,11 @@
-import consul
+import scmt.plugins
 
 
 def build(options):
-    if options['backend'] == 'consul':
-        return consul.Consul(options['address'])
-    else:
-        raise IndexError("No such backend %s" % options['backend'])
\ No newline at end of file
+    """
+    Create storage by backend name, implementation is imported on first use
+
+    :param options: storage section of config
+    :return:
+    """
+    return scmt.plugins.get('storage', options['backend'])(options)
@@ -3,22 +3,52 @@ import json
 import base64
 import threading
 import time
+import scmt.loggable
+import scmt.metrics
+import scmt.tracing
 
 
-class Consul:
+class Consul(scmt.loggable.Loggable):
     """
     Consul backend for storing credentials
     """
-    def __init__(self, consul_addr='172.17.0.1:8500', logger=None):
+    # write only every N-th debug record of reads and writes
+    log_sample = 100
+
+    def __init__(self, consul_addr='172.17.0.1:8500'):
         self.consul_addr = consul_addr.replace('http://', '').replace('/','')
         self.cache_time = 10
-        self.logger = logger
         self._cache = {}
         self._cacheLock = threading.Lock()
 
-    def log(self, msg):
-        if self.logger:
-            self.logger.log('[CONSUL] ' + msg)
+    @classmethod
+    def from_options(cls, options):
+        return cls(options['address'])
+
+    def _http(self, op, method, url, **kwargs):
+        """
+        Run HTTP request to consul, latency and errors are counted in metrics
+
+        :param op: operation name for metrics
+        :param method:
+        :param url:
+        :return:
+        """
+        started = time.time()
+        try:
+            with scmt.tracing.span('consul.' + op):
+                response = requests.request(method, url, **kwargs)
+        except requests.RequestException:
+            scmt.metrics.STORAGE_ERRORS.inc(('consul', op))
+            raise
+        finally:
+            scmt.metrics.STORAGE.observe(time.time() - started, ('consul', op))
+
+        if response.status_code >= 500:
+            scmt.metrics.STORAGE_ERRORS.inc(('consul', op))
+            self.log("Consul request failed", level='warning', op=op, url=url, status=response.status_code)
+
+        return response
 
     def exists(self, path):
         try:
@@ -39,9 +69,9 @@ class Consul:
         :return:
         """
         url = 'http://%s/v1/kv/%s?keys' % (self.consul_addr, path)
-        self.log('[CONSUL] GET KEYS %s' % url)
+        self.log("Consul list", level='debug', sample=self.log_sample, path=path)
 
-        response = requests.get(url, timeout=10)
+        response = self._http('list', 'GET', url, timeout=10)
 
         if len(response.text) == 0:
             raise IndexError("No such directory %s" % path)
@@ -68,12 +98,15 @@ class Consul:
         :param key:
         :return:
         """
-        if key in self._cache and self._cache[key]['expire'] < time.time():
+        key = key.lstrip('/')
+        if key in self._cache and self._cache[key]['expire'] > time.time():
+            scmt.metrics.CACHE.inc(('consul', 'hit'))
             return self._cache[key]['value']
 
+        scmt.metrics.CACHE.inc(('consul', 'miss'))
         url = 'http://%s/v1/kv/%s' % (self.consul_addr, key)
-        self.log("[CONSUL] GET %s" % url)
-        response = requests.get(url, timeout=10)
+        self.log("Consul read", level='debug', sample=self.log_sample, key=key)
+        response = self._http('read', 'GET', url, timeout=10)
 
         if len(response.text) == 0:
             raise IndexError("No key text found! Key: %s" % url)
@@ -89,20 +122,72 @@ class Consul:
 
         return value
 
-    def write(self, key, value):
+    def write(self, key, value, session=None):
+        """
+        Write key value
+
+        :param key:
+        :param value:
+        :param session: acquire key by session, key is deleted when session expires
+        :return: False when key is held by other session, IOError is raised when write failed
+        """
         if key[0] != '/':
             key = '/%s' % key
 
         url = 'http://%s/v1/kv%s' % (self.consul_addr, key)
-        self.log("PUT %s" % url)
-        response = requests.put(url, data=str(value))
+        if session:
+            url += '?acquire=%s' % session
+        self.log("Consul write", level='debug', sample=self.log_sample, key=key)
+        response = self._http('write', 'PUT', url, data=str(value))
+        if response.status_code >= 300:
+            # e.g. 413 when value exceeds consul limit of 512 KB
+            raise IOError("Failed to write %s, consul responded with %d" % (key, response.status_code))
+        if session and response.text.strip() != 'true':
+            return False
 
-        self.log("RESPONSE: %s" % str(response.text))
         with self._cacheLock:
-            self._cache[key] = {'expire' : time.time() + self.cache_time, 'value': value}
+            self._cache[key.lstrip('/')] = {'expire' : time.time() + self.cache_time, 'value': value}
+
+        return True
+
+    def create_session(self, name, ttl):
+        """
+        Create session which deletes its keys when it is not renewed during ttl
+
+        :param name:
+        :param ttl: seconds
+        :return: session id
+        """
+        url = 'http://%s/v1/session/create' % self.consul_addr
+        response = self._http('session', 'PUT', url, timeout=10, data=json.dumps({
+            'Name': name,
+            'TTL': '%ds' % ttl,
+            'Behavior': 'delete',
+            'LockDelay': '0s'
+        }))
+        response.raise_for_status()
+
+        return json.loads(response.text)['ID']
+
+    def renew_session(self, session):
+        """
+        Renew session TTL
+
+        :param session:
+        :return: False when session doesn't exist anymore
+        """
+        url = 'http://%s/v1/session/renew/%s' % (self.consul_addr, session)
+        response = self._http('session', 'PUT', url, timeout=10)
+        if response.status_code == 404:
+            return False
+        response.raise_for_status()
 
         return True
 
+    def destroy_session(self, session):
+        url = 'http://%s/v1/session/destroy/%s' % (self.consul_addr, session)
+        self._http('session', 'PUT', url, timeout=10)
+
     def _clean_cache(self):
         """
         Remove items from cache
@@ -110,7 +195,7 @@ class Consul:
         :return:
         """
         for key in self._cache.keys():
-            if self._cache[key]['expire'] < time.time():
+            if self._cache[key]['expire'] > time.time():
                 continue
 
             del(self._cache[key])
@@ -120,13 +205,71 @@ class Consul:
             key = '/%s' % key
 
         url = 'http://%s/v1/kv%s?recurse=true' % (self.consul_addr, key)
-        self.log("DELETE %s" % url)
-        response = requests.delete(url, timeout=10)
-        self.log("[RESPONSE]: %s" % str(response.text))
+        self.log("Consul delete", level='debug', key=key)
+        self._http('delete', 'DELETE', url, timeout=10)
+
+        with self._cacheLock:
+            prefix = key.lstrip('/')
+            for cached in self._cache.keys():
+                if cached == prefix or cached.startswith(prefix + '/'):
+                    del(self._cache[cached])
 
         return True
 
+    def watch(self, path, index=0, wait='60s'):
+        """
+        Wait for changes of keys under path using blocking query
 
+        :param path:
+        :param index: index returned by previous call, 0 returns current state immediately
+        :param wait: maximum time to wait for changes
+        :return: tuple of new index and dict of keys values
+        """
+        url = 'http://%s/v1/kv/%s?recurse&index=%d&wait=%s' % (self.consul_addr, path, index, wait)
+        response = self._http('watch', 'GET', url, timeout=int(wait.rstrip('s')) + 10)
+
+        new_index = int(response.headers.get('X-Consul-Index', 0))
+        if new_index < index:
+            # index went backwards, consul asks clients to restart watch
+            new_index = 0
+
+        if response.status_code == 404:
+            return new_index, {}
+        response.raise_for_status()
 
+        items = {}
+        for item in json.loads(response.text):
+            items[item['Key']] = base64.decodestring(item['Value']) if item['Value'] else ''
 
+        return new_index, items
 
+    def changes(self, path, index=0):
+        """
+        Get keys of path modified after index. Cheap keys query is used first,
+        so nothing is transferred when path is not changed since index
+
+        :param path:
+        :param index: index returned by previous call
+        :return: tuple of new index and dict key relative to path => modify index, dict is None when nothing changed
+        """
+        path = path.strip('/') + '/'
+        url = 'http://%s/v1/kv/%s?keys&separator=/' % (self.consul_addr, path)
+        response = self._http('changes', 'GET', url, timeout=10)
+
+        new_index = int(response.headers.get('X-Consul-Index', 0))
+        if index and new_index == index:
+            return new_index, None
+
+        url = 'http://%s/v1/kv/%s?recurse' % (self.consul_addr, path)
+        self.log("Consul changes", level='debug', path=path, index=new_index)
+        response = self._http('changes', 'GET', url, timeout=30)
+        if response.status_code == 404:
+            return int(response.headers.get('X-Consul-Index', 0)), {}
+        response.raise_for_status()
+
+        keys = {}
+        for item in json.loads(response.text):
+            if item['ModifyIndex'] > index:
+                keys[str(item['Key'][len(path):])] = item['ModifyIndex']
+
+        return int(response.headers.get('X-Consul-Index', 0)), keys
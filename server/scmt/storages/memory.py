@@ -0,0 +1,87 @@
+import threading
+
+
+class MemoryStorage:
+    """
+    In-memory storage for tests and simulations. Keys behave like in Consul:
+    key could have value and subkeys at the same time, delete removes subkeys
+    and directory exists while it has keys
+    """
+    def __init__(self):
+        # node is [value or None, name => child node]
+        self.root = [None, {}]
+        self._lock = threading.Lock()
+
+    def _find(self, path):
+        node = self.root
+        for part in path.strip('/').split('/'):
+            if part not in node[1]:
+                return None
+            node = node[1][part]
+
+        return node
+
+    def read(self, key):
+        with self._lock:
+            node = self._find(key)
+            if node is None or node[0] is None:
+                raise IndexError("No such key %s" % key)
+
+            return node[0]
+
+    def write(self, key, value):
+        with self._lock:
+            node = self.root
+            for part in key.strip('/').split('/'):
+                node = node[1].setdefault(part, [None, {}])
+            node[0] = value
+
+        return True
+
+    def exists(self, path):
+        with self._lock:
+            return self._find(path) is not None
+
+    def list(self, path):
+        with self._lock:
+            node = self._find(path)
+            if node is None or not node[1]:
+                raise IndexError("No such directory %s" % path)
+
+            return node[1].keys()
+
+    def keys(self, path=''):
+        """
+        All keys with values under path
+
+        :param path:
+        :return:
+        """
+        with self._lock:
+            node = self._find(path) if path else self.root
+            found = []
+            pending = [(path.strip('/'), node)] if node else []
+            while pending:
+                prefix, node = pending.pop()
+                if node[0] is not None:
+                    found.append(prefix)
+                for name, child in node[1].items():
+                    pending.append((prefix + '/' + name if prefix else name, child))
+
+        return sorted(found)
+
+    def delete(self, key):
+        with self._lock:
+            parts = key.strip('/').split('/')
+            nodes = [self.root]
+            for part in parts:
+                if part not in nodes[-1][1]:
+                    return
+                nodes.append(nodes[-1][1][part])
+
+            # nodes[i] is named parts[i - 1], empty parents are removed too
+            del nodes[-2][1][parts[-1]]
+            for i in range(len(parts) - 1, 0, -1):
+                if nodes[i][0] is not None or nodes[i][1]:
+                    break
+                del nodes[i - 1][1][parts[i - 1]]
@@ -0,0 +1,28 @@
+import unittest
+import memory
+
+
+class MemoryStorageTestCase(unittest.TestCase):
+    def test_keys_like_consul(self):
+        kv = memory.MemoryStorage()
+        kv.write('a/state', 'meta')
+        kv.write('a/state/hosts/1', 'bucket')
+        kv.write('a/host/requests/ip', '1')
+
+        # key has value and subkeys at the same time
+        self.assertEqual(kv.read('a/state'), 'meta')
+        self.assertEqual(sorted(kv.list('a')), ['host', 'state'])
+        self.assertRaises(IndexError, kv.read, 'a/host')
+
+        # empty directories disappear with their last key
+        kv.delete('a/host/requests/ip')
+        self.assertEqual(kv.list('a'), ['state'])
+        self.assertFalse(kv.exists('a/host'))
+
+        kv.delete('a/state')
+        self.assertEqual(kv.keys(), [])
+        self.assertRaises(IndexError, kv.list, 'a')
+
+
+if __name__ == '__main__':
+    unittest.main()
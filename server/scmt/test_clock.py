@@ -0,0 +1,58 @@
+import threading
+import unittest
+
+from clock import SimulatedClock
+
+
+class SimulatedClockTestCase(unittest.TestCase):
+    def test_sleepers_wake_in_virtual_time(self):
+        clock = SimulatedClock(1000)
+        woken = []
+
+        def sleeper(seconds):
+            clock.sleep(seconds)
+            woken.append((seconds, clock.time()))
+            clock.sleep(1000)
+
+        for seconds in [100, 30]:
+            thread = threading.Thread(target=sleeper, args=(seconds,))
+            thread.daemon = True
+            thread.start()
+        clock.wait_blocked(2)
+
+        self.assertEqual(clock.advance(50), 1050)
+        self.assertEqual(woken, [(30, 1030)])
+        clock.advance(50)
+        self.assertEqual(woken, [(30, 1030), (100, 1100)])
+
+    def test_notified_waiter_runs_before_time_moves(self):
+        clock = SimulatedClock(0)
+        condition = threading.Condition()
+        tasks = []
+        done = []
+
+        def worker():
+            while True:
+                with condition:
+                    if not tasks:
+                        clock.wait(condition, 60)
+                    if tasks:
+                        tasks.pop()
+                        done.append(clock.time())
+                        continue
+                clock.sleep(0)
+
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        clock.wait_blocked(1)
+
+        with condition:
+            tasks.append('task')
+            clock.notify(condition)
+        clock.advance(10)
+        self.assertEqual(done, [0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+
+from clock import SimulatedClock
+from cluster import Membership, Ring
+from storages.memory import MemoryStorage
+
+
+class ClusterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.hostnames = ['host%d.example.com' % i for i in range(3000)]
+
+    def test_ring_moves_only_share_of_joined_node(self):
+        before = Ring(['a', 'b', 'c'])
+        after = Ring(['a', 'b', 'c', 'd'])
+
+        owners = dict([(hostname, before.owner(hostname)) for hostname in self.hostnames])
+        for node in ['a', 'b', 'c']:
+            share = owners.values().count(node) / float(len(self.hostnames))
+            self.assertTrue(0.2 < share < 0.47, share)
+
+        moved = [hostname for hostname in self.hostnames if after.owner(hostname) != owners[hostname]]
+        self.assertTrue(0.15 < len(moved) / float(len(self.hostnames)) < 0.35)
+        self.assertEqual(set([after.owner(hostname) for hostname in moved]), set(['d']))
+
+    def test_members_split_hostnames_and_forward(self):
+        storage = MemoryStorage()
+        clock = SimulatedClock(10 ** 6)
+        members = [Membership(storage, node, clock) for node in ['a', 'b']]
+        received = []
+        for membership in members:
+            membership.set_domains(['example.com'])
+            membership.set_receiver(lambda hostname, force: received.append((hostname, force)))
+            membership.register()
+        for membership in members:
+            self.assertTrue(membership.refresh())
+
+        owned = [[hostname for hostname in self.hostnames if membership.owns(hostname, 'example.com')]
+                 for membership in members]
+        self.assertEqual(len(owned[0]) + len(owned[1]), len(self.hostnames))
+        self.assertFalse(set(owned[0]) & set(owned[1]))
+
+        members[0].forward(owned[1][0], 'example.com')
+        members[0].forward(owned[1][0], 'example.com')
+        self.assertEqual(members[0].receive(), 0)
+        self.assertEqual(members[1].receive(), 1)
+        self.assertEqual(received, [(owned[1][0], False)])
+
+        # b stops renewing registration, a takes all hostnames
+        clock.advance(Membership.ttl + 1)
+        members[0].register()
+        self.assertTrue(members[0].refresh())
+        self.assertTrue(members[0].owns(owned[1][0], 'example.com'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import StringIO
+import sys
+import unittest
+
+import loggable
+
+
+class Component(loggable.Loggable):
+    def hot(self, number):
+        self.log("Hot path", sample=10, number=number)
+
+
+class LoggableTestCase(unittest.TestCase):
+    def setUp(self):
+        loggable.flush()
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def tearDown(self):
+        loggable.flush()
+        sys.stdout = self.stdout
+        loggable.set_level('info')
+
+    def output(self):
+        loggable.flush()
+        return sys.stdout.getvalue()
+
+    def test_levels_and_fields(self):
+        component = Component()
+        component.log("Hidden", level='debug')
+        component.log("Issued", hostname='a.example.com', reason='renew before expire')
+        loggable.set_level('error')
+        component.log("Also hidden", level='warning')
+
+        lines = self.output().splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertIn('[info] Issued hostname=a.example.com reason="renew before expire"', lines[0])
+
+    def test_unicode_fields(self):
+        component = Component()
+        component.log(u"Caf\xe9 issued", name=u'caf\xe9', quoted=u'caf\xe9 bar')
+        component.log("Issued", name='after')
+
+        lines = self.output().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertIn('[info] Caf\xc3\xa9 issued name=caf\xc3\xa9 quoted="caf\\u00e9 bar"', lines[0])
+        self.assertIn('[info] Issued name=after', lines[1])
+
+    def test_sampling(self):
+        component = Component()
+        for number in range(25):
+            component.hot(number)
+
+        lines = self.output().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertIn('number=0 sampled=10', lines[0])
+        self.assertIn('number=20 sampled=10', lines[2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from manager import Manager
+
+
+class ManagerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_zones_are_pending_until_initialized(self):
+        domains = {'a.com': {'storage': 'kv'}, 'b.com': {'storage': 'kv'}, 'c.com': {'storage': 'kv'}}
+        manager = Manager(self.dir, domains, {'kv': None}, init_workers=0)
+
+        self.assertEqual(manager.cert({'hostname': 'www.c.com', 'ip': '127.0.0.1'}), {'status': 'pending'})
+        self.assertEqual(list(manager._pending)[0], 'c.com')
+        self.assertRaises(RuntimeError, manager.get_ca, 'www.c.com')
+        self.assertFalse(manager.get_readiness()['ready'])
+
+    def test_failed_zone(self):
+        manager = Manager(self.dir, {'a.com': {'storage': 'kv'}}, {'kv': None})
+
+        self.assertFalse(manager.wait_ready(10))
+        readiness = manager.get_readiness()
+        self.assertEqual(readiness['zones']['a.com']['status'], 'failed')
+        self.assertIn('no CA', readiness['zones']['a.com']['error'])
+
+    def test_queue_order_and_active_hostnames(self):
+        manager = Manager(self.dir, {}, {}, init_workers=0)
+        for hostname in ['a.com', 'b.com', 'a.com', 'c.com']:
+            manager.add_to_queue(hostname)
+        manager.add_to_queue('b.com', force=True)
+
+        self.assertEqual(list(manager.queue), ['a.com', 'b.com', 'c.com'])
+        self.assertEqual(manager.get_from_queue(0), ('a.com', False))
+        # hostname queued again while being issued waits until its issue is done
+        manager.add_to_queue('a.com')
+        self.assertEqual(manager.get_from_queue(0), ('b.com', True))
+        self.assertEqual(manager.get_from_queue(0), ('c.com', False))
+        self.assertIsNone(manager.get_from_queue(0))
+
+        manager.task_done('a.com')
+        self.assertEqual(manager.get_from_queue(0), ('a.com', False))
+
+        # successful issue already covers renewal queued during it
+        manager.add_to_queue('a.com', force=True)
+        manager.task_done('a.com', issued=True)
+        self.assertIsNone(manager.get_from_queue(0))
+
+    def test_watch_rereads_only_issued_hostnames(self):
+        manager = Manager(self.dir, {}, {}, init_workers=0)
+        fingerprints = {'a.com': 'a1', 'b.com': 'b1', 'c.com': 'c1'}
+        reads = []
+
+        def get_fingerprints(hostnames):
+            reads.append(sorted(hostnames))
+            return dict([(hostname, fingerprints[hostname]) for hostname in hostnames])
+
+        manager.get_fingerprints = get_fingerprints
+        result = {}
+        watcher = threading.Thread(target=lambda: result.update(manager.watch({'hostnames': dict(fingerprints), 'timeout': 10})))
+        watcher.start()
+        while not reads:
+            time.sleep(0.01)
+
+        # issue of not watched hostname doesn't wake watch
+        manager.certificate_issued('d.com')
+        fingerprints['b.com'] = 'b2'
+        manager.certificate_issued('b.com')
+        watcher.join(5)
+
+        self.assertEqual(result['hostnames'], ['b.com'])
+        self.assertEqual(reads, [['a.com', 'b.com', 'c.com'], ['b.com']])
+        self.assertEqual(manager._watchers, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
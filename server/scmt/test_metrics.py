@@ -0,0 +1,46 @@
+import unittest
+
+import metrics
+
+
+class MetricsTestCase(unittest.TestCase):
+    def test_render(self):
+        registry = metrics.Registry()
+        requests = registry.register(metrics.Counter('test_requests_total', 'Requests', ('method',)))
+        latency = registry.register(metrics.Histogram('test_latency_seconds', 'Latency', buckets=(0.1, 1)))
+        registry.register(metrics.Gauge('test_queue', 'Queue', callback=lambda: {(): 3}))
+
+        requests.inc(('cert',))
+        requests.inc(('cert',), 2)
+        latency.observe(0.5)
+        latency.observe(5)
+
+        output = registry.render()
+        self.assertIn('test_requests_total{method="cert"} 3.0', output)
+        self.assertIn('test_latency_seconds_bucket{le="0.1"} 0', output)
+        self.assertIn('test_latency_seconds_bucket{le="1.0"} 1', output)
+        self.assertIn('test_latency_seconds_bucket{le="+Inf"} 2', output)
+        self.assertIn('test_latency_seconds_count 2', output)
+        self.assertIn('test_queue 3.0', output)
+
+    def test_merge_shards(self):
+        collected = []
+        for shard in range(2):
+            registry = metrics.Registry()
+            latency = registry.register(metrics.Histogram('test_latency_seconds', 'Latency', buckets=(1,)))
+            latency.observe(0.5)
+            collected.append(registry.collect([('shard', shard)]))
+
+        output = metrics.merge(*collected)
+        self.assertEqual(output.count('# TYPE test_latency_seconds histogram'), 1)
+        self.assertIn('test_latency_seconds_bucket{shard="0",le="1.0"} 1', output)
+        self.assertIn('test_latency_seconds_count{shard="1"} 1', output)
+
+    def test_same_name(self):
+        registry = metrics.Registry()
+        first = registry.register(metrics.Counter('test_total', 'Test'))
+        self.assertIs(registry.register(metrics.Counter('test_total', 'Test')), first)
+
+
+if __name__ == '__main__':
+    unittest.main()
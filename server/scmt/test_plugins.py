@@ -0,0 +1,23 @@
+import collections
+import unittest
+
+import plugins
+
+
+class PluginsTestCase(unittest.TestCase):
+    def test_lazy_load_and_register(self):
+        plugins.register('storage', 'test-ordered', 'collections:OrderedDict')
+        self.assertIn('test-ordered', plugins.names('storage'))
+        self.assertIs(plugins.get('storage', 'test-ordered'), collections.OrderedDict)
+
+        # implementation could be named directly in config
+        self.assertEqual(plugins.get('ca', 'collections:OrderedDict.fromkeys'), collections.OrderedDict.fromkeys)
+
+    def test_unknown(self):
+        self.assertRaises(IndexError, plugins.get, 'hook', 'no-such-hook')
+        self.assertRaises(IndexError, plugins.get, 'hook', 'collections:NoSuchClass')
+        self.assertRaises(IndexError, plugins.get, 'hook', 'no_such_module:Hook')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+import time
+import unittest
+
+from clock import SimulatedClock
+from reconciler import Reconciler
+from storages.memory import MemoryStorage
+
+
+class IndexedStorage(MemoryStorage):
+    def __init__(self):
+        MemoryStorage.__init__(self)
+        self.index = 1
+        self.modified = {}
+        self.deleted = 0
+        self.scans = 0
+
+    def write(self, key, value):
+        MemoryStorage.write(self, key, value)
+        self.index += 1
+        self.modified[key] = self.index
+
+    def delete(self, key):
+        MemoryStorage.delete(self, key)
+        for stored in self.modified.keys():
+            if stored == key or stored.startswith(key + '/'):
+                del self.modified[stored]
+        self.index += 1
+        self.deleted = self.index
+
+    def changes(self, path, index=0):
+        # like consul, index of path is the last modification of its keys
+        keys = dict([(key[len(path) + 1:], modified) for key, modified in self.modified.items()
+                     if key.startswith(path + '/')])
+        path_index = max(keys.values() + [self.deleted])
+        if index == path_index:
+            return path_index, None
+
+        self.scans += 1
+        return path_index, dict([(key, modified) for key, modified in keys.items() if modified > index])
+
+
+class FakeCA:
+    def __init__(self, due):
+        self.due = due
+        self.checked = []
+
+    def cleanup_host(self, hostname):
+        self.checked.append(hostname)
+        return self.due.get(hostname, time.time() + 3600)
+
+
+class ReconcilerTestCase(unittest.TestCase):
+    def test_slices_and_resume(self):
+        storage = MemoryStorage()
+        for i in range(5):
+            storage.write('example.com/host%d.example.com/cert.pem' % i, 'cert')
+
+        ca = FakeCA({'host0.example.com': None})
+        reconciler = Reconciler('example.com', ca, storage)
+        reconciler.slice_size = 3
+
+        self.assertEqual(reconciler.tick(), 3)
+        self.assertEqual(len(ca.checked), 3)
+        # hosts are saved in buckets, not in one value
+        self.assertNotIn('hosts', storage.read('_scmt/reconcile/example.com'))
+        self.assertTrue(storage.keys('_scmt/reconcile/example.com/hosts'))
+
+        # state is persisted, new instance continues with remaining hosts
+        reconciler = Reconciler('example.com', ca, storage)
+        reconciler.slice_size = 3
+        self.assertEqual(reconciler.tick(), 2)
+        self.assertEqual(len(set(ca.checked)), 5)
+        self.assertEqual(reconciler.tick(), 0)
+        self.assertNotIn('host0.example.com', reconciler.state['hosts'])
+
+    def test_only_changed_hosts(self):
+        storage = IndexedStorage()
+        for i in range(3):
+            storage.write('example.com/host%d.example.com/cert.pem' % i, 'cert')
+
+        ca = FakeCA({})
+        reconciler = Reconciler('example.com', ca, storage)
+        self.assertEqual(reconciler.tick(), 3)
+        self.assertEqual(reconciler.tick(), 0)
+
+        # polling requests are not changes
+        scans = storage.scans
+        storage.write('example.com/host2.example.com/requests/10.0.0.1', '1')
+        self.assertEqual(reconciler.tick(), 0)
+        self.assertEqual(storage.scans, scans)
+
+        storage.write('example.com/host1.example.com/cert.pem', 'renewed')
+        reconciler.mark('host1.example.com')
+        self.assertEqual(reconciler.tick(), 1)
+        self.assertEqual(ca.checked[-1], 'host1.example.com')
+
+        # old marks are removed with next full listing
+        reconciler.clock = SimulatedClock(time.time() + reconciler.changes_retention + reconciler.list_interval)
+        self.assertEqual(reconciler.refresh(), 0)
+        self.assertFalse(storage.keys(reconciler.get_changes_path()))
+
+    def test_due_backlog_drains(self):
+        storage = IndexedStorage()
+        for i in range(25000):
+            storage.write('example.com/host%d.example.com/cert.pem' % i, 'cert')
+
+        clock = SimulatedClock(10 ** 6)
+        ca = FakeCA({})
+        reconciler = Reconciler('example.com', ca, storage, clock)
+        lists = []
+        storage_list = storage.list
+        storage.list = lambda path: lists.append(path) or storage_list(path)
+
+        # slice grows with due hosts, whole domain is checked in few ticks
+        self.assertEqual([reconciler.tick() for _ in range(4)], [10000, 10000, 5000, 0])
+
+        # marks replace hourly listing of the domain
+        clock.advance(reconciler.list_interval * 5)
+        reconciler.tick()
+        self.assertEqual(lists.count('example.com'), 1)
+
+    def test_due_order_with_simulated_clock(self):
+        storage = MemoryStorage()
+        for i in range(3):
+            storage.write('example.com/host%d.example.com/cert.pem' % i, 'cert')
+
+        clock = SimulatedClock(10 ** 6)
+        ca = FakeCA({'host0.example.com': clock.now + 300, 'host1.example.com': clock.now + 100,
+                     'host2.example.com': clock.now + 200})
+        reconciler = Reconciler('example.com', ca, storage, clock)
+        reconciler.slice_size = 1
+        self.assertEqual(reconciler.tick() + reconciler.tick() + reconciler.tick(), 3)
+        self.assertEqual(reconciler.next_due(), clock.now + 100)
+        self.assertEqual(reconciler.tick(), 0)
+
+        clock.advance(250)
+        self.assertEqual(reconciler.next_slice(), ['host1.example.com'])
+        reconciler.slice_size = 5
+        self.assertEqual(reconciler.next_slice(), ['host1.example.com', 'host2.example.com'])
+
+    def test_foreign_hosts_and_rebalance(self):
+        storage = MemoryStorage()
+        for i in range(4):
+            storage.write('example.com/host%d.example.com/cert.pem' % i, 'cert')
+
+        membership = FakeMembership(['host0.example.com', 'host1.example.com'])
+        ca = FakeCA({})
+        reconciler = Reconciler('example.com', ca, storage, membership=membership)
+        self.assertEqual(reconciler.get_state_path(), '_scmt/reconcile/a/example.com')
+        self.assertEqual(reconciler.tick(), 2)
+        self.assertEqual(sorted(ca.checked), ['host0.example.com', 'host1.example.com'])
+        # hosts of other replica are not kept in state of this one
+        self.assertEqual(sorted(reconciler.state['hosts']), ['host0.example.com', 'host1.example.com'])
+
+        # other replica left
+        membership.owned.append('host2.example.com')
+        self.assertEqual(reconciler.rebalance(), 1)
+        self.assertEqual(reconciler.next_slice(), ['host2.example.com'])
+
+        # host moved to other replica is forgotten
+        membership.owned.remove('host0.example.com')
+        self.assertEqual(reconciler.rebalance(), 0)
+        self.assertNotIn('host0.example.com', reconciler.state['hosts'])
+
+
+class FakeMembership:
+    node = 'a'
+
+    def __init__(self, owned):
+        self.owned = owned
+
+    def owns(self, hostname, domain):
+        return hostname in self.owned
+
+
+if __name__ == '__main__':
+    unittest.main()
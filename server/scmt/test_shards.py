@@ -0,0 +1,24 @@
+import unittest
+
+import shards
+
+
+class ShardsTestCase(unittest.TestCase):
+    def test_split_domains(self):
+        domains = dict([('d%d.com' % i, {'ca': 'letsencrypt'}) for i in range(5)])
+
+        split = shards.split_domains(domains, 2)
+        self.assertEqual([sorted(shard) for shard in split], [['d0.com', 'd2.com', 'd4.com'], ['d1.com', 'd3.com']])
+        self.assertEqual(len(shards.split_domains(domains, 16)), 5)
+
+    def test_find_domain(self):
+        domains = ['example.com', 'internal.example.com']
+
+        self.assertEqual(shards.find_domain(domains, 'a.example.com'), 'example.com')
+        self.assertEqual(shards.find_domain(domains, 'a.internal.example.com'), 'internal.example.com')
+        self.assertEqual(shards.find_domain(domains, 'example.com'), 'example.com')
+        self.assertIsNone(shards.find_domain(domains, 'badexample.com'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import time
+import unittest
+
+import tracing
+
+
+class TracingTestCase(unittest.TestCase):
+    def test_spans(self):
+        with tracing.span('outside'):
+            pass
+
+        tracing.start('issue', hostname='slow.example.com')
+        with tracing.span('authz'):
+            with tracing.span('acme.request'):
+                time.sleep(0.02)
+        try:
+            with tracing.span('finalize'):
+                raise RuntimeError("rate limit")
+        except RuntimeError:
+            pass
+        tracing.finish('error')
+
+        tracing.start('issue', hostname='fast.example.com')
+        tracing.finish()
+
+        slowest = tracing.slowest(1, 'issue')[0]
+        self.assertEqual(slowest['attrs']['hostname'], 'slow.example.com')
+        self.assertEqual([span['name'] for span in slowest['spans']], ['authz', 'acme.request', 'finalize'])
+        self.assertEqual(slowest['spans'][1]['depth'], 1)
+        self.assertEqual(slowest['spans'][2]['error'], 'rate limit')
+        self.assertIsNone(tracing.current())
+
+    def test_profiler(self):
+        trace = tracing.start('issue', hostname='example.com')
+        tracing.Profiler().sample()
+        tracing.finish()
+
+        self.assertIn('test_profiler', trace.to_dict()['samples'][0]['stack'])
+
+
+if __name__ == '__main__':
+    unittest.main()
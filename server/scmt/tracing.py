@@ -0,0 +1,210 @@
+"""
+Per-issuance tracing. Issue worker starts a trace for hostname, code on the way
+records nested spans into it, finished traces are kept in ring buffer and the
+slowest ones are served on /traces. Spans outside of trace cost one thread-local
+lookup.
+"""
+import collections
+import sys
+import threading
+import time
+import loggable
+
+# number of finished traces kept in memory
+BUFFER_SIZE = 256
+
+_local = threading.local()
+_finished = collections.deque(maxlen=BUFFER_SIZE)
+# thread ident => active trace, used by profiler
+_active = {}
+
+
+class Trace:
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.started = time.time()
+        self.duration = None
+        self.status = None
+        self.spans = []
+        self.depth = 0
+        # collapsed stack => number of profiler samples
+        self.samples = {}
+
+    def to_dict(self, samples=20):
+        top = sorted(self.samples.items(), key=lambda item: -item[1])[:samples]
+        return {
+            'name': self.name,
+            'attrs': self.attrs,
+            'started': self.started,
+            'duration': self.duration if self.duration is not None else time.time() - self.started,
+            'status': self.status,
+            'spans': [{
+                'name': name,
+                'offset': offset,
+                'duration': duration,
+                'depth': depth,
+                'attrs': attrs,
+                'error': error
+            } for name, offset, duration, depth, attrs, error in self.spans],
+            'samples': [{'stack': stack, 'count': count} for stack, count in top]
+        }
+
+
+class Span:
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.trace = None
+
+    def __enter__(self):
+        self.trace = getattr(_local, 'trace', None)
+        if self.trace is not None:
+            self.started = time.time()
+            self.trace.depth += 1
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        trace = self.trace
+        if trace is None:
+            return False
+
+        trace.depth -= 1
+        error = str(exc_value) if exc_value is not None else None
+        trace.spans.append((self.name, self.started - trace.started, time.time() - self.started,
+                            trace.depth, self.attrs, error))
+        return False
+
+
+class TimedSpan(Span):
+    """
+    Span which also observes its duration in histogram, even outside of trace
+    """
+    def __init__(self, name, attrs, histogram, labels):
+        Span.__init__(self, name, attrs)
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.observe_started = time.time()
+        return Span.__enter__(self)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.time() - self.observe_started, self.labels)
+        return Span.__exit__(self, exc_type, exc_value, traceback)
+
+
+def span(name, **attrs):
+    """
+    Record duration of with block in current trace
+
+    :param name:
+    :param attrs:
+    :return:
+    """
+    return Span(name, attrs)
+
+
+def timed(name, histogram, labels=(), **attrs):
+    """
+    Same as span() but duration is also observed in histogram
+
+    :param name:
+    :param histogram:
+    :param labels:
+    :param attrs:
+    :return:
+    """
+    return TimedSpan(name, attrs, histogram, labels)
+
+
+def start(name, **attrs):
+    """
+    Start trace in current thread
+
+    :param name:
+    :param attrs:
+    :return:
+    """
+    trace = Trace(name, attrs)
+    _local.trace = trace
+    _active[threading.current_thread().ident] = trace
+
+    return trace
+
+
+def finish(status='ok'):
+    """
+    Finish trace of current thread and put it to ring buffer
+
+    :param status:
+    :return:
+    """
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        return None
+
+    _local.trace = None
+    _active.pop(threading.current_thread().ident, None)
+    trace.duration = time.time() - trace.started
+    trace.status = status
+    # spans are recorded on exit, show them in start order
+    trace.spans.sort(key=lambda item: item[1])
+    _finished.append(trace)
+
+    return trace
+
+
+def current():
+    return getattr(_local, 'trace', None)
+
+
+def slowest(limit=10, name=None):
+    """
+    Get slowest recently finished traces
+
+    :param limit:
+    :param name: only traces with this name
+    :return: list of traces dicts
+    """
+    traces = [trace for trace in list(_finished) if name is None or trace.name == name]
+    traces.sort(key=lambda trace: -trace.duration)
+
+    return [trace.to_dict() for trace in traces[:limit]]
+
+
+def active():
+    return [trace.to_dict() for trace in _active.values()]
+
+
+class Profiler(loggable.Loggable, threading.Thread):
+    """
+    Sampling profiler, periodically takes stacks of threads running traces
+    """
+    # maximum number of frames in sample
+    max_depth = 30
+
+    def __init__(self, interval=0.05):
+        threading.Thread.__init__(self, name='profiler')
+        self.daemon = True
+        self.interval = interval
+
+    def run(self):
+        self.log("Sampling profiler started, interval %.3f sec" % self.interval)
+        while True:
+            time.sleep(self.interval)
+            self.sample()
+
+    def sample(self):
+        frames = sys._current_frames()
+        for ident, trace in _active.items():
+            frame = frames.get(ident)
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                code = frame.f_code
+                stack.append('%s:%s:%d' % (code.co_filename.split('/')[-1], code.co_name, frame.f_lineno))
+                frame = frame.f_back
+
+            key = ';'.join(reversed(stack))
+            trace.samples[key] = trace.samples.get(key, 0) + 1